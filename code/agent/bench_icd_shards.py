@@ -0,0 +1,124 @@
+"""
+按章分片基准：整库加载（解析 jsonl / mmap 整库快照） vs 按章分片快照（各章首次访问时才打开），
+比较常驻内存（RSS）与首轮耗时。每种方式在独立子进程中测量，互不影响。
+
+首轮：get_child_node / get_coding_rule 取根节点；展开：沿第一个章 -> 类目 -> 亚目依次取子节点与规则，
+与一个病人前几轮的工具调用相同。
+
+用法（在 code/agent 目录下）：
+    python bench_icd_shards.py
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from icd_tree import ICDTree, Node_DIR, Rule_DIR, build_shards, build_snapshot, load_shards
+
+MODES = ("jsonl", "snapshot", "shards")
+
+CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+import icd_tree
+
+def rss_kb():
+    stats = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                stats[key] = int(value.split()[0])
+    return stats
+
+mode, snapshot_path, shard_root = sys.argv[1:4]
+base = rss_kb()
+if mode == "jsonl":
+    tree = icd_tree.ICDTree(icd_tree.Node_DIR, icd_tree.Rule_DIR)
+elif mode == "snapshot":
+    tree = icd_tree.load_snapshot(snapshot_path, icd_tree.Node_DIR, icd_tree.Rule_DIR, None).tree
+else:
+    tree = icd_tree.load_shards(shard_root, icd_tree.Node_DIR, icd_tree.Rule_DIR, None).tree
+_, children = tree.get_child_node("root", 0)
+tree.get_coding_rule("root", 0)
+first_turn = time.perf_counter() - start
+first_turn_rss = rss_kb()
+
+node_id = children[0]["node_id"]
+for level in (1, 2, 3):
+    code, children = tree.get_child_node(node_id, level)
+    tree.get_coding_rule(node_id, level)
+    if code != 1 or not children:
+        break
+    node_id = children[0]["node_id"]
+expanded = time.perf_counter() - start
+print(json.dumps({"base": base, "first_turn": first_turn, "first_turn_rss": first_turn_rss,
+                  "expanded": expanded, "expanded_rss": rss_kb(),
+                  "loaded": getattr(tree, "loaded_shards", lambda: None)()}))
+"""
+
+
+def run(mode, snapshot_path, shard_root):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])))
+    out = subprocess.run([sys.executable, "-c", CHILD, mode, snapshot_path, shard_root],
+                         capture_output=True, text=True, env=env, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_icd_shards_")
+    snapshot_path = os.path.join(workdir, "icd_kb.snapshot")
+    shard_root = os.path.join(workdir, "icd_kb.shards")
+
+    start = time.perf_counter()
+    build_snapshot(snapshot_path, Node_DIR, Rule_DIR, None)
+    snapshot_build = time.perf_counter() - start
+    start = time.perf_counter()
+    version_dir = build_shards(shard_root, Node_DIR, Rule_DIR, None)
+    shards_build = time.perf_counter() - start
+    shard_files = sorted(os.listdir(version_dir))
+    shard_sizes = [os.path.getsize(os.path.join(version_dir, name)) for name in shard_files]
+    print(f"整库快照: {os.path.getsize(snapshot_path) / 2**20:.2f} MB，编译 {snapshot_build * 1000:.0f} ms")
+    print(f"分片快照: {len(shard_files)} 个，共 {sum(shard_sizes) / 2**20:.2f} MB，"
+          f"根分片 {os.path.getsize(os.path.join(version_dir, 'root.snapshot')) / 2**20:.2f} MB，"
+          f"最大分片 {max(shard_sizes) / 2**20:.2f} MB，编译 {shards_build * 1000:.0f} ms")
+
+    print()
+    print(f"{'加载方式':<12} {'首轮耗时':>10} {'首轮 RSS 增量':>14} {'展开耗时':>10} {'展开 RSS 增量':>14} {'其中匿名内存':>12}")
+    print("-" * 84)
+    for mode in MODES:
+        result = run(mode, snapshot_path, shard_root)
+        base = result["base"]
+        first = result["first_turn_rss"]["VmRSS"] - base["VmRSS"]
+        expanded = result["expanded_rss"]["VmRSS"] - base["VmRSS"]
+        anon = result["expanded_rss"].get("RssAnon", 0) - base.get("RssAnon", 0)
+        print(f"{mode:<12} {result['first_turn'] * 1000:>8.1f} ms {first / 1024:>11.2f} MB "
+              f"{result['expanded'] * 1000:>8.1f} ms {expanded / 1024:>11.2f} MB {anon / 1024:>9.2f} MB")
+        if result["loaded"]:
+            print(f"{'':<12} 已打开分片: {', '.join(result['loaded'])}")
+    print("-" * 84)
+
+    reference = ICDTree(Node_DIR, Rule_DIR)
+    sharded = run_consistency(reference, shard_root)
+    print(f"分片一致性校验: {len(reference.codes) - sharded}/{len(reference.codes)} 一致")
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_consistency(reference, shard_root):
+    """逐编码、逐层级比较整库树与分片树的工具返回，返回不一致的编码数"""
+    tree = load_shards(shard_root, Node_DIR, Rule_DIR, None).tree
+    mismatched = 0
+    for code in reference.codes:
+        if any(reference.get_child_node(code, level) != tree.get_child_node(code, level)
+               or reference.get_coding_rule(code, level) != tree.get_coding_rule(code, level)
+               for level in range(5)) or reference.get_path(code) != tree.get_path(code):
+            mismatched += 1
+    return mismatched
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+ICD 树内存占用基准：旧的 dict-of-lists 路径索引 vs 紧凑数组树 ICDTree，
+以及冷启动耗时：逐行解析 jsonl vs mmap 打开预编译快照。
+
+用法（在 code/agent 目录下）：
+    python bench_icd_tree.py [merge_path.jsonl]
+未提供 merge_path.jsonl 时，由 node_index 生成同结构的临时码表。
+"""
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from icd_tree import ICDTree, Node_DIR, Rule_DIR, build_snapshot, load_snapshot, split_code_name
+
+ALL_PATH_FILE = os.path.join(Node_DIR, "merge_path.jsonl")
+
+
+def build_full_hierarchy_index(jsonl_path):
+    """旧实现（原 retrival_agent.py / check/*.py）：为每个编码保存一条完整路径 list"""
+    index_map = {}
+    root_node = {"level": 0, "node_id": "root", "name": "根节点"}
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            l1_code, l1_name = split_code_name(entry.get("first_chapter", ""))
+            if not l1_code:
+                continue
+            path_l1 = [root_node, {"node_id": l1_code, "name": l1_name, "level": 1}]
+            index_map[l1_code] = path_l1
+            l2_code, l2_name = split_code_name(entry.get("second_chapter", ""))
+            path_l2 = path_l1
+            if l2_code:
+                path_l2 = path_l1 + [{"node_id": l2_code, "name": l2_name, "level": 2}]
+                index_map[l2_code] = path_l2
+            l3_code, l3_name = split_code_name(entry.get("third_chapter", ""))
+            current_parent_path = path_l2
+            if l3_code:
+                current_parent_path = path_l2 + [{"node_id": l3_code, "name": l3_name, "level": 3}]
+                index_map[l3_code] = current_parent_path
+            if entry.get("code"):
+                index_map[entry["code"]] = current_parent_path + [
+                    {"node_id": entry["code"], "name": entry.get("name"), "level": 4}]
+    return index_map
+
+
+def synthesize_merge_path(out_path):
+    """由 node_index 拼出 merge_path.jsonl 同结构的码表（仅用于基准）"""
+    tree = ICDTree(Node_DIR, Rule_DIR)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        for node, level in enumerate(tree.levels):
+            if level != 4:
+                continue
+            row = {"code": tree.codes[node], "name": tree.names[node],
+                   "first_chapter": "", "second_chapter": "", "third_chapter": ""}
+            parent = tree.parents[node]
+            while parent > 0:
+                field = ("first_chapter", "second_chapter", "third_chapter")[tree.levels[parent] - 1]
+                row[field] = f"{tree.codes[parent]} {tree.names[parent]}"
+                parent = tree.parents[parent]
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def measure(label, build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    obj = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {current / 2**20:>10.2f} MB {peak / 2**20:>10.2f} MB {elapsed * 1000:>9.1f} ms")
+    return obj, current
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else ALL_PATH_FILE
+    tmp = None
+    if not os.path.exists(path):
+        tmp = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False)
+        tmp.close()
+        synthesize_merge_path(tmp.name)
+        path = tmp.name
+        print(f"未找到 merge_path.jsonl，使用由 node_index 生成的码表: {path}")
+
+    print(f"{'索引':<28} {'常驻内存':>13} {'峰值':>13} {'构建耗时':>9}")
+    print("-" * 70)
+    legacy, legacy_bytes = measure("dict-of-lists (旧)", lambda: build_full_hierarchy_index(path))
+    tree, tree_bytes = measure("ICDTree.from_merge_path", lambda: ICDTree.from_merge_path(path))
+    print("-" * 70)
+    print(f"节点数: 旧 {len(legacy)} / 新 {len(tree)}，内存缩减 {legacy_bytes / max(tree_bytes, 1):.1f}x")
+
+    mismatched = sum(1 for code, p in legacy.items() if tree.get_path(code) != p)
+    print(f"路径一致性校验: {len(legacy) - mismatched}/{len(legacy)} 一致")
+
+    print()
+    print(f"{'冷启动':<28} {'常驻内存':>13} {'峰值':>13} {'耗时':>9}")
+    print("-" * 70)
+    snapshot_path = os.path.join(tempfile.gettempdir(), "bench_icd_kb.snapshot")
+    measure("解析 jsonl (旧)", lambda: (ICDTree(Node_DIR, Rule_DIR), ICDTree.from_merge_path(path)))
+    measure("build_snapshot", lambda: build_snapshot(snapshot_path, Node_DIR, Rule_DIR, path))
+    snapshot, _ = measure("load_snapshot (mmap)", lambda: load_snapshot(snapshot_path, Node_DIR, Rule_DIR, path))
+    print("-" * 70)
+    print(f"快照大小: {os.path.getsize(snapshot_path) / 2**20:.2f} MB")
+    reference = ICDTree(Node_DIR, Rule_DIR)
+    mismatched = sum(1 for code in reference.codes
+                     if reference.get_child_node(code, 3) != snapshot.tree.get_child_node(code, 3)
+                     or reference.get_path(code) != snapshot.tree.get_path(code))
+    print(f"快照一致性校验: {len(reference.codes) - mismatched}/{len(reference.codes)} 一致")
+    del snapshot
+    os.unlink(snapshot_path)
+
+    if tmp is not None:
+        os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+词法检索基准：LexicalIndex（ICD 名称的字符 n-gram BM25 倒排索引）的建索引耗时与每条 query 的检索延迟（微秒）。
+
+query 取自码表中随机抽取的编码名称：整条名称，及名称中随机截取的一段（模拟病历中只出现部分字面，如 "伞部"、"O1群"）；
+"按类目过滤" 一栏以该编码所在类目（second_chapter）为过滤条件。命中率为该编码排在前 k 的比例（检查结果正确，不是召回率评测）。
+只读码表（DATA_FILES），不需要向量库与嵌入服务；检索器中 lexical_search / hybrid_search 的词法一路即此索引。
+
+用法（在 code/agent 目录下）：
+    python bench_lexical_search.py [样本数] [k]
+"""
+import random
+import sys
+import time
+
+from ICD_retrival import DATA_FILES, CodeTable, LexicalIndex
+
+SOURCE = "ICD-10-fix"
+
+
+def fragment(name, rng):
+    """名称中随机截取的 2-6 个字"""
+    if len(name) <= 2:
+        return name
+    size = rng.randint(2, min(6, len(name)))
+    start = rng.randint(0, len(name) - size)
+    return name[start:start + size]
+
+
+def run_queries(index, queries, codes, wheres, k):
+    """返回 (平均每条耗时 µs, 目标编码排在前 k 的比例)"""
+    hits = 0
+    start = time.perf_counter()
+    results = [index.search(query, k, where) for query, where in zip(queries, wheres)]
+    elapsed = (time.perf_counter() - start) / len(queries)
+    for code, rows in zip(codes, results):
+        hits += any(index.metadatas[row]["code"] == code for row, _ in rows)
+    return elapsed * 1e6, hits / len(queries)
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    start = time.perf_counter()
+    table = CodeTable(DATA_FILES[SOURCE])
+    loaded = time.perf_counter()
+    index = LexicalIndex(table)
+    built = time.perf_counter()
+    print(f"码表 {len(table)} 条：读入 {(loaded - start) * 1000:.0f} ms，建索引 {(built - loaded) * 1000:.0f} ms，"
+          f"词数 {len(index._postings)}")
+
+    rng = random.Random(0)
+    picked = rng.sample(range(len(table)), min(samples, len(table)))
+    codes = [table.metadatas[i]["code"] for i in picked]
+    names = [table.metadatas[i]["name"] for i in picked]
+    query_sets = (("整条名称", names), ("名称片段", [fragment(name, rng) for name in names]))
+    filter_sets = (
+        ("全库", [None] * len(picked)),
+        ("按类目过滤", [{"second_chapter": table.metadatas[i].get("second_chapter")} for i in picked]),
+    )
+
+    print(f"样本数: {len(picked)}，k={k}")
+    print(f"{'query':<10} {'检索范围':<10} {'每条耗时':>12} {'命中率@k':>10}")
+    print("-" * 50)
+    for query_label, queries in query_sets:
+        for filter_label, wheres in filter_sets:
+            run_queries(index, queries[:50], codes[:50], wheres[:50], k)  # 预热（过滤条件的行号索引首次建立）
+            micros, hit_rate = run_queries(index, queries, codes, wheres, k)
+            print(f"{query_label:<10} {filter_label:<10} {micros:>9.1f} µs {hit_rate:>10.1%}")
+    print("-" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+量化向量基准：NumpyVectorBackend 的 float32 / float16 / int8（逐维缩放）矩阵，及是否按 float32 精确重排，
+比较矩阵内存、单条 / 批量查询延迟，以及相对当前检索路径（Chroma similarity_search_with_score）结果的召回率@k。
+
+query 取自向量库中随机抽取的编码名称（同 bench_vector_backend.py）；参照结果为 Chroma 的 similarity_search_with_score，
+另给出相对 float32 精确 top-k 的召回率，区分量化误差与 HNSW 近似误差。
+查询向量预先算好，嵌入服务的耗时不计入（similarity_search_with_score 的查询向量来自嵌入缓存）。
+"常驻矩阵" 为检索时整体扫描的矩阵大小；重排只按行读取 float32 矩阵（mmap）中的候选行。
+
+用法（在 code/agent 目录下，需可用的 Chroma 向量库；numpy 后端与量化矩阵首次运行时自动生成）：
+    python bench_quantized_vectors.py [样本数] [k]
+"""
+import random
+import sys
+import time
+
+from ICD_retrival import ICDRetriever, NumpyVectorBackend, get_embeddings, load_numpy_backend
+
+SOURCE = "ICD-10-fix"
+SETTINGS = (
+    ("float32", None, False),
+    ("float16", "float16", False),
+    ("float16+重排", "float16", True),
+    ("int8", "int8", False),
+    ("int8+重排", "int8", True),
+)
+
+
+def run_queries(store, vectors, k, batched):
+    """返回 (每条 query 的结果编码列表, 平均每条耗时)"""
+    start = time.perf_counter()
+    if batched:
+        result = store.query(query_embeddings=vectors, n_results=k)
+        codes = [[m["code"] for m in metadatas] for metadatas in result["metadatas"]]
+    else:
+        codes = [[m["code"] for m in store.query(query_embeddings=[vector], n_results=k)["metadatas"][0]]
+                 for vector in vectors]
+    return codes, (time.perf_counter() - start) / len(vectors)
+
+
+def recall(approx, exact):
+    total = sum(len(e) for e in exact)
+    return sum(len(set(a) & set(e)) for a, e in zip(approx, exact)) / total if total else 1.0
+
+
+def matrix_bytes(store):
+    return store.qvectors.nbytes + (store.scales.nbytes if store.scales is not None else 0)
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    chroma = ICDRetriever(sources=SOURCE, k=k, backend="chroma").vectorstores[SOURCE]
+    path = load_numpy_backend(SOURCE, chroma).path
+
+    base = NumpyVectorBackend(path)
+    random.seed(0)
+    picked = random.sample(range(base.count()), min(samples, base.count()))
+    queries = [base.metadatas[i]["name"] for i in picked]
+    start = time.perf_counter()
+    vectors = get_embeddings().embed_documents(queries)
+    print(f"样本数: {len(queries)}，k={k}，向量矩阵 {base.vectors.shape}，"
+          f"嵌入 {(time.perf_counter() - start) * 1000:.0f} ms（不计入下表）")
+
+    reference = [[doc.metadata["code"] for doc, _ in chroma.similarity_search_with_score(query, k=k)]
+                 for query in queries]
+    exact, _ = run_queries(base, vectors, k, batched=True)
+    print(f"Chroma 相对 float32 精确 top-k 的召回率: {recall(reference, exact):.1%}")
+
+    print(f"{'格式':<14} {'常驻矩阵':>10} {'缩减':>8} {'单条耗时':>10} {'批量(每条)':>12} "
+          f"{'召回率(vs Chroma)':>18} {'召回率(vs 精确)':>16}")
+    print("-" * 100)
+    for label, quantization, rescore in SETTINGS:
+        store = NumpyVectorBackend(path, quantization=quantization, rescore=rescore)
+        codes, single = run_queries(store, vectors, k, batched=False)
+        _, batched = run_queries(store, vectors, k, batched=True)
+        size = matrix_bytes(store)
+        print(f"{label:<14} {size / 2 ** 20:>7.1f} MB {1 - size / base.vectors.nbytes:>7.1%} "
+              f"{single * 1000:>8.2f} ms {batched * 1000:>10.2f} ms "
+              f"{recall(codes, reference):>18.1%} {recall(codes, exact):>16.1%}")
+    print("-" * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+规则 token 预算基准：对随机抽取的编码，取其路径上（根、章、类目、亚目）的全部规则，
+比较不同 token 预算下的提示词规模，以及答案相关规则的保留率。
+
+仓库中没有病历数据，query 以答案路径上各节点名称代替病历摘要；
+保留率是准确率的代理指标：
+  - 引用规则：abstart_code / 正文引用了答案路径编码的规则（按设计始终保留，应为 100%）；
+  - 亚目/类目规则：挂在答案自身类目、亚目上的规则（最具体、对选码影响最大）。
+真实的准确率变化需设置 base_agent.RULE_TOKEN_BUDGET（或 ICD_Jugde_rethink 的 rule_token_budget）
+完整跑一遍，再用 check/ 下的评测脚本对比。
+
+用法（在 code/agent 目录下）：
+    python bench_rule_selector.py [样本数]
+"""
+import random
+import sys
+import time
+
+from icd_tree import ICDTree, NO_RULE_TEXT, Node_DIR, Rule_DIR
+from rule_selector import estimate_tokens, normalize_code, rule_codes, select_rules
+
+BUDGETS = (None, 2000, 1000, 500, 250)
+
+
+def path_rules(tree, path):
+    """路径上各节点的规则（与 agent 在该路径上累计看到的规则一致，不含 "无特殊规则" 占位），附带其所在层级"""
+    rules = []
+    for item in path:
+        level = item["level"]
+        if level > 3:
+            continue
+        code, rule_list = tree.get_coding_rule(item["node_id"], level)
+        if code == 1:
+            rules += [(level, text) for text in rule_list if text != NO_RULE_TEXT]
+    return rules
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    tree = ICDTree(Node_DIR, Rule_DIR)
+    leaves = [code for code, level in zip(tree.codes, tree.levels) if level == 4]
+    random.seed(0)
+    cases = []
+    for code in random.sample(leaves, min(samples, len(leaves))):
+        path = tree.get_path(code)
+        rules = path_rules(tree, path)
+        query = " ".join(item["name"] for item in path[1:])
+        answer_codes = {normalize_code(item["node_id"]) for item in path[2:]}
+        cited = {i for i, (_, text) in enumerate(rules)
+                 if any(c.startswith(r) or r.startswith(c) for r in rule_codes(text) for c in answer_codes)}
+        specific = {i for i, (level, _) in enumerate(rules) if level >= 2}
+        cases.append((path, rules, query, cited, specific))
+
+    print(f"样本数: {len(cases)}，平均每条路径规则数: {sum(len(c[1]) for c in cases) / len(cases):.1f}")
+    print(f"{'预算':<8} {'平均 token':>10} {'缩减':>8} {'平均规则数':>10} {'引用规则保留':>12} {'亚目/类目规则保留':>16} {'耗时/次':>10}")
+    print("-" * 90)
+    baseline = None
+    for budget in BUDGETS:
+        tokens = kept_rules = cited_total = cited_kept = specific_total = specific_kept = 0
+        start = time.perf_counter()
+        for path, rules, query, cited, specific in cases:
+            texts = [text for _, text in rules]
+            candidates = [item["node_id"] for item in path[2:]]
+            kept = select_rules(texts, query, budget, candidates)
+            kept_ids = {id(text) for text in kept}
+            kept_index = {i for i, text in enumerate(texts) if id(text) in kept_ids}
+            tokens += sum(estimate_tokens(text) for text in kept)
+            kept_rules += len(kept)
+            cited_total += len(cited)
+            cited_kept += len(cited & kept_index)
+            specific_total += len(specific)
+            specific_kept += len(specific & kept_index)
+        elapsed = (time.perf_counter() - start) / len(cases)
+        avg_tokens = tokens / len(cases)
+        baseline = baseline or avg_tokens
+        print(f"{str(budget):<8} {avg_tokens:>10.0f} {1 - avg_tokens / baseline:>7.1%} {kept_rules / len(cases):>10.1f} "
+              f"{cited_kept / max(cited_total, 1):>12.1%} {specific_kept / max(specific_total, 1):>16.1%} "
+              f"{elapsed * 1000:>8.2f} ms")
+    print("-" * 90)
+
+
+if __name__ == "__main__":
+    main()
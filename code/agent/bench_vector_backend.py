@@ -0,0 +1,77 @@
+"""
+向量检索后端基准：Chroma（HNSW + SQLite 元数据） vs NumpyVectorBackend（整库矩阵精确检索），
+比较单条 / 批量查询的延迟，以及 Chroma 结果相对精确 top-k 的召回率。
+
+query 取自向量库中随机抽取的编码名称（与推荐诊断、get_child_node 的 query 同类）；
+"按类目过滤" 一栏以该编码所在类目（second_chapter）为过滤条件，对应 retrival_agent 中逐层召回子节点的调用。
+两个后端使用同一批预先算好的查询向量，嵌入服务的耗时不计入。
+
+用法（在 code/agent 目录下，需可用的 Chroma 向量库；numpy 后端首次运行时自动由 Chroma 导出）：
+    python bench_vector_backend.py [样本数] [k]
+"""
+import random
+import sys
+import time
+
+from ICD_retrival import ICDRetriever, get_embeddings
+
+SOURCE = "ICD-10-fix"
+
+
+def run_queries(store, vectors, k, wheres, batched):
+    """返回 (每条 query 的结果编码列表, 平均每条耗时)"""
+    start = time.perf_counter()
+    codes = []
+    if batched:
+        # 同一过滤条件的 query 合成一次调用（与 ICDRetriever.retrieve_many 相同）
+        groups = {}
+        for i, where in enumerate(wheres):
+            groups.setdefault(repr(where), (where, []))[1].append(i)
+        codes = [None] * len(vectors)
+        for where, indices in groups.values():
+            result = store._collection.query(query_embeddings=[vectors[i] for i in indices], n_results=k, where=where)
+            for i, metadatas in zip(indices, result["metadatas"]):
+                codes[i] = [m["code"] for m in metadatas]
+    else:
+        for vector, where in zip(vectors, wheres):
+            result = store._collection.query(query_embeddings=[vector], n_results=k, where=where)
+            codes.append([m["code"] for m in result["metadatas"][0]])
+    return codes, (time.perf_counter() - start) / len(vectors)
+
+
+def recall(approx, exact):
+    total = sum(len(e) for e in exact)
+    return sum(len(set(a) & set(e)) for a, e in zip(approx, exact)) / total if total else 1.0
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    chroma = ICDRetriever(sources=SOURCE, k=k, backend="chroma").vectorstores[SOURCE]
+    numpy_store = ICDRetriever(sources=SOURCE, k=k, backend="numpy").vectorstores[SOURCE]
+
+    random.seed(0)
+    picked = random.sample(range(numpy_store.count()), min(samples, numpy_store.count()))
+    queries = [numpy_store.metadatas[i]["name"] for i in picked]
+    start = time.perf_counter()
+    vectors = get_embeddings().embed_documents(queries)
+    print(f"样本数: {len(queries)}，k={k}，向量矩阵 {numpy_store.vectors.shape}，"
+          f"嵌入 {(time.perf_counter() - start) * 1000:.0f} ms（不计入下表）")
+
+    settings = (
+        ("全库", [None] * len(picked)),
+        ("按类目过滤", [{"second_chapter": numpy_store.metadatas[i].get("second_chapter")} for i in picked]),
+    )
+    print(f"{'检索范围':<10} {'后端':<8} {'单条耗时':>10} {'批量(每条)':>12} {'召回率@k':>10}")
+    print("-" * 60)
+    for label, wheres in settings:
+        exact, _ = run_queries(numpy_store, vectors, k, wheres, batched=True)
+        for name, store in (("chroma", chroma), ("numpy", numpy_store)):
+            codes, single = run_queries(store, vectors, k, wheres, batched=False)
+            _, batched = run_queries(store, vectors, k, wheres, batched=True)
+            print(f"{label:<10} {name:<8} {single * 1000:>8.2f} ms {batched * 1000:>10.2f} ms {recall(codes, exact):>10.1%}")
+    print("-" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from typing import Dict, Iterable, List, Optional
+
+
+class NodeRegistry:
+    """
+    单个病人会话内维护的 node_list（按首次加入的顺序）。
+
+    - 以 node_id 为键，成员判断与按 node_id 取值均为 O(1)，新增节点只追加，不再每轮由 list 重建 dict；
+    - 已存在的 node_id 再次加入时原位替换（与原 up_data_node_list 中 dict 赋值的语义一致）；
+    - str() / repr() 与 repr(list(...)) 逐字节一致，渲染结果缓存到内容变化为止，
+      因此可以直接放进提示词的 f-string 中。
+    """
+
+    def __init__(self, items: Iterable[Dict] = ()):
+        self._items: Dict[str, Dict] = {}
+        self._reprs: Dict[str, str] = {}
+        self._text: Optional[str] = None
+        for item in items:
+            self._put(item["node_id"], item)
+
+    def _put(self, node_id, item):
+        previous = self._items.get(node_id)
+        self._items[node_id] = item
+        if previous != item or list(previous) != list(item):
+            # 内容（含键顺序）变化才需要重新渲染
+            self._reprs[node_id] = repr(item)
+            self._text = None
+
+    def add(self, level, node_id, name):
+        self._put(node_id, {"level": level, "node_id": node_id, "name": name})
+
+    def add_node(self, node: Dict):
+        """加入当前节点（根节点除外）及其全部子节点，对应原 up_data_node_list"""
+        if node['level'] != 0:
+            self.add(node["level"], node["node_id"], node["name"])
+        self.add_children(node["child_node"])
+
+    def add_children(self, child_list: Optional[List[Dict]]):
+        """加入 get_child_node 返回的子节点，对应原 up_data_node_list_after_call"""
+        if child_list is None:
+            return
+        for child in child_list:
+            self.add(child["level"], child["node_id"], child["name"])
+
+    def __contains__(self, node_id):
+        return node_id in self._items
+
+    def __getitem__(self, node_id) -> Dict:
+        return self._items[node_id]
+
+    def get(self, node_id, default=None):
+        return self._items.get(node_id, default)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def to_list(self) -> List[Dict]:
+        return list(self._items.values())
+
+    def __repr__(self):
+        if self._text is None:
+            self._text = "[" + ", ".join(self._reprs.values()) + "]"
+        return self._text
+
+    __str__ = __repr__
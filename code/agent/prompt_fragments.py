@@ -0,0 +1,166 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from icd_tree import NO_RULE_TEXT
+
+
+class NodeFragments:
+    """
+    单个节点的工具返回值及其预渲染文本。
+    children / rules 与 get_child_node / get_coding_rule 的返回值相同，且在多个病人之间共享，只读使用；
+    children_text / rules_text 为对应 list 的 repr，与原先 f-string 中 {node["child_node"]} 的输出逐字节一致。
+    """
+    __slots__ = ("child_code", "children", "children_text", "child_ids", "rule_code", "rules", "rules_text")
+
+    def __init__(self, child_code, children, rule_code, rules):
+        self.child_code = child_code
+        self.children = children
+        self.children_text = repr(children)
+        self.child_ids = frozenset(item['node_id'] for item in children or ())
+        self.rule_code = rule_code
+        self.rules = rules
+        self.rules_text = repr(rules)
+
+
+class PathRuleBundle:
+    """
+    一条 根 -> 编码 路径上各节点的规则（nodes，不含根节点）及其渲染好的 path_context_str（text）。
+    在多个病人、多次回退后重试之间共享，只读使用。
+    """
+    __slots__ = ("nodes", "text")
+
+    def __init__(self, nodes: List[Dict]):
+        self.nodes = nodes
+        self.text = format_path_rules(nodes)
+
+
+def format_path_rules(path_rules: List[Dict]) -> str:
+    """校验提示词中 "待校验的编码路径" 一段（path_context_str）：逐层缩进列出节点及其规则"""
+    text = ""
+    for idx, node in enumerate(path_rules):
+        if 'rules' in node and node['rules']:
+            rules_str = "\n      - ".join(node['rules'])
+            rules_str = "\n      - " + rules_str
+        else:
+            rules_str = "无特殊规则"
+        indent = "  " * idx
+        text += f"{indent}-> [Level {node['level']}] {node['node_id']} {node['name']}\n{indent}   【节点对应规则】:{rules_str}\n"
+    return text
+
+
+class PromptFragmentCache:
+    """
+    按 (知识库版本, node_id, level) 缓存子节点列表、规则列表及其渲染文本，按路径缓存 format_path_to_str 的结果
+    以及校验用的路径规则包（PathRuleBundle），均为 LRU。
+
+    同一节点在不同病人、不同轮次中的提示词片段完全相同，命中后拼接提示词只需字符串拼接，
+    也让 vLLM 的前缀缓存看到稳定的文本。
+    version 返回当前（会话固定的）知识库版本，作为缓存键的一部分，知识库热更新后不会命中旧版本的片段。
+    """
+
+    def __init__(self, get_child_node: Callable, get_coding_rule: Callable, maxsize: int = 8192,
+                 version: Optional[Callable[[], str]] = None):
+        self._get_child_node = get_child_node
+        self._get_coding_rule = get_coding_rule
+        self._version = version or (lambda: None)
+        self.maxsize = maxsize
+        self._nodes: "OrderedDict[tuple, NodeFragments]" = OrderedDict()
+        self._paths: "OrderedDict[tuple, str]" = OrderedDict()
+        self._bundles: "OrderedDict[tuple, PathRuleBundle]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, table: OrderedDict, key):
+        with self._lock:
+            value = table.get(key)
+            if value is not None:
+                table.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def _store(self, table: OrderedDict, key, value):
+        with self._lock:
+            table[key] = value
+            table.move_to_end(key)
+            while len(table) > self.maxsize:
+                table.popitem(last=False)
+        return value
+
+    def node(self, node_id, level) -> NodeFragments:
+        """
+        获取节点片段；level 4 为最终编码，与 select_next_node 一致：无子节点、规则为默认提示。
+        backtry_path 回退到 level 4 节点时也取这里的值（原先为 get_child_node / get_coding_rule 的 None），见 backtry_path 中的说明
+        """
+        key = (self._version(), node_id, level)
+        fragments = self._lookup(self._nodes, key)
+        if fragments is None:
+            if level == 4:
+                fragments = NodeFragments(1, [], 1, [NO_RULE_TEXT])
+            else:
+                c_code, child_list = self._get_child_node(node_id, level)
+                r_code, rule_list = self._get_coding_rule(node_id, level)
+                fragments = NodeFragments(c_code, child_list, r_code, rule_list)
+            self._store(self._nodes, key, fragments)
+        return fragments
+
+    def children_text(self, node: Dict) -> str:
+        """repr(node["child_node"])；节点的子节点列表来自本缓存时直接返回预渲染文本"""
+        fragments = self._nodes.get((self._version(), node.get("node_id"), node.get("level")))
+        if fragments is not None and fragments.children is node["child_node"]:
+            return fragments.children_text
+        return repr(node["child_node"])
+
+    def child_ids(self, node: Dict) -> frozenset:
+        """node["child_node"] 中的 node_id 集合（来自本缓存时直接复用）"""
+        fragments = self._nodes.get((self._version(), node.get("node_id"), node.get("level")))
+        if fragments is not None and fragments.children is node["child_node"]:
+            return fragments.child_ids
+        return frozenset(item['node_id'] for item in node["child_node"])
+
+    def rules_text(self, node: Dict) -> str:
+        """repr(node["check_rules"])；规则列表来自本缓存时直接返回预渲染文本"""
+        fragments = self._nodes.get((self._version(), node.get("node_id"), node.get("level")))
+        if fragments is not None and fragments.rules is node["check_rules"]:
+            return fragments.rules_text
+        return repr(node["check_rules"])
+
+    def path_text(self, path: List[Dict]) -> str:
+        """与 format_path_to_str 相同：'node_id name -> node_id name'"""
+        key = tuple((item['node_id'], item['name']) for item in path)
+        text = self._lookup(self._paths, key)
+        if text is None:
+            text = self._store(self._paths, key, " -> ".join(f"{node_id} {name}" for node_id, name in key))
+        return text
+
+    def path_rules(self, path: List[Dict]) -> PathRuleBundle:
+        """
+        路径上各祖先节点的规则包（校验 validate_current_node 用）。以整条路径为键而非仅叶子编码：
+        同一编码可能挂在两个父节点下（如 M00 与 MO0），路径不同、规则也不同。
+        """
+        key = (self._version(),) + tuple((item['node_id'], item['level'], item['name']) for item in path)
+        bundle = self._lookup(self._bundles, key)
+        if bundle is None:
+            nodes = [{"node_id": node_id, "name": name, "level": level, "rules": self.node(node_id, level).rules}
+                     for node_id, level, name in key[1:] if node_id != 'root']
+            bundle = self._store(self._bundles, key, PathRuleBundle(nodes))
+        return bundle
+
+    def node_state_text(self, node_info: Dict, node: Dict, path_text: str, with_children: bool = True) -> str:
+        """
+        与 repr({"当前节点":..., "当前节点的子节点":..., "当前节点的特殊规则":..., "当前路径":...}) 逐字节一致，
+        用于 <tool_response> 中的节点状态。
+        """
+        parts = ["{'当前节点': ", repr(node_info)]
+        if with_children:
+            parts += [", '当前节点的子节点': ", self.children_text(node)]
+        parts += [", '当前节点的特殊规则': ", self.rules_text(node), ", '当前路径': ", repr(path_text), "}"]
+        return "".join(parts)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"nodes": len(self._nodes), "paths": len(self._paths), "bundles": len(self._bundles), "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -3,6 +3,10 @@ import re
 import os
 from typing import List, Dict, Optional, Tuple, Any
 import ast
+from icd_tree import ICDTree, get_icd_snapshot, get_icd_tree, get_knowledge_base, format_chapter, attach_knowledge_base, publish_knowledge_base, NO_RULE_TEXT
+from prompt_fragments import PromptFragmentCache, format_path_rules
+from rule_selector import select_rules
+from node_registry import NodeRegistry
 from ICD_retrival import ICDRetriever as ICDRetriever2
 from collections import defaultdict
 
@@ -47,127 +51,6 @@ def load_jsonl(file_path: str) -> List[Dict]:
             data.append(json.loads(line.strip()))
     return data
 
-def split_code_name(s):
-    """
-    辅助工具：将 "B26.2+ 流行性腮腺炎性脑炎" 切割为 "B26.2+" 和 "流行性腮腺炎性脑炎"
-    """
-    if not s or not isinstance(s, str):
-        return None, None
-    parts = s.split(' ', 1)
-    if len(parts) < 2:
-        return s.strip(), ""
-    return parts[0].strip(), parts[1].strip()
-
-def build_full_hierarchy_index(jsonl_path):
-    index_map = {}
-    
-    # === 1. 定义固定的根节点 ===
-    root_node = {
-        "level": 0,
-        "node_id": "root",
-        "name": "根节点"
-    }
-
-    with open(jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            
-            entry = json.loads(line)
-            
-            # --- Level 1 (First Chapter) ---
-            l1_raw = entry.get("first_chapter", "")
-            l1_code, l1_name = split_code_name(l1_raw)
-            if not l1_code: continue 
-            
-            node_l1 = {"node_id": l1_code, "name": l1_name, "level": 1}
-            
-            # [关键修改] 路径从 root_node 开始
-            path_l1 = [root_node, node_l1]
-            index_map[l1_code] = path_l1
-            
-            # --- Level 2 (Second Chapter) ---
-            l2_raw = entry.get("second_chapter", "")
-            l2_code, l2_name = split_code_name(l2_raw)
-            
-            path_l2 = path_l1 # 默认父路径
-            if l2_code:
-                node_l2 = {"node_id": l2_code, "name": l2_name, "level": 2}
-                path_l2 = path_l1 + [node_l2] # 拼接
-                index_map[l2_code] = path_l2
-            
-            # --- Level 3 (Third Chapter) ---
-            l3_raw = entry.get("third_chapter", "")
-            l3_code, l3_name = split_code_name(l3_raw)
-            
-            current_parent_path = path_l2
-            
-            if l3_code:
-                node_l3 = {"node_id": l3_code, "name": l3_name, "level": 3}
-                path_l3 = path_l2 + [node_l3] # 拼接
-                index_map[l3_code] = path_l3
-                current_parent_path = path_l3
-            
-            # --- Level 4 (Code) ---
-            l4_code = entry.get("code")
-            l4_name = entry.get("name")
-            
-            if l4_code:
-                node_l4 = {"node_id": l4_code, "name": l4_name, "level": 4}
-                path_l4 = current_parent_path + [node_l4] # 拼接
-                index_map[l4_code] = path_l4
-
-    return index_map
-
-icd_chapter_dict = {
-    "第一章": "第1章",
-    "第二章": "第2章",
-    "第三章": "第3章",
-    "第四章": "第4章",
-    "第五章": "第5章",
-    "第六章": "第6章",
-    "第七章": "第7章",
-    "第八章": "第8章",
-    "第九章": "第9章",
-    "第十章": "第10章",
-    "第十一章": "第11章",
-    "第十二章": "第12章",
-    "第十三章": "第13章",
-    "第十四章": "第14章",
-    "第十五章": "第15章",
-    "第十六章": "第16章",
-    "第十七章": "第17章",
-    "第十八章": "第18章",
-    "第十九章": "第19章",
-    "第二十章": "第20章",
-    "第二十一章": "第21章",
-    "第二十二章": "第22章"
-}
-chapter_dict_reversed = {
-    "第1章": "第一章",
-    "第2章": "第二章",
-    "第3章": "第三章",
-    "第4章": "第四章",
-    "第5章": "第五章",
-    "第6章": "第六章",
-    "第7章": "第七章",
-    "第8章": "第八章",
-    "第9章": "第九章",
-    "第10章": "第十章",
-    "第11章": "第十一章",
-    "第12章": "第十二章",
-    "第13章": "第十三章",
-    "第14章": "第十四章",
-    "第15章": "第十五章",
-    "第16章": "第十六章",
-    "第17章": "第十七章",
-    "第18章": "第十八章",
-    "第19章": "第十九章",
-    "第20章": "第二十章",
-    "第21章": "第二十一章",
-    "第22章": "第二十二章"
-}
 def extract_unique_values(node_list, field):
     """
     从节点列表中提取指定字段的所有唯一值。
@@ -728,21 +611,32 @@ def ICD_GetContent_v2(process_dict: dict, previous_func: str, params: dict) -> d
 
 # 1. 加载索引 (程序启动时只需执行一次)
 print(f"正在加载文件: {code_table_jsonl_path} ...")
-try:
-    code_to_entry = build_full_hierarchy_index(code_table_jsonl_path)
-    print(f"索引构建完成，包含 {len(code_to_entry)} 个节点。")
-except FileNotFoundError:
+# 码表与 node_index / rule_index 一起编入 mmap 快照，由 get_knowledge_base 统一管理：
+# 源文件变化时自动重新编译并热更新，查询时按当前（会话固定的）版本取码表
+EMPTY_CODE_TREE = ICDTree.empty()
+
+def get_code_tree():
+    code_tree = get_icd_snapshot(Node_DIR, Rule_DIR, code_table_jsonl_path).code_tree
+    return EMPTY_CODE_TREE if code_tree is None else code_tree
+
+if len(get_code_tree()):
+    print(f"索引构建完成，包含 {len(get_code_tree())} 个节点。")
+else:
     print("错误：找不到文件，请检查 code_table_jsonl_path 路径是否正确。")
-    code_to_entry = {}
+
+def get_code_keys():
+    """当前版本码表的 章节 / 类目 / 亚目 标签规范化表"""
+    return get_icd_snapshot(Node_DIR, Rule_DIR, code_table_jsonl_path).keys
 
 # 2. 定义查询函数
 def coda2path(code):
-    if code not in code_to_entry:
+    code_tree = get_code_tree()
+    if code not in code_tree:
         print(f"警告: answer_code '{code}' 未在码表中找到")
         return None
     
-    # 直接返回索引中存储好的路径 List
-    return code_to_entry[code]
+    # 路径由父指针按需生成
+    return code_tree.get_path(code)
 
 retriever = ICDRetriever2(sources="ICD-10-fix", k=40)
 
@@ -753,7 +647,8 @@ def get_child_node_new(node_id, level, query):
         if current_path:
             for item in current_path:
                 if item['level'] == level:
-                    filter_contidon = f"{item['node_id']} {item['name']}"
+                    # 过滤值取向量库元数据中的标签写法（如 "第1章“...”"、"A01 伤寒和副伤寒"），由快照的规范化表直接给出
+                    filter_contidon = get_code_keys().label(item['node_id']) or f"{item['node_id']} {item['name']}"
                     break
 
     level_to_filter = {1: "first_chapter", 2: "second_chapter", 3: "third_chapter"}
@@ -913,64 +808,9 @@ tools = [
     }
 ]
 
-def format_chapter(chapter_data):
-    """将单个章节的 JSON 对象转换为指定格式的字符串"""
-    chapter_name = chapter_data["chapter"]
-    sub_codes = chapter_data["sub_codes"]
-    lines = [f"{chapter_name}包含"]
-    for item in sub_codes:
-        code_range = item["节范围"]
-        name = item["节名称"]
-        lines.append(f"{code_range}，{name}")
-    return "\n".join(lines)
-
 def get_coding_rule(node_id,level):
-    node_rule_list=[]
-    if level==0:
-        rule_list=load_jsonl(BASE_RULE_FILE0)
-        for item in rule_list:
-            # print(item)
-            rule_content=format_chapter(item)
-            node_rule_list.append(rule_content)
-        rule_list=load_jsonl(BASE_RULE_FILE)
-        for rule_item in rule_list:
-            node_rule_list.append(rule_item['rule_content'])
-    elif level==1:
-        rule_list=load_jsonl(CHAPTER_RULE_FILE)
-        node_dict={}
-        for item in rule_list:
-            node_dict[item['chapter']]=item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            rule_list=node_dict[node_id]['chapter_rules']
-            for item in rule_list:
-                node_rule_list.append(item['rule_content'])
-    elif level==2:
-        rule_list=load_jsonl(CATEGORY_RULE_FILE)
-        node_dict={}
-        for item in rule_list:
-            node_dict[item['sub_chapter']]=item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            rule_list=node_dict[node_id]['category_rules']
-            for item in rule_list:
-                node_rule_list.append(item['rule_content'])
-    elif level==3:
-        rule_list=load_jsonl(SUBCATEGORY_RULE_FILE)
-        node_dict={}
-        for item in rule_list:
-            node_dict[item['de_chapter']]=item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            rule_list=node_dict[node_id]['subcategory_rules']
-            for item in rule_list:
-                node_rule_list.append(item['rule_content'])
-    if not node_rule_list:
-        node_rule_list.append('该编码下无特殊编码规则，请根据电子病历内容和ICD节点信息判断选择路径')
-    return 1,node_rule_list
+####根据node_id,level，获得节点规则 返回【int，list】0表示节点不在该层级规则文件中 1表示正常
+    return get_icd_tree(Node_DIR, Rule_DIR).get_coding_rule(node_id, level)
 
 import copy
 def backtry_path(pass_flag, level, node, path, parent_node, current_coding_trace):
@@ -986,25 +826,21 @@ def backtry_path(pass_flag, level, node, path, parent_node, current_coding_trace
         new_parent_node = parent_node 
 
     current_path_list = path[-1]
-    new_path_list = []
-    target_item = None
-
-    for item in current_path_list:
-        item_copy = copy.deepcopy(item)
-        if item_copy['level'] == level:
-            target_item = item_copy
-            new_path_list.append(item_copy)
-            break 
-        else:
-            new_path_list.append(item_copy)
-            new_parent_node = item_copy
+    # 按层级定位回退目标在当前路径中的下标，只复制目标及其以上的前缀
+    # (路径节点均为 {'level','node_id','name'} 扁平 dict，浅拷贝即可，无需 deepcopy)
+    target_pos = next((i for i, item in enumerate(current_path_list) if item['level'] == level), None)
 
     # print(f"当前尝试回退至 Level: {level}")
     
-    if not target_item:
+    if target_pos is None:
         # print("回退失败：在当前路径中未找到指定层级")
         return 0, node, path, parent_node, current_coding_trace
 
+    new_path_list = [dict(item) for item in current_path_list[:target_pos + 1]]
+    target_item = new_path_list[target_pos]
+    if target_pos > 0:
+        new_parent_node = new_path_list[target_pos - 1]
+
     path.append(new_path_list)
     
     # --- 2. 证据链回溯处理 (核心修改) ---
@@ -1023,9 +859,13 @@ def backtry_path(pass_flag, level, node, path, parent_node, current_coding_trace
     # print(f"证据链已回退，保留前 {len(new_coding_trace)} 条记录")
 
     # --- 3. 获取子节点与规则 ---
-    c_code, child_list = get_child_node(target_item['node_id'], target_item['level'])
-    r_code, rule_list = get_coding_rule(target_item['node_id'], target_item['level'])
-    pc_code, pchild_list = get_child_node(new_parent_node['node_id'], new_parent_node['level'])
+    # 子节点、规则列表取自 PROMPT_FRAGMENTS（跨病人共享，只读）
+    # 注意：回退目标为 level 4（最终编码）时，这里得到 child_node=[]、check_rules=[NO_RULE_TEXT]（同 select_next_node），
+    # 而原先 get_child_node / get_coding_rule 返回 (-1, None)，工具返回中显示为 None，之后在 up_data_node_list 中遍历 None 报错。
+    # 这是有意的修正，该情形下的提示词与原先不同。
+    target_fragments = PROMPT_FRAGMENTS.node(target_item['node_id'], target_item['level'])
+    child_list, rule_list = target_fragments.children, target_fragments.rules
+    pchild_list = PROMPT_FRAGMENTS.node(new_parent_node['node_id'], new_parent_node['level']).children
 
     new_node = {
         "level": target_item['level'],
@@ -1046,38 +886,17 @@ def backtry_path(pass_flag, level, node, path, parent_node, current_coding_trace
     return 1, new_node, path, new_parent_node_struct, new_coding_trace
     
 def up_data_node_list(node,node_list):
-    node_dict = {item["node_id"]: item for item in node_list}
-    if node['level']!=0:
-    # 添加当前节点,根节点不添加
-        node_dict[node["node_id"]] = {
-            "level": node["level"],
-            "node_id": node["node_id"],
-            "name": node["name"]
-        }
-    # 添加所有子节点
-    for child in node["child_node"]:
-        node_dict[child["node_id"]] = {
-            "level": child["level"],
-            "node_id": child["node_id"],
-            "name": child["name"]
-        }
-
-    # 转换回列表并返回
-    return list(node_dict.values())
+####node_list 为会话内增量维护的 NodeRegistry（传入 list 时先转换）；添加当前节点(根节点不添加)及所有子节点
+    if not isinstance(node_list, NodeRegistry):
+        node_list = NodeRegistry(node_list)
+    node_list.add_node(node)
+    return node_list
 
 def up_data_node_list_after_call(child_list,node_list):
-    if child_list is None:
-        return node_list
-    node_dict = {item["node_id"]: item for item in node_list}
-    for child in child_list:
-        node_dict[child["node_id"]] = {
-            "level": child["level"],
-            "node_id": child["node_id"],
-            "name": child["name"]
-        }
-
-    # 转换回列表并返回
-    return list(node_dict.values())
+    if not isinstance(node_list, NodeRegistry):
+        node_list = NodeRegistry(node_list)
+    node_list.add_children(child_list)
+    return node_list
 
 def format_path_to_str(path):
     """
@@ -1089,7 +908,7 @@ def format_path_to_str(path):
     返回:
         str: 格式化后的路径字符串，如 "A00 霍乱 -> A00.0 霍乱弧菌"
     """
-    return " -> ".join(f"{node['node_id']} {node['name']}" for node in path)
+    return PROMPT_FRAGMENTS.path_text(path)
 
 
 
@@ -1097,66 +916,23 @@ def format_path_to_str(path):
 
 def get_child_node(node_id,level):
 ####根据node_id,level，获得子节点 返回【int，list】0表示节点错误 1表示正常 -1表示层级错误
+    return get_icd_tree(Node_DIR, Rule_DIR).get_child_node(node_id, level)
 
-    child_node_list=[]
-    if level==0:
-        node_list=load_jsonl(CHAPTER_FILE)
-        for node_item in node_list:
-            child_node_list.append({'node_id':node_item["chapter"],"name":node_item["name"],"level":1})
-    elif level==1:
-        node_dict={}
-        node_list=load_jsonl(CHAPTER_FILE)
-        for node_item in node_list:
-            node_dict[node_item["chapter"]]=node_item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            node_list=node_dict[node_id]['sub_code']
-            for node_item in node_list:
-                child_node_list.append({'node_id':node_item["code"],"name":node_item["name"],"level":2})
-    elif level==2:
-        node_dict={}
-        node_list=load_jsonl(CATEGORY_FILE)
-        for node_item in node_list:
-            node_dict[node_item["sub_chapter"]]=node_item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            node_list=node_dict[node_id]['sub_code']
-            ####可能存在类目节点的下级节点没有亚目节点，而是直接为最终节点
-            if not node_list:
-                node_dict={}
-                node_list=load_jsonl(SUBCATEGORY_FILE)
-                for node_item in node_list:
-                    node_dict[node_item["de_chapter"]]=node_item
-                if node_id not in node_dict:
-                    return 0,None
-                else:
-                    node_list=node_dict[node_id]['sub_code']
-               
-                    
-                    for node_item in node_list:
-                        child_node_list.append({'node_id':node_item["code"],"name":node_item["name"],"level":4})
-            else:
-                for node_item in node_list:
-                    child_node_list.append({'node_id':node_item["code"],"name":node_item["name"],"level":3})
-    elif level==3:
-        node_dict={}
-        node_list=load_jsonl(SUBCATEGORY_FILE)
-        for node_item in node_list:
-            node_dict[node_item["de_chapter"]]=node_item
-        if node_id not in node_dict:
-            return 0,None
-        else:
-            node_list=node_dict[node_id]['sub_code']
- 
-            
-            for node_item in node_list:
-             
-                child_node_list.append({'node_id':node_item["code"],"name":node_item["name"],"level":4})
-    else:
-        return -1,None
-    return 1,child_node_list
+####按节点缓存子节点/规则列表及其渲染文本，提示词中的片段与 repr 输出逐字节一致
+PROMPT_FRAGMENTS = PromptFragmentCache(get_child_node, get_coding_rule,
+                                       version=lambda: get_icd_snapshot(Node_DIR, Rule_DIR).version)
+
+# check_rules 的 token 预算：None 时工具返回保留节点的全部规则；
+# 设为整数时按与病历的字符 n-gram BM25 相关度截取，引用了当前节点或其子节点编码的规则始终保留
+RULE_TOKEN_BUDGET = None
+
+def apply_rule_budget(node, rule_query):
+    """按 RULE_TOKEN_BUDGET 截取 node["check_rules"]，返回新的 node（不修改缓存中的规则列表）"""
+    if RULE_TOKEN_BUDGET is None or not node.get("check_rules"):
+        return node
+    candidates = [node["node_id"]] + [item["node_id"] for item in node.get("child_node") or ()]
+    rules = select_rules(node["check_rules"], rule_query, RULE_TOKEN_BUDGET, candidates)
+    return dict(node, check_rules=rules or [NO_RULE_TEXT])
 
 def select_next_node(node,select_node_id,path):
     sub_node_list=node['child_node']
@@ -1166,13 +942,14 @@ def select_next_node(node,select_node_id,path):
     if select_node_id not in node_dict:
         return 0,node,path
     else:
+        fragments=PROMPT_FRAGMENTS.node(select_node_id,node_dict[select_node_id]['level'])
         if node_dict[select_node_id]['level']==4:
-            node={"level":node_dict[select_node_id]['level'],"node_id":select_node_id,"name":node_dict[select_node_id]['name'],"check_rules":['该编码下无特殊编码规则，请根据电子病历内容和ICD节点信息判断选择路径'],"child_node":[]}
+            node={"level":node_dict[select_node_id]['level'],"node_id":select_node_id,"name":node_dict[select_node_id]['name'],"check_rules":fragments.rules,"child_node":fragments.children}
             path[-1].append({"level":node_dict[select_node_id]['level'],"node_id":select_node_id,"name":node_dict[select_node_id]['name']})
             return 1,node,path
         else:
-            c_code,child_list=get_child_node(select_node_id,node_dict[select_node_id]['level'])
-            r_code,rule_list=get_coding_rule(select_node_id,node_dict[select_node_id]['level'])
+            c_code,child_list=fragments.child_code,fragments.children
+            r_code,rule_list=fragments.rule_code,fragments.rules
             if c_code==1 and r_code==1:
                 node={"level":node_dict[select_node_id]['level'],"node_id":select_node_id,"name":node_dict[select_node_id]['name'],"check_rules":rule_list,"child_node":child_list}
                 path[-1].append({"level":node_dict[select_node_id]['level'],"node_id":select_node_id,"name":node_dict[select_node_id]['name']})
@@ -1197,28 +974,15 @@ def check_emr_content(process_dict,part,params):
 
 
 
-def validate_current_node(parent_node,currnt_node,currnt_path,file_content,current_coding_trace,answer_path):
+def validate_current_node(parent_node,currnt_node,currnt_path,file_content,current_coding_trace,answer_path,path_context_str=None):
 #     # print("父节点")
 #     # print(parent_node)
     
-    # A. 纵向路径（静态结构与规则）
-    path_context_str = ""
+    # A. 纵向路径（静态结构与规则）；调用方已有路径规则包（PROMPT_FRAGMENTS.path_rules）时直接传入其文本
+    if path_context_str is None:
+        path_context_str = format_path_rules(currnt_path)
     # 建立一个 ID 到 Name 的映射，方便后面给 Trace 补全名称
-    id_to_name_map = {} 
-    
-    for idx, node in enumerate(currnt_path):
-        id_to_name_map[node['node_id']] = node['name']
-        
-        # 修改：不使用 .get('rules', [])
-        if 'rules' in node and node['rules']:
-            rules = node['rules']
-            rules_str = "\n      - ".join(rules)
-            rules_str = "\n      - " + rules_str
-        else:
-            rules_str = "无特殊规则"
-            
-        indent = "  " * idx
-        path_context_str += f"{indent}-> [Level {node['level']}] {node['node_id']} {node['name']}\n{indent}   【节点对应规则】:{rules_str}\n"
+    id_to_name_map = {node['node_id']: node['name'] for node in currnt_path}
 
     # B. 历史决策轨迹（动态推理过程）
     trace_context_str = ""
@@ -1483,6 +1247,16 @@ def compress_history_prompt(full_prompt_content):
 
 
 def process_single_patient(select_data):
+    """
+    单个病人的编码会话。会话期间固定使用进入时的知识库版本（热更新只影响之后开始的病人），
+    并在输出记录中写入 kb_version，便于复现。
+    """
+    with get_knowledge_base(Node_DIR, Rule_DIR).session() as kb_snapshot:
+        result = _process_single_patient(select_data)
+    result["kb_version"] = kb_snapshot.version
+    return result
+
+def _process_single_patient(select_data):
     try:
         patient_id = select_data["patient_id"]
         process_dict = dict()
@@ -1530,16 +1304,17 @@ def process_single_patient(select_data):
         node = {"level": 0, "node_id": "root", "name": "根节点", "check_rules": [], "child_node": []}
         all_path = [[]]
         file_content = process_dict['file_content']
+        rule_query = str(file_content)
 
-        a_code, code_list = get_child_node("root", 0)
-        b_code, rule_list = get_coding_rule("root", 0)
-        node["check_rules"] = rule_list
-        node["child_node"] = code_list
+        root_fragments = PROMPT_FRAGMENTS.node("root", 0)
+        node["check_rules"] = root_fragments.rules
+        node["child_node"] = root_fragments.children
+        node = apply_rule_budget(node, rule_query)
         node_info = {"level": node["level"], "node_id": node["node_id"], "name": node['name']}
         parent_node = {}
         all_path[-1].append(node_info)
 
-        node_list_all = [{"node_id":"root","name":"root","level":0}]
+        node_list_all = NodeRegistry([{"node_id":"root","name":"root","level":0}])
         node_list_all = up_data_node_list(node=node, node_list=node_list_all)
         currnt_path = all_path[-1]
         currnt_path_info = format_path_to_str(currnt_path)
@@ -1556,7 +1331,7 @@ def process_single_patient(select_data):
         病历内容：{file_content}
         当前节点：{node_info}
         当前维护的 node_list ：{node_list_all}
-        当前节点的特殊规则：{node["check_rules"]}
+        当前节点的特殊规则：{PROMPT_FRAGMENTS.rules_text(node)}
         当前路径：{currnt_path_info}
         """
         base_prompt = base_prompt+"。/think"
@@ -1592,13 +1367,7 @@ def process_single_patient(select_data):
             # history_list = [item for item in history_list if 'error' not in item]
             answer_tools = extract_operations(responce, ['name', 'arguments'])
 
-            check_node_list_dict = {item['node_id']: item for item in node_list_all}
-            # check_sub_list_dict = {item['node_id']: item for item in node["child_node"]}
-            check_sub_list_dict = {
-                item['node_id']: item 
-                for item in node["child_node"] 
-                if item['node_id'] in check_node_list_dict
-            }
+            # node_list_all 为 NodeRegistry，成员判断 O(1)，不再每轮重建 check_node_list_dict / check_sub_list_dict
 
             if not answer_tools:
                 geshi=f"""调用函数出错，格式错误。应该使用`<tool_call></tool_call>`标签包裹，然后内部使用**有效的JSON对象**指定函数名称和参数禁止在内部使用XML子标签格式**（如`<name>`、`<arguments>`等）
@@ -1617,6 +1386,7 @@ def process_single_patient(select_data):
 
             answer_tool = answer_tools[-1]
             action_list.append(answer_tool['name'])
+            tool_response_text = None  # 由缓存片段拼接出的 repr(tool_response)，None 时按原样渲染
             
             if answer_tool['name'] == 'get_child_node':
                 if 'node_id' not in answer_tool['arguments']:
@@ -1631,13 +1401,13 @@ def process_single_patient(select_data):
                 else:
                     node_id = answer_tool['arguments']['node_id']
                     query = answer_tool['arguments']['query']
-                    if node_id not in check_node_list_dict:
+                    if node_id not in node_list_all:
                         base_prompt = f"调用函数出错，你选择的node_id不在维护的node_list中。你选择的node_id为{node_id}，当前维护的 node_list ：{node_list_all}"
                         tool_response={"error":base_prompt}
                         # base_prompt=tool_response
 
                     else:
-                        model_node = check_node_list_dict[node_id]
+                        model_node = node_list_all[node_id]
                         if model_node['level']==4:
                             tool_response={"选择node_id":node_id,"对应子节点":[]}
                             base_prompt = f"调用函数成功。你选择的node_id为{node_id}，其没有子节点"
@@ -1664,22 +1434,24 @@ def process_single_patient(select_data):
                     node_id = answer_tool['arguments']['selected_node_id']
                     step_evidence = answer_tool['arguments']['evidence_quote']
                     step_rule = answer_tool['arguments']['rule_quote']
-                    if node_id not in check_sub_list_dict:
+                    if node_id not in PROMPT_FRAGMENTS.child_ids(node) or node_id not in node_list_all:
                         base_prompt = f"调用函数出错，你选择的node_id不在维护的node_list中。你选择的node_id为{node_id}，当前维护的 node_list ：{node_list_all}。建议先使用get_child_node工具补充结点信息"
                         tool_response={"error":base_prompt}
                         # base_prompt=tool_response
                     else:
                         parent_node = node
                         s_code, node, path = select_next_node(node=node, select_node_id=node_id, path=all_path)
+                        node = apply_rule_budget(node, rule_query)
                         node_info = {"level": node["level"], "node_id": node["node_id"], "name": node['name']}
                         currnt_path = all_path[-1]
                         currnt_path_info = format_path_to_str(currnt_path)
                         base_prompt = f"""下移成功：
                         当前节点：{node_info}
-                        当前节点的特殊规则：{node["check_rules"]}
+                        当前节点的特殊规则：{PROMPT_FRAGMENTS.rules_text(node)}
                         当前路径：{currnt_path_info}
                         """
                         tool_response={"当前节点":node_info,"当前节点的特殊规则":node["check_rules"],"当前路径":currnt_path_info}
+                        tool_response_text=PROMPT_FRAGMENTS.node_state_text(node_info, node, currnt_path_info, with_children=False)
                         # node_list_all = up_data_node_list_after_call(node["child_node"], node_list_all)
                         current_coding_trace.append({'node_id':node_info['node_id'],'level':node_info['level'],'step_evidence':step_evidence,'step_rule':step_rule})
                         # base_prompt=tool_response
@@ -1690,18 +1462,14 @@ def process_single_patient(select_data):
                     tool_response={"error":base_prompt}
                 else:
                     currnt_path = all_path[-1]
-                    currnt_path_rule=[]
-                    for item in currnt_path :
-                        if item['node_id']=='root':
-                            continue
-                        r_flag,rules=get_coding_rule(item['node_id'],item['level'])
-                        new_item={"node_id":item['node_id'],"name":item['name'],"level":item['level'],'rules':rules}
-                        currnt_path_rule.append(new_item)
+                    # 路径规则包按路径缓存：同一路径在不同病人、回退后重试之间直接复用已渲染的 path_context_str
+                    path_bundle = PROMPT_FRAGMENTS.path_rules(currnt_path)
                     
                     check_pass, reason = validate_current_node(
                         parent_node=parent_node,
                         currnt_node=node_info,
-                        currnt_path=currnt_path_rule,
+                        currnt_path=path_bundle.nodes,
+                        path_context_str=path_bundle.text,
                         file_content=file_content,
                         current_coding_trace=current_coding_trace,
                         answer_path=answer_path
@@ -1731,15 +1499,17 @@ def process_single_patient(select_data):
                         # base_prompt=tool_response
                     else:
                         v_code, node, all_path, parent_node,current_coding_trace = backtry_path(pass_flag=0, level=model_level, node=node, path=all_path, parent_node=parent_node,current_coding_trace=current_coding_trace)
+                        node = apply_rule_budget(node, rule_query)
                         node_info = {"level": node["level"], "node_id": node["node_id"], "name": node['name']}
                         currnt_path = all_path[-1]
                         currnt_path_info = format_path_to_str(currnt_path)
                         base_prompt = f"""调用函数成功，成功回退节点。
                         当前节点：{node_info}
-                        当前节点的特殊规则：{node["check_rules"]}
+                        当前节点的特殊规则：{PROMPT_FRAGMENTS.rules_text(node)}
                         当前路径：{currnt_path_info}
                         """
                         tool_response={"当前节点":node_info,"当前节点的特殊规则":node["check_rules"],"当前路径":currnt_path_info}
+                        tool_response_text=PROMPT_FRAGMENTS.node_state_text(node_info, node, currnt_path_info, with_children=False)
                         check_finish=False
                         # base_prompt=tool_response
 
@@ -1763,8 +1533,8 @@ def process_single_patient(select_data):
                     if node_info['level'] != 4:
                         base_prompt = f"""
                         当前节点为{node_info['level']},所在层级不为最终编码，无法停止
-                        当前节点的子节点：{node.get("child_node", "无")}
-                        当前节点的特殊规则：{node.get("check_rules", "无")}
+                        当前节点的子节点：{PROMPT_FRAGMENTS.children_text(node) if "child_node" in node else "无"}
+                        当前节点的特殊规则：{PROMPT_FRAGMENTS.rules_text(node) if "check_rules" in node else "无"}
                         当前路径：{currnt_path_info}
                         """
                         tool_response = {"error": base_prompt}
@@ -1797,7 +1567,7 @@ def process_single_patient(select_data):
             else:
                 base_prompt = "调用函数失败，name参数名错误。"
                 tool_response={"error":base_prompt}
-            base_prompt=f"""<tool_response>\n{tool_response}\n</tool_response>。 /think"""
+            base_prompt=f"""<tool_response>\n{tool_response if tool_response_text is None else tool_response_text}\n</tool_response>。 /think"""
             if "error" in tool_response:  #######如果出错了，就不加入训练数据中  且这一轮对话需要删除
                 # print(f"{patient_id}执行过程中出现错误")
                 history_list.append({'assistant': responce,'error':True})
@@ -1846,12 +1616,32 @@ def process_single_patient(select_data):
 import json
 import os
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 
 TEST_DATA_FILE = "../data/code4detail.json"  # 替换为实际路径
 OUTPUT_JSONL_FILE = "./deepseek/deepseek_retrival_agent.jsonl"
 EXEC_ERROR_JSONL_FILE = "./paper_test/deepseek/deepseek_retrival_error.jsonl"
+# True 时改用多进程：父进程发布知识库快照，各子进程以只读 mmap 挂载同一份（不受 GIL 限制）
+USE_PROCESS_POOL = False
+
+
+def process_and_save(data):
+    """处理单个病人数据并返回结果"""
+    result = process_single_patient(data)
+    if "error" in result:
+        return ("error", result)
+    
+    final_node = result['final_node']
+    model_code = final_node['node_id']
+    answer_code = result['answer_code']
+    
+    if (model_code ==answer_code) and final_node['level'] == 4:
+        return ("success", result)
+    else:
+        return ("data_error", result)
+
+
 if __name__ == '__main__':
 
     # 读取测试数据
@@ -1871,24 +1661,14 @@ if __name__ == '__main__':
 
     print(f"总病人数量: {len(patient_data)}，已处理: {len(processed_ids)}，待处理: {len(to_process)}")
 
-    def process_and_save(data):
-        """处理单个病人数据并返回结果"""
-        result = process_single_patient(data)
-        if "error" in result:
-            return ("error", result)
-        
-        final_node = result['final_node']
-        model_code = final_node['node_id']
-        answer_code = result['answer_code']
-        
-        if (model_code ==answer_code) and final_node['level'] == 4:
-            return ("success", result)
-        else:
-            return ("data_error", result)
-
     # 并发处理
     max_workers = min(32, len(to_process))  # 设置最大线程数，可根据需要调整
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    if USE_PROCESS_POOL:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=attach_knowledge_base,
+                                       initargs=(publish_knowledge_base(Node_DIR, Rule_DIR),))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
         # 提交所有任务
         future_to_data = {executor.submit(process_and_save, data): data for data in to_process}
         
@@ -0,0 +1,100 @@
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+from text_ngrams import ngram_counts
+
+# 规则正文中出现的编码，如 "A16.2"、"B20"、"MO0"；规则倒排索引（retrieval&rerank_tools.ICDRuleManager）共用同一写法
+CODE_PATTERN = r"(?<![A-Za-z0-9])[A-Z][0-9O]{2}(?:\.[0-9Xx]{1,4})?[+*†]?"
+CODE_RE = re.compile(CODE_PATTERN)
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]")
+
+Rule = Union[str, Dict]
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 token 数：中文按 1 字 1 token，其余字符按 4 个 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def normalize_code(code: str) -> str:
+    """去空白与星剑号、转大写，类目数字位上误写的字母 O 按 0 处理（如 "MO0" -> "M00"）"""
+    code = re.sub(r"[\s+*†]", "", str(code)).upper()
+    return code[0] + code[1:3].replace("O", "0") + code[3:] if len(code) >= 3 else code
+
+
+# 规则正文在病人之间重复出现，其 n-gram 计数缓存复用（只读）；query（病历）每次不同，不进缓存
+char_ngrams = lru_cache(maxsize=16384)(ngram_counts)
+
+
+def rule_content(rule: Rule) -> str:
+    return rule.get("rule_content", "") if isinstance(rule, dict) else rule
+
+
+def rule_codes(rule: Rule) -> set:
+    """规则引用的编码：abstart_code（有则用）加上正文中出现的编码"""
+    codes = {normalize_code(code) for code in CODE_RE.findall(rule_content(rule))}
+    if isinstance(rule, dict):
+        codes.update(normalize_code(code) for code in rule.get("abstart_code", []) if CODE_RE.fullmatch(code))
+    return codes
+
+
+def _matches(codes: set, candidates: set) -> bool:
+    """规则编码与候选编码相同，或一方是另一方的前缀（类目规则适用于其下编码，反之亦然）"""
+    for code in codes:
+        for candidate in candidates:
+            if candidate.startswith(code) or code.startswith(candidate):
+                return True
+    return False
+
+
+def bm25_scores(query: str, docs: Sequence[str], n: int = 2, k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """
+    字符 n-gram BM25：以 docs 自身为语料统计 idf 与平均长度，query 中每个 n-gram 只计一次
+    （病历很长，重复出现的词不应线性放大得分）。
+    """
+    if not docs:
+        return []
+    grams = [char_ngrams(doc, n) for doc in docs]
+    lengths = [sum(g.values()) for g in grams]
+    avg_length = sum(lengths) / len(lengths) or 1.0
+    df = Counter()
+    for g in grams:
+        df.update(g.keys())
+    terms = [term for term in ngram_counts(query, n) if term in df]
+    total = len(docs)
+    idf = {term: math.log(1 + (total - df[term] + 0.5) / (df[term] + 0.5)) for term in terms}
+    scores = []
+    for g, length in zip(grams, lengths):
+        norm = k1 * (1 - b + b * length / avg_length)
+        scores.append(sum(idf[term] * g[term] * (k1 + 1) / (g[term] + norm) for term in terms if term in g))
+    return scores
+
+
+def select_rules(rules: Sequence[Rule], query: str, token_budget: Optional[int],
+                 candidates: Iterable[str] = (), n: int = 2) -> List[Rule]:
+    """
+    在 token_budget 内按与 query（病历摘要、候选名称等）的 BM25 相关度挑选规则，返回保持原顺序的子列表。
+    引用了任一候选编码（abstart_code 或正文中的编码）的规则始终保留，即使超出预算；
+    token_budget 为 None 时原样返回。
+    """
+    if token_budget is None or not rules:
+        return list(rules)
+    candidates = {normalize_code(code) for code in candidates if code}
+    contents = [rule_content(rule) for rule in rules]
+    costs = [estimate_tokens(text) for text in contents]
+    keep = set()
+    used = 0
+    for i, rule in enumerate(rules):
+        if candidates and _matches(rule_codes(rule), candidates):
+            keep.add(i)
+            used += costs[i]
+    scores = bm25_scores(query, contents, n)
+    for i in sorted(range(len(rules)), key=lambda i: (-scores[i], i)):
+        if i not in keep and used + costs[i] <= token_budget:
+            keep.add(i)
+            used += costs[i]
+    return [rule for i, rule in enumerate(rules) if i in keep]
@@ -0,0 +1,103 @@
+import re
+from typing import Dict, Optional
+
+# 章节 / 类目 / 亚目标签的统一规范化（agent、check、retrieval 三处各有一份相同的拷贝）
+#
+# 同一章节在不同文件中写法不同：
+#   node_index / rule_index:  "第十八章"
+#   merge_path / 向量库元数据: "第18章“症状、体征和临床与实验室异常所见，不可归类在他处者”"
+# 类目 / 亚目在元数据中为 "R16 肝大和脾大"，规则文件中为 "R16"。
+# KeyIndex 把各种写法统一到规则与码树使用的 key，并可由 key 取回元数据中的标签（检索过滤用）。
+
+CHAPTER_COUNT = 22
+_CN_DIGITS = "零一二三四五六七八九十"
+_CHAPTER_RE = re.compile(r"第\s*([0-9]+|[零一二三四五六七八九十]+)\s*章")
+
+
+def chinese_numeral(n: int) -> str:
+    """0-99 的中文数字（18 -> "十八"，20 -> "二十"）"""
+    if n <= 10:
+        return _CN_DIGITS[n]
+    if n < 20:
+        return "十" + _CN_DIGITS[n % 10]
+    tens, unit = divmod(n, 10)
+    return f"{_CN_DIGITS[tens]}十" + (_CN_DIGITS[unit] if unit else "")
+
+
+def chapter_key(n: int) -> str:
+    """第 n 章的 key（规则文件与 node_index 的写法）"""
+    return f"第{chinese_numeral(n)}章"
+
+
+class KeyIndex:
+    """
+    预计算的双向规范化表：标签（任意写法）-> key，key -> 元数据标签。
+
+    - 第 1-22 章的 "第n章" / "第X章" 写法在构造时登记，chapter_number 给出章序号（评测排序用）；
+    - from_trees 登记码树中全部章节 / 类目 / 亚目的 "编码 名称" 标签；
+    - 表中没有的标签按正则 / 空格切分推导一次后记入表中（至多 maxsize 条），热路径上只是一次 dict 查找。
+    """
+
+    def __init__(self, maxsize: int = 1 << 17):
+        self.maxsize = maxsize
+        self._keys: Dict[str, str] = {}
+        self._labels: Dict[str, str] = {}
+        self.chapter_numbers: Dict[str, int] = {}
+        for n in range(1, CHAPTER_COUNT + 1):
+            key = chapter_key(n)
+            self.chapter_numbers[key] = n
+            self._keys[key] = self._keys[f"第{n}章"] = key
+
+    @classmethod
+    def from_trees(cls, *trees) -> "KeyIndex":
+        """
+        由 ICDTree（码树 / merge_path 路径树）的 level 1-3 节点建表；None 跳过。
+        先传入的树优先作为 key -> 标签 的反查结果（检索过滤需传入 merge_path 路径树在前）。
+        """
+        index = cls()
+        for tree in trees:
+            if tree is None:
+                continue
+            for code, name, level in zip(tree.codes, tree.names, tree.levels):
+                if not 1 <= level <= 3:
+                    continue
+                key = index.key(code)
+                index.add(f"{code} {name}" if name else code, key)
+                index.add(code, key)
+        return index
+
+    def add(self, label: str, key: str):
+        self._keys[label] = key
+        self._labels.setdefault(key, label)
+
+    @staticmethod
+    def _derive(label: str) -> str:
+        """表中没有的标签：章节按 "第n章" 取章序号，其余取第一个空格前的编码"""
+        match = _CHAPTER_RE.match(label)
+        if match:
+            num = match.group(1)
+            if num.isdigit():
+                return chapter_key(int(num))
+            return f"第{num}章"
+        if label.startswith("第"):
+            return label.split("“")[0].strip()
+        return label.split(" ")[0].strip()
+
+    def key(self, label) -> str:
+        """"第18章“...”" -> "第十八章"，"R16 肝大和脾大" -> "R16"；空值返回 \"\""""
+        if not label:
+            return ""
+        key = self._keys.get(label)
+        if key is None:
+            key = self._derive(label)
+            if len(self._keys) < self.maxsize:
+                self._keys[label] = key
+        return key
+
+    def label(self, label) -> Optional[str]:
+        """任意写法 -> 元数据中的标签（如 "第十八章" -> "第18章“...”"，"R16" -> "R16 肝大和脾大"）；未登记时返回 None"""
+        return self._labels.get(self.key(label))
+
+    def chapter_number(self, label) -> Optional[int]:
+        """章节标签 -> 章序号（1-22）；非章节返回 None"""
+        return self.chapter_numbers.get(self.key(label))
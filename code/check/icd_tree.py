@@ -0,0 +1,1232 @@
+import bisect
+import contextvars
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import List, Dict, Optional
+
+from icd_keys import KeyIndex
+
+# ----------------------------
+# 配置路径（与 base_agent.py 保持一致）
+# ----------------------------
+Node_DIR = "../node_index"
+Rule_DIR = "../rule_index"
+
+NO_RULE_TEXT = '该编码下无特殊编码规则，请根据电子病历内容和ICD节点信息判断选择路径'
+
+# 预编译快照（见 build_snapshot / load_snapshot）
+SNAPSHOT_FILE = os.path.join(Node_DIR, "icd_kb.snapshot")
+ALL_PATH_FILE = os.path.join(Node_DIR, "merge_path.jsonl")
+NODE_FILES = ("level_1.jsonl", "level_2.jsonl", "level_3.jsonl")
+RULE_FILES = ("chapter_index.jsonl", "level_0.jsonl", "level_1.jsonl", "level_2.jsonl", "level_3.jsonl")
+
+ROOT_ID = 0
+
+# flags 位：该节点能否以对应 level 调用 get_child_node（即是否为对应 node_index 文件中的 key）
+QUERY_L1 = 1 << 1
+QUERY_L2 = 1 << 2
+QUERY_L3 = 1 << 3
+
+# 祖先索引：每个编码保存定宽的祖先 id 元组（自顶向下：章、类目、亚目、编码），不足处补 NO_ANCESTOR。
+# 槽位按路径深度排列，与 get_path(code)[1:] 一一对应（类目下直接挂编码时，编码位于第 3 个槽位）。
+PATH_WIDTH = 4
+NO_ANCESTOR = -1
+UNKNOWN_ID = -2
+
+
+def _iter_jsonl(file_path: str):
+    """逐行读取 jsonl；文件不存在时与 load_jsonl 一样只打印警告"""
+    if not os.path.exists(file_path):
+        print(f"⚠️ 警告：{file_path} 不存在，返回空列表")
+        return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _read_rows(data_dir: str, file_names) -> Dict[str, list]:
+    """一次读入目录下的若干 jsonl：{文件名: [行]}"""
+    return {name: list(_iter_jsonl(os.path.join(data_dir, name))) for name in file_names}
+
+
+def format_chapter(chapter_data):
+    """将单个章节的 JSON 对象转换为指定格式的字符串"""
+    chapter_name = chapter_data["chapter"]
+    sub_codes = chapter_data["sub_codes"]
+    lines = [f"{chapter_name}包含"]
+    for item in sub_codes:
+        code_range = item["节范围"]
+        name = item["节名称"]
+        lines.append(f"{code_range}，{name}")
+    return "\n".join(lines)
+
+
+def split_code_name(s):
+    """
+    辅助工具：将 "B26.2+ 流行性腮腺炎性脑炎" 切割为 "B26.2+" 和 "流行性腮腺炎性脑炎"
+    """
+    if not s or not isinstance(s, str):
+        return None, None
+    parts = s.split(' ', 1)
+    if len(parts) < 2:
+        return s.strip(), ""
+    return parts[0].strip(), parts[1].strip()
+
+
+class ICDTree:
+    """
+    ICD 编码树的紧凑内存表示。
+
+    - 每个编码对应一个整数 node id（0 为根节点），code / name 字符串全部 intern；
+    - levels / parents / flags 为定长数组，路径由父指针按需回溯，不再为每个编码保存整条路径；
+    - 子节点为 CSR 邻接表（child_start / child_count 指向 edge_child / edge_name）。
+      同一编码可能出现在多个父节点的子列表中（如 M00.0 同时挂在 M00 与 MO0 下），
+      因此不用 first-child / next-sibling 链表，子节点名称以各自列表为准；
+    - 规则正文去重后存入 rule_text，各层级通过 rule_start / rule_count 指向 rule_refs；
+    - ancestors 为每个节点 PATH_WIDTH 个祖先 id 的定宽数组，路径比较只需比较整数。
+
+    get_child_node / get_coding_rule 的返回结构与原先逐次读文件的工具函数完全一致。
+    """
+
+    def __init__(self, node_dir: str = Node_DIR, rule_dir: str = Rule_DIR):
+        self.node_dir = node_dir
+        self.rule_dir = rule_dir
+        self._init_storage()
+        self._load_nodes(_read_rows(node_dir, NODE_FILES))
+        self._load_rules(_read_rows(rule_dir, RULE_FILES))
+        self._freeze()
+
+    @classmethod
+    def from_rows(cls, node_rows: Dict[str, list], rule_rows: Dict[str, list]) -> "ICDTree":
+        """由已读入的 node_index / rule_index 行构建（按章分片时每个分片只传入本章的行）"""
+        tree = cls.__new__(cls)
+        tree.node_dir = tree.rule_dir = None
+        tree._init_storage()
+        tree._load_nodes(node_rows)
+        tree._load_rules(rule_rows)
+        tree._freeze()
+        return tree
+
+    @classmethod
+    def from_merge_path(cls, jsonl_path: str) -> "ICDTree":
+        """由 merge_path.jsonl（向量库码表，含 first/second/third_chapter）构建路径索引"""
+        tree = cls.__new__(cls)
+        tree.node_dir = os.path.dirname(jsonl_path)
+        tree.rule_dir = None
+        tree._init_storage()
+        tree._load_merge_path(jsonl_path)
+        tree._freeze()
+        return tree
+
+    @classmethod
+    def empty(cls) -> "ICDTree":
+        """仅含根节点的空树（码表缺失时的占位）"""
+        tree = cls.__new__(cls)
+        tree.node_dir = tree.rule_dir = None
+        tree._init_storage()
+        tree._freeze()
+        return tree
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "ICDSnapshot", prefix: str) -> "ICDTree":
+        """直接以 mmap 快照中的数组为存储（只读），字符串按需解码"""
+        tree = cls.__new__(cls)
+        tree.node_dir = tree.rule_dir = None
+        section = lambda name: snapshot.section(prefix + name)
+        column = lambda name: _StringColumn(snapshot.strings, section(name))
+        tree.codes = column("codes")
+        tree.names = column("names")
+        tree.levels = section("levels")
+        tree.parents = section("parents")
+        tree.flags = section("flags")
+        tree.child_start = section("child_start")
+        tree.child_count = section("child_count")
+        tree.edge_child = section("edge_child")
+        tree.edge_name = column("edge_name")
+        tree.root_rules = tuple(column("root_rules"))
+        tree.rule_text = column("rule_text")
+        tree.rule_refs = section("rule_refs")
+        tree.rule_start = {level: section(f"rule_start{level}") for level in (1, 2, 3)}
+        tree.rule_count = {level: section(f"rule_count{level}") for level in (1, 2, 3)}
+        tree.ancestors = section("ancestors")
+        tree._index = _SortedCodeIndex(tree.codes, section("order"))
+        return tree
+
+    def _dump(self, prefix: str, strings: "_StringTableBuilder", sections: Dict[str, array]):
+        """将树写入快照 sections（字符串换成字符串表 id）"""
+        sids = lambda values: array('i', map(strings.add, values))
+        sections[prefix + "codes"] = sids(self.codes)
+        sections[prefix + "names"] = sids(self.names)
+        sections[prefix + "levels"] = array('b', self.levels)
+        sections[prefix + "parents"] = array('i', self.parents)
+        sections[prefix + "flags"] = array('B', self.flags)
+        sections[prefix + "child_start"] = array('i', self.child_start)
+        sections[prefix + "child_count"] = array('i', self.child_count)
+        sections[prefix + "edge_child"] = array('i', self.edge_child)
+        sections[prefix + "edge_name"] = sids(self.edge_name)
+        sections[prefix + "root_rules"] = sids(self.root_rules)
+        sections[prefix + "rule_text"] = sids(self.rule_text)
+        sections[prefix + "rule_refs"] = array('i', self.rule_refs)
+        for level in (1, 2, 3):
+            sections[prefix + f"rule_start{level}"] = array('i', self.rule_start[level])
+            sections[prefix + f"rule_count{level}"] = array('i', self.rule_count[level])
+        sections[prefix + "ancestors"] = array('i', self.ancestors)
+        # 按编码排序的 node id，加载后以二分代替 dict 查找
+        sections[prefix + "order"] = array('i', sorted(range(len(self.codes)), key=self.codes.__getitem__))
+
+    # ---------- 存储 ----------
+    def _init_storage(self):
+        self._index: Dict[str, int] = {}
+        self.codes: List[str] = []
+        self.names: List[str] = []
+        self.levels = array('b')
+        self.parents = array('i')
+        self.flags = array('B')
+        # 构建期：parent id -> [(child id, 列表中的名称)]，_freeze 时压平为 CSR
+        self._pending_edges: Dict[int, list] = {}
+        self.child_start = array('i')
+        self.child_count = array('i')
+        self.edge_child = array('i')
+        self.edge_name: List[str] = []
+        # 规则
+        self.root_rules: tuple = ()
+        self.rule_text: List[str] = []
+        self.rule_refs = array('i')
+        self.rule_start = {level: array('i') for level in (1, 2, 3)}
+        self.rule_count = {level: array('i') for level in (1, 2, 3)}
+        self.ancestors = array('i')
+        self._rule_text_id: Dict[str, int] = {}
+        self._pending_rules: Dict[int, Dict[int, list]] = {1: {}, 2: {}, 3: {}}
+
+        self._add_node("root", "根节点", 0, -1)
+
+    def _add_node(self, code, name, level, parent) -> int:
+        """获取或新建节点；已存在时只补全缺失的父指针"""
+        node = self._index.get(code)
+        if node is not None:
+            if self.parents[node] == -1 and parent != -1:
+                self.parents[node] = parent
+            return node
+        node = len(self.codes)
+        code = sys.intern(code)
+        self._index[code] = node
+        self.codes.append(code)
+        self.names.append(sys.intern(name))
+        self.levels.append(level)
+        self.parents.append(parent)
+        self.flags.append(0)
+        return node
+
+    def _add_children(self, parent, kids, level, query_flag=0):
+        edges = self._pending_edges.setdefault(parent, [])
+        for item in kids:
+            child = self._add_node(item["code"], item["name"], level, parent)
+            edges.append((child, sys.intern(item["name"])))
+        self.flags[parent] |= query_flag
+
+    def _freeze(self):
+        """将构建期的子节点列表、规则列表压平为定长数组"""
+        n = len(self.codes)
+        self.child_start = array('i', [0]) * n
+        self.child_count = array('i', [0]) * n
+        for parent in range(n):
+            edges = self._pending_edges.get(parent)
+            if not edges:
+                continue
+            self.child_start[parent] = len(self.edge_child)
+            self.child_count[parent] = len(edges)
+            for child, name in edges:
+                self.edge_child.append(child)
+                self.edge_name.append(name)
+        self._pending_edges = {}
+
+        for level in (1, 2, 3):
+            starts = self.rule_start[level] = array('i', [0]) * n
+            counts = self.rule_count[level] = array('i', [-1]) * n
+            for node, refs in self._pending_rules[level].items():
+                starts[node] = len(self.rule_refs)
+                counts[node] = len(refs)
+                self.rule_refs.extend(refs)
+        self._pending_rules = {1: {}, 2: {}, 3: {}}
+        self._rule_text_id = {}
+
+        self.ancestors = array('i', [NO_ANCESTOR]) * (PATH_WIDTH * n)
+        for node in range(1, n):
+            chain = []
+            parent = node
+            while parent > ROOT_ID:
+                chain.append(parent)
+                parent = self.parents[parent]
+            chain.reverse()
+            base = node * PATH_WIDTH
+            for depth, ancestor in enumerate(chain[:PATH_WIDTH]):
+                self.ancestors[base + depth] = ancestor
+
+    # ---------- 加载 ----------
+    def _load_nodes(self, node_rows: Dict[str, list]):
+        chapters = node_rows["level_1.jsonl"]
+        categories = node_rows["level_2.jsonl"]
+        subcategories = {item["de_chapter"]: item for item in node_rows["level_3.jsonl"]}
+
+        self._add_children(ROOT_ID, [{"code": item["chapter"], "name": item["name"]} for item in chapters], 1)
+        for item in chapters:
+            node = self._add_node(item["chapter"], item["name"], 1, ROOT_ID)
+            self._add_children(node, item["sub_code"], 2, QUERY_L1)
+        for item in categories:
+            node = self._add_node(item["sub_chapter"], item["name"], 2, -1)
+            if item["sub_code"]:
+                self._add_children(node, item["sub_code"], 3, QUERY_L2)
+            elif item["sub_chapter"] in subcategories:
+                # 类目下没有亚目时，直接挂最终编码
+                leaf_parent = subcategories.pop(item["sub_chapter"])
+                self._add_children(node, leaf_parent["sub_code"], 4, QUERY_L2 | QUERY_L3)
+        for key, item in subcategories.items():
+            node = self._add_node(key, item["name"], 3, -1)
+            self._add_children(node, item["sub_code"], 4, QUERY_L3)
+
+    def _load_merge_path(self, jsonl_path):
+        seen_edges = set()
+        with open(jsonl_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                parent = ROOT_ID
+                for level, field in ((1, "first_chapter"), (2, "second_chapter"), (3, "third_chapter"), (4, None)):
+                    if field is None:
+                        code, name = entry.get("code"), entry.get("name")
+                    else:
+                        code, name = split_code_name(entry.get(field, ""))
+                    if not code:
+                        if level == 1:
+                            break
+                        continue
+                    node = self._add_node(code, name or "", level, parent)
+                    # 与旧的 build_full_hierarchy_index 一致：同一编码以最后出现的行为准
+                    self.names[node] = sys.intern(name or "")
+                    self.levels[node] = level
+                    self.parents[node] = parent
+                    if (parent, node) not in seen_edges:
+                        seen_edges.add((parent, node))
+                        self._pending_edges.setdefault(parent, []).append((node, self.names[node]))
+                        self.flags[parent] |= 1 << self.levels[parent]
+                    parent = node
+
+    def _load_rules(self, rule_rows: Dict[str, list]):
+        root_rules = [format_chapter(item) for item in rule_rows["chapter_index.jsonl"]]
+        root_rules += [item['rule_content'] for item in rule_rows["level_0.jsonl"]]
+        self.root_rules = tuple(root_rules)
+
+        specs = (
+            (1, "level_1.jsonl", "chapter", "chapter_rules"),
+            (2, "level_2.jsonl", "sub_chapter", "category_rules"),
+            (3, "level_3.jsonl", "de_chapter", "subcategory_rules"),
+        )
+        for level, file_name, key_field, rule_field in specs:
+            for item in rule_rows[file_name]:
+                node = self._add_node(item[key_field], item.get("name", ""), level, -1)
+                self._pending_rules[level][node] = [self._rule_id(r['rule_content']) for r in item[rule_field]]
+
+    def _rule_id(self, content):
+        rid = self._rule_text_id.get(content)
+        if rid is None:
+            rid = self._rule_text_id[content] = len(self.rule_text)
+            self.rule_text.append(sys.intern(content))
+        return rid
+
+    # ---------- 查询 ----------
+    def __len__(self):
+        """编码节点数（不含根节点）"""
+        return len(self.codes) - 1
+
+    def __contains__(self, code):
+        return code != "root" and code in self._index
+
+    def node_id(self, code) -> Optional[int]:
+        return self._index.get(code)
+
+    def get_node(self, code) -> Optional[Dict]:
+        """编码对应的节点 {'node_id','name','level'}，未知编码返回 None"""
+        node = self._index.get(code)
+        if node is None or node == ROOT_ID:
+            return None
+        return {'node_id': self.codes[node], "name": self.names[node], "level": self.levels[node]}
+
+    def get_child_node(self, node_id, level):
+        """返回【int，list】0表示节点错误 1表示正常 -1表示层级错误"""
+        if level == 0:
+            node = ROOT_ID
+        elif level in (1, 2, 3):
+            node = self._index.get(node_id)
+            if node is None or not self.flags[node] & (1 << level):
+                return 0, None
+        else:
+            return -1, None
+        start = self.child_start[node]
+        codes, levels, edge_child, edge_name = self.codes, self.levels, self.edge_child, self.edge_name
+        return 1, [{'node_id': codes[edge_child[e]], "name": edge_name[e], "level": levels[edge_child[e]]}
+                   for e in range(start, start + self.child_count[node])]
+
+    def get_coding_rule(self, node_id, level):
+        """返回【int，list】0表示该层级规则文件中无此节点，1表示正常"""
+        if level == 0:
+            node_rule_list = list(self.root_rules)
+        elif level in (1, 2, 3):
+            node = self._index.get(node_id)
+            count = -1 if node is None else self.rule_count[level][node]
+            if count < 0:
+                return 0, None
+            start = self.rule_start[level][node]
+            node_rule_list = [self.rule_text[self.rule_refs[i]] for i in range(start, start + count)]
+        else:
+            node_rule_list = []
+        if not node_rule_list:
+            node_rule_list.append(NO_RULE_TEXT)
+        return 1, node_rule_list
+
+    def get_parent(self, node_id) -> Optional[Dict]:
+        """返回父节点 {'node_id','name','level'}，根节点或未知节点返回 None"""
+        node = self._index.get(node_id)
+        if node is None or self.parents[node] < 0:
+            return None
+        parent = self.parents[node]
+        return {'node_id': self.codes[parent], "name": self.names[parent], "level": self.levels[parent]}
+
+    def ancestor_ids(self, code) -> Optional[tuple]:
+        """编码的定宽祖先 id 元组（不含根节点，含编码自身），未知编码返回 None"""
+        node = self._index.get(code)
+        if node is None or node == ROOT_ID:
+            return None
+        base = node * PATH_WIDTH
+        return tuple(self.ancestors[base:base + PATH_WIDTH])
+
+    def path_ids(self, path: List[Dict]) -> tuple:
+        """
+        外部给出的路径（如样本中的 answer_path，不含根节点）转换为与 ancestor_ids 同构的定宽元组，
+        不在树中的编码记为 UNKNOWN_ID，不会与任何节点相等。
+        """
+        ids = [self._index.get(item.get('node_id'), UNKNOWN_ID) for item in path[:PATH_WIDTH]]
+        return tuple(ids) + (NO_ANCESTOR,) * (PATH_WIDTH - len(ids))
+
+    @staticmethod
+    def agreement_depth(a: tuple, b: tuple) -> int:
+        """两条定宽路径自顶向下连续一致的深度（宽度固定，常数时间）"""
+        depth = 0
+        while depth < PATH_WIDTH and a[depth] >= 0 and a[depth] == b[depth]:
+            depth += 1
+        return depth
+
+    def common_depth(self, code_a, code_b) -> int:
+        """两个编码在树中共同祖先的深度：0 表示章节即不同，PATH_WIDTH 表示路径完全一致"""
+        a, b = self.ancestor_ids(code_a), self.ancestor_ids(code_b)
+        if a is None or b is None:
+            return 0
+        return self.agreement_depth(a, b)
+
+    def get_path(self, code) -> Optional[List[Dict]]:
+        """
+        由父指针回溯出 Root -> L1 -> L2 -> (L3) -> L4 路径，格式与旧的 build_full_hierarchy_index 相同。
+        未知编码返回 None。
+        """
+        node = self._index.get(code)
+        if node is None or node == ROOT_ID:
+            return None
+        path = []
+        while node > ROOT_ID:
+            path.append({"node_id": self.codes[node], "name": self.names[node], "level": self.levels[node]})
+            node = self.parents[node]
+        path.append({"level": 0, "node_id": "root", "name": "根节点"})
+        path.reverse()
+        return path
+
+
+# ----------------------------
+# 编码区间索引（chapter_index 中的节范围）
+# ----------------------------
+_CATEGORY_KEY = re.compile(r"([A-Z])([0-9O]{2})")
+
+
+def normalize_code(code) -> str:
+    """统一编码写法：去空白、全角点号、星剑号等标记，转大写（如 'b26.2+ ' -> 'B26.2'）"""
+    if not isinstance(code, str):
+        return ""
+    code = code.strip().upper().replace("．", ".").replace("。", ".")
+    return re.sub(r"[\s+*†]", "", code)
+
+
+def category_key(code) -> Optional[str]:
+    """编码的三位类目键，数字位上误写的字母 O 按 0 处理（如码表中的 'MO0'）；无法识别时返回 None"""
+    match = _CATEGORY_KEY.match(normalize_code(code))
+    if match is None:
+        return None
+    return match.group(1) + match.group(2).replace("O", "0")
+
+
+class CodeRangeIndex:
+    """
+    chapter_index.jsonl 中各章 "节范围"（如 "A00-A09"）的有序区间索引。
+
+    resolve(code) 对任意编码字符串（包括码表中不存在、模型编造的编码）二分定位所属章、节，
+    并在给定的 ICDTree 中查找其类目、亚目节点，O(log n)。
+    """
+
+    def __init__(self, chapter_index_file: str = os.path.join(Rule_DIR, "chapter_index.jsonl"),
+                 tree: Optional["ICDTree"] = None):
+        self.tree = tree
+        intervals = []
+        for item in _iter_jsonl(chapter_index_file):
+            for section in item["sub_codes"]:
+                start, _, end = section["节范围"].partition("-")
+                start, end = category_key(start), category_key(end or start)
+                if start and end:
+                    intervals.append((start, end, item["chapter"], section["节范围"], section["节名称"]))
+        intervals.sort()
+        self.starts = [interval[0] for interval in intervals]
+        self.intervals = intervals
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _node(self, level, code, *aliases) -> Optional[Dict]:
+        """按 level 在树中查找编码，依次尝试原写法、别名及带星剑号的写法（如 'A17+'）"""
+        if self.tree is None:
+            return None
+        for candidate in (code, *aliases, code + "+", code + "*"):
+            node = self.tree.get_node(candidate)
+            if node is not None and node["level"] == level:
+                return node
+        return None
+
+    def resolve(self, code) -> Optional[Dict]:
+        """
+        返回 {"code", "chapter", "section", "section_name", "category", "subcategory"}，
+        category / subcategory 为树中的节点 {'node_id','name','level'}（树中不存在时为 None）；
+        编码格式无法识别或不落在任何节范围内时返回 None。
+        """
+        key = category_key(code)
+        if key is None:
+            return None
+        pos = bisect.bisect_right(self.starts, key) - 1
+        if pos < 0 or key > self.intervals[pos][1]:
+            return None
+        _, _, chapter, section, section_name = self.intervals[pos]
+        normalized = normalize_code(code)
+        category = self._node(2, key, normalized[:3])
+        subcategory = None
+        if len(normalized) >= 5 and normalized[3] == ".":
+            subcategory = self._node(3, key + normalized[3:5], normalized[:5])
+        return {"code": code, "chapter": chapter, "section": section, "section_name": section_name,
+                "category": category, "subcategory": subcategory}
+
+    def chapter_of(self, code) -> Optional[str]:
+        """编码所属章（如 "第一章"），无法定位时返回 None"""
+        key = category_key(code)
+        if key is None:
+            return None
+        pos = bisect.bisect_right(self.starts, key) - 1
+        if pos < 0 or key > self.intervals[pos][1]:
+            return None
+        return self.intervals[pos][2]
+
+
+# ----------------------------
+# 预编译二进制快照
+# ----------------------------
+# 文件布局（本机字节序）：
+#   header : magic(8) | version(u32) | byteorder(u32) | toc_offset(u64) | toc_length(u64)
+#   body   : 各 section 依次排列（8 字节对齐），均为定长数组
+#   toc    : JSON，记录 section 名 -> [typecode, offset, 元素个数]，以及源文件 stat / checksum
+# section 前缀 "n." 为 node_index + rule_index 构成的树，"m." 为 merge_path.jsonl 构成的路径树，
+# "s.blob" / "s.offsets" 为去重后的 UTF-8 字符串表；按章分片时根分片另有 "r." 路由表（见 build_shards）。
+SNAPSHOT_MAGIC = b"ICDSNAP\0"
+SNAPSHOT_VERSION = 2
+_HEADER = struct.Struct("<8sIIQQ")
+_BYTEORDER = {"little": 1, "big": 2}[sys.byteorder]
+
+
+class _StringTableBuilder:
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self.blob = bytearray()
+        self.offsets = array('I', [0])
+
+    def add(self, text: str) -> int:
+        sid = self._ids.get(text)
+        if sid is None:
+            sid = self._ids[text] = len(self.offsets) - 1
+            self.blob += text.encode("utf-8")
+            self.offsets.append(len(self.blob))
+        return sid
+
+
+class _StringTable:
+    """mmap 上的只读字符串表，按 id 解码，最近使用的解码结果缓存在本进程"""
+
+    def __init__(self, blob: memoryview, offsets: memoryview, cache_size: int = 65536):
+        self._blob = blob
+        self._offsets = offsets
+        self._decode = lru_cache(maxsize=cache_size)(self._decode_raw)
+
+    def _decode_raw(self, sid: int) -> str:
+        return str(self._blob[self._offsets[sid]:self._offsets[sid + 1]], "utf-8")
+
+    def __getitem__(self, sid: int) -> str:
+        return self._decode(sid)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+class _StringColumn:
+    """字符串 id 数组 -> 只读字符串序列（行为同 list[str]）"""
+
+    def __init__(self, strings: _StringTable, sids: memoryview):
+        self._strings = strings
+        self._sids = sids
+
+    def __getitem__(self, i: int) -> str:
+        return self._strings[self._sids[i]]
+
+    def __len__(self):
+        return len(self._sids)
+
+    def __iter__(self):
+        strings = self._strings
+        return (strings[sid] for sid in self._sids)
+
+
+class _SortedCodeIndex:
+    """以按编码排序的 node id 数组二分查找，代替 dict[str, int]（不在本进程堆上建索引）"""
+
+    def __init__(self, codes: _StringColumn, order: memoryview):
+        self._codes = codes
+        self._order = order
+
+    def get(self, code, default=None):
+        if not isinstance(code, str):
+            return default
+        codes, order = self._codes, self._order
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if codes[order[mid]] < code:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and codes[order[lo]] == code:
+            return order[lo]
+        return default
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+
+def _source_files(node_dir: Optional[str], rule_dir: Optional[str], merge_path: Optional[str]):
+    """快照依赖的源文件：[(key, path)]，key 与目录无关，便于快照整体迁移"""
+    files = []
+    if node_dir:
+        files += [(f"node/{name}", os.path.join(node_dir, name)) for name in NODE_FILES]
+    if rule_dir:
+        files += [(f"rule/{name}", os.path.join(rule_dir, name)) for name in RULE_FILES]
+    if merge_path:
+        files.append(("merge/" + os.path.basename(merge_path), merge_path))
+    return files
+
+
+def _source_stats(files) -> Dict[str, Optional[list]]:
+    stats = {}
+    for key, path in files:
+        try:
+            st = os.stat(path)
+            stats[key] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stats[key] = None
+    return stats
+
+
+def _source_checksum(files) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    for key, path in files:
+        digest.update(key.encode("utf-8") + b"\0")
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            digest.update(b"\1")
+        except OSError:
+            digest.update(b"<missing>\0")
+    return digest.hexdigest()
+
+
+def build_snapshot(snapshot_path: str = SNAPSHOT_FILE, node_dir: Optional[str] = Node_DIR,
+                   rule_dir: Optional[str] = Rule_DIR, merge_path: Optional[str] = ALL_PATH_FILE) -> str:
+    """
+    将 node_index / rule_index（及 merge_path.jsonl，存在时）编译为一个二进制快照。
+    先写临时文件再 os.replace，多进程同时重建也不会读到半个文件。返回快照路径。
+    """
+    files = _source_files(node_dir, rule_dir, merge_path)
+    trees = {}
+    if node_dir and rule_dir:
+        trees["n."] = ICDTree(node_dir, rule_dir)
+    if merge_path and os.path.exists(merge_path):
+        trees["m."] = ICDTree.from_merge_path(merge_path)
+    return _write_snapshot(snapshot_path, trees, _source_stats(files), _source_checksum(files))
+
+
+def _write_snapshot(snapshot_path: str, trees: Dict[str, ICDTree], sources, checksum,
+                    router: Optional[Dict[str, int]] = None, shards=()) -> str:
+    """写出快照文件（先写临时文件再 os.replace）；router 为 编码 -> 分片序号，仅根分片使用"""
+    strings = _StringTableBuilder()
+    sections: Dict[str, array] = {}
+    for prefix, tree in trees.items():
+        tree._dump(prefix, strings, sections)
+    if router is not None:
+        codes = sorted(router)
+        sections["r.codes"] = array('i', map(strings.add, codes))
+        sections["r.shards"] = array('h', (router[code] for code in codes))
+    sections["s.offsets"] = strings.offsets
+    sections["s.blob"] = array('B', strings.blob)
+
+    toc = {"sections": {}, "trees": sorted(trees), "shards": list(shards),
+           "sources": sources, "checksum": checksum}
+    tmp_path = f"{snapshot_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * _HEADER.size)
+        for name, values in sections.items():
+            f.write(b"\0" * (-f.tell() % 8))
+            toc["sections"][name] = [values.typecode, f.tell(), len(values)]
+            values.tofile(f)
+        toc_bytes = json.dumps(toc, ensure_ascii=False).encode("utf-8")
+        toc_offset = f.tell()
+        f.write(toc_bytes)
+        f.seek(0)
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, _BYTEORDER, toc_offset, len(toc_bytes)))
+    os.replace(tmp_path, snapshot_path)
+    return snapshot_path
+
+
+class ICDSnapshot:
+    """
+    只读 mmap 打开的快照。多个进程打开同一文件时共享页缓存，数组不拷贝到进程堆。
+    tree 为 node_index + rule_index 的 ICDTree，code_tree 为 merge_path 路径树（未编入时为 None）。
+    """
+
+    def __init__(self, snapshot_path: str):
+        self.path = snapshot_path
+        with open(snapshot_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        if len(self._buffer) < _HEADER.size:
+            raise ValueError(f"快照文件损坏: {snapshot_path}")
+        magic, version, byteorder, toc_offset, toc_length = _HEADER.unpack_from(self._buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or byteorder != _BYTEORDER:
+            raise ValueError(f"快照版本不匹配: {snapshot_path}")
+        toc = json.loads(bytes(self._buffer[toc_offset:toc_offset + toc_length]))
+        self._sections = toc["sections"]
+        self.sources = toc["sources"]
+        self.checksum = toc["checksum"]
+        self.shards = toc.get("shards", [])
+        self.strings = _StringTable(self.section("s.blob"), self.section("s.offsets"))
+        self.tree = ICDTree.from_snapshot(self, "n.") if "n." in toc["trees"] else None
+        self.code_tree = ICDTree.from_snapshot(self, "m.") if "m." in toc["trees"] else None
+        self._keys = None
+
+    @property
+    def version(self) -> str:
+        """知识库版本号（源文件内容 checksum 前缀），写入输出记录以便复现"""
+        return self.checksum[:12]
+
+    @property
+    def keys(self) -> KeyIndex:
+        """本版本码表的 章节 / 类目 / 亚目 标签规范化表（首次访问时由码树建立，随快照一起热更新）"""
+        if self._keys is None:
+            self._keys = KeyIndex.from_trees(self.code_tree, self.tree)
+        return self._keys
+
+    def has_section(self, name: str) -> bool:
+        return name in self._sections
+
+    def section(self, name: str) -> memoryview:
+        typecode, offset, count = self._sections[name]
+        size = array(typecode).itemsize
+        return self._buffer[offset:offset + size * count].cast(typecode)
+
+    def is_fresh(self, files) -> bool:
+        """源文件 stat 未变直接视为最新；stat 变了再比较内容 checksum（仅 touch 不会触发重建）"""
+        if _source_stats(files) == self.sources:
+            return True
+        return _source_checksum(files) == self.checksum
+
+
+def load_snapshot(snapshot_path: str = SNAPSHOT_FILE, node_dir: Optional[str] = Node_DIR,
+                  rule_dir: Optional[str] = Rule_DIR, merge_path: Optional[str] = ALL_PATH_FILE) -> ICDSnapshot:
+    """打开快照；不存在、版本不符或与源 jsonl 的 checksum 不一致时自动重新编译"""
+    files = _source_files(node_dir, rule_dir, merge_path)
+    if os.path.exists(snapshot_path):
+        try:
+            snapshot = ICDSnapshot(snapshot_path)
+            if set(snapshot.sources) == {key for key, _ in files} and snapshot.is_fresh(files):
+                return snapshot
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ 快照不可用（{e}），重新编译")
+    print(f"🔄 编译 ICD 知识库快照: {snapshot_path}")
+    build_snapshot(snapshot_path, node_dir, rule_dir, merge_path)
+    return ICDSnapshot(snapshot_path)
+
+
+# ----------------------------
+# 按章分片的快照
+# ----------------------------
+# 一次会话通常只展开一两个章，而整库快照 / jsonl 需要整体加载 level_3（最大的节点文件）。
+# 分片目录布局：
+#   <shard_root>/CURRENT                 当前版本目录名（os.replace 原子切换）
+#   <shard_root>/<版本>/root.snapshot    根节点、各章及其类目列表、level_0/1 规则，以及 编码 -> 分片 的路由表
+#   <shard_root>/<版本>/chNN.snapshot    第 NN 章的类目、亚目节点与 level_2/3 规则，首次访问该章时才 mmap
+#   <shard_root>/<版本>/merge.snapshot   merge_path 路径树（code_tree），首次访问时才 mmap
+SHARD_DIR = os.path.join(Node_DIR, "icd_kb.shards")
+SHARD_BY_CHAPTER = True
+ROOT_SHARD = "root"
+MERGE_SHARD = "merge"
+
+
+def _partition_rows(node_rows: Dict[str, list], rule_rows: Dict[str, list]):
+    """
+    将 node_index / rule_index 的行按章切分，返回 (分片名列表, {分片名: (node_rows, rule_rows)}, 编码 -> 分片序号)。
+    类目按 level_1 的子列表归章，亚目按 level_2 的子列表归到类目所在章；无法归章的行留在根分片（序号 0）。
+    """
+    chapters = node_rows["level_1.jsonl"]
+    names = [ROOT_SHARD] + [f"ch{i:02d}" for i in range(1, len(chapters) + 1)]
+    owner: Dict[str, int] = {}
+    for shard, item in enumerate(chapters, 1):
+        for kid in item["sub_code"]:
+            owner.setdefault(kid["code"], shard)
+    for item in node_rows["level_2.jsonl"]:
+        shard = owner.get(item["sub_chapter"])
+        if shard is not None:
+            for kid in item["sub_code"]:
+                owner.setdefault(kid["code"], shard)
+
+    def split(rows, key_field):
+        parts = [[] for _ in names]
+        for item in rows:
+            parts[owner.get(item[key_field], 0)].append(item)
+        return parts
+
+    categories = split(node_rows["level_2.jsonl"], "sub_chapter")
+    subcategories = split(node_rows["level_3.jsonl"], "de_chapter")
+    category_rules = split(rule_rows["level_2.jsonl"], "sub_chapter")
+    subcategory_rules = split(rule_rows["level_3.jsonl"], "de_chapter")
+    parts = {}
+    for shard, name in enumerate(names):
+        root = shard == 0
+        # 章分片也带上本章这一行，类目节点因此有父指针，get_path 在分片内即可回溯到根
+        parts[name] = (
+            {"level_1.jsonl": chapters if root else [chapters[shard - 1]],
+             "level_2.jsonl": categories[shard],
+             "level_3.jsonl": subcategories[shard]},
+            {"chapter_index.jsonl": rule_rows["chapter_index.jsonl"] if root else [],
+             "level_0.jsonl": rule_rows["level_0.jsonl"] if root else [],
+             "level_1.jsonl": rule_rows["level_1.jsonl"] if root else [],
+             "level_2.jsonl": category_rules[shard],
+             "level_3.jsonl": subcategory_rules[shard]},
+        )
+    return names, parts, owner
+
+
+def build_shards(shard_root: str = SHARD_DIR, node_dir: str = Node_DIR, rule_dir: str = Rule_DIR,
+                 merge_path: Optional[str] = ALL_PATH_FILE) -> str:
+    """
+    将知识库按章编译为分片快照，写入 shard_root/<版本>/ 后再原子更新 CURRENT，返回版本目录。
+    旧版本目录保留（可能仍有会话固定在旧版本上、尚未打开其中的分片），需要时手动清理。
+    """
+    files = _source_files(node_dir, rule_dir, merge_path)
+    sources, checksum = _source_stats(files), _source_checksum(files)
+    node_rows, rule_rows = _read_rows(node_dir, NODE_FILES), _read_rows(rule_dir, RULE_FILES)
+    names, parts, owner = _partition_rows(node_rows, rule_rows)
+    trees = {name: ICDTree.from_rows(*parts[name]) for name in names}
+
+    # 路由表：带行的 level 2/3 键按其行所在分片，其余类目及以下编码按所在章分片（供 get_path / get_node）
+    router: Dict[str, int] = {}
+    for rows, key_field in ((node_rows["level_2.jsonl"], "sub_chapter"), (node_rows["level_3.jsonl"], "de_chapter"),
+                            (rule_rows["level_2.jsonl"], "sub_chapter"), (rule_rows["level_3.jsonl"], "de_chapter")):
+        for item in rows:
+            router.setdefault(item[key_field], owner.get(item[key_field], 0))
+    for shard, name in enumerate(names[1:], 1):
+        tree = trees[name]
+        for node in range(1, len(tree.codes)):
+            if tree.levels[node] >= 2:
+                router.setdefault(tree.codes[node], shard)
+
+    os.makedirs(shard_root, exist_ok=True)
+    version_dir = os.path.join(shard_root, f"v{SNAPSHOT_VERSION}-{checksum[:12]}")
+    tmp_dir = f"{version_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name in names:
+        root = name == ROOT_SHARD
+        _write_snapshot(os.path.join(tmp_dir, name + ".snapshot"), {"n.": trees[name]}, sources, checksum,
+                        router if root else None, names if root else ())
+    if merge_path and os.path.exists(merge_path):
+        _write_snapshot(os.path.join(tmp_dir, MERGE_SHARD + ".snapshot"),
+                        {"m.": ICDTree.from_merge_path(merge_path)}, sources, checksum)
+    try:
+        os.rename(tmp_dir, version_dir)
+    except OSError:
+        # 同一版本已由其他进程写好（内容相同），丢弃本次结果
+        if not os.path.isdir(version_dir):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    current_tmp = os.path.join(shard_root, f"CURRENT.tmp{os.getpid()}")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(version_dir))
+    os.replace(current_tmp, os.path.join(shard_root, "CURRENT"))
+    return version_dir
+
+
+class ShardedICDTree:
+    """
+    按章分片的 ICDTree：根分片常驻，level 2 / 3 的查询按路由表定位到所在章的分片，
+    分片在首次访问时才 mmap 打开，之后在进程内共享（多进程之间共享页缓存）。
+
+    get_child_node / get_coding_rule / get_node / get_parent / get_path 的返回与整库 ICDTree 一致；
+    节点 id 只在分片内有效，因此不提供 ancestor_ids 等基于 id 的接口。
+    """
+
+    def __init__(self, root: ICDSnapshot, shard_dir: str):
+        self.shard_dir = shard_dir
+        self.shard_names = root.shards
+        self._root = root.tree
+        codes = root.section("r.codes")
+        self._router = _SortedCodeIndex(_StringColumn(root.strings, codes), range(len(codes)))
+        self._router_shards = root.section("r.shards")
+        self._shards: Dict[int, ICDTree] = {0: root.tree}
+        self._lock = threading.Lock()
+
+    def _shard(self, code) -> Optional[ICDTree]:
+        """编码所在分片的树（首次访问时打开），路由表中没有的编码返回 None"""
+        pos = self._router.get(code)
+        if pos is None:
+            return None
+        shard = self._router_shards[pos]
+        tree = self._shards.get(shard)
+        if tree is None:
+            with self._lock:
+                tree = self._shards.get(shard)
+                if tree is None:
+                    path = os.path.join(self.shard_dir, self.shard_names[shard] + ".snapshot")
+                    tree = self._shards[shard] = ICDSnapshot(path).tree
+        return tree
+
+    def _tree_of(self, code) -> ICDTree:
+        return self._shard(code) or self._root
+
+    def loaded_shards(self) -> List[str]:
+        """已打开的分片名（含根分片）"""
+        return [self.shard_names[shard] for shard in sorted(self._shards)]
+
+    def __contains__(self, code):
+        return code in self._tree_of(code)
+
+    def get_child_node(self, node_id, level):
+        """返回【int，list】0表示节点错误 1表示正常 -1表示层级错误"""
+        if level in (2, 3):
+            tree = self._shard(node_id)
+            return (0, None) if tree is None else tree.get_child_node(node_id, level)
+        return self._root.get_child_node(node_id, level)
+
+    def get_coding_rule(self, node_id, level):
+        """返回【int，list】0表示该层级规则文件中无此节点，1表示正常"""
+        if level in (2, 3):
+            tree = self._shard(node_id)
+            return (0, None) if tree is None else tree.get_coding_rule(node_id, level)
+        return self._root.get_coding_rule(node_id, level)
+
+    def get_node(self, code) -> Optional[Dict]:
+        return self._tree_of(code).get_node(code)
+
+    def get_parent(self, node_id) -> Optional[Dict]:
+        return self._tree_of(node_id).get_parent(node_id)
+
+    def get_path(self, code) -> Optional[List[Dict]]:
+        return self._tree_of(code).get_path(code)
+
+
+class ShardedSnapshot:
+    """
+    按章分片的快照版本，接口同 ICDSnapshot（tree / code_tree / version / sources / checksum）。
+    打开时只 mmap 根分片；tree 为 ShardedICDTree，code_tree 在首次访问时打开。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.root = ICDSnapshot(os.path.join(path, ROOT_SHARD + ".snapshot"))
+        self.sources = self.root.sources
+        self.checksum = self.root.checksum
+        self.tree = ShardedICDTree(self.root, path)
+        self._code_tree = None
+        self._code_tree_loaded = False
+        self._keys = None
+
+    @property
+    def version(self) -> str:
+        return self.checksum[:12]
+
+    @property
+    def code_tree(self) -> Optional[ICDTree]:
+        if not self._code_tree_loaded:
+            merge_file = os.path.join(self.path, MERGE_SHARD + ".snapshot")
+            self._code_tree = ICDSnapshot(merge_file).code_tree if os.path.exists(merge_file) else None
+            self._code_tree_loaded = True
+        return self._code_tree
+
+    @property
+    def keys(self) -> KeyIndex:
+        """同 ICDSnapshot.keys；码树部分只用根分片（各章及其类目），不打开各章分片"""
+        if self._keys is None:
+            self._keys = KeyIndex.from_trees(self.code_tree, self.root.tree)
+        return self._keys
+
+    def is_fresh(self, files) -> bool:
+        return self.root.is_fresh(files)
+
+
+def load_shards(shard_root: str = SHARD_DIR, node_dir: str = Node_DIR, rule_dir: str = Rule_DIR,
+                merge_path: Optional[str] = ALL_PATH_FILE) -> ShardedSnapshot:
+    """打开 CURRENT 指向的分片版本；不存在或与源 jsonl 不一致时重新编译（新鲜度判断同 load_snapshot）"""
+    files = _source_files(node_dir, rule_dir, merge_path)
+    current_file = os.path.join(shard_root, "CURRENT")
+    if os.path.exists(current_file):
+        try:
+            with open(current_file, encoding="utf-8") as f:
+                snapshot = ShardedSnapshot(os.path.join(shard_root, f.read().strip()))
+            if set(snapshot.sources) == {key for key, _ in files} and snapshot.is_fresh(files):
+                return snapshot
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ 分片快照不可用（{e}），重新编译")
+    print(f"🔄 按章编译 ICD 知识库分片: {shard_root}")
+    return ShardedSnapshot(build_shards(shard_root, node_dir, rule_dir, merge_path))
+
+
+# ----------------------------
+# 可热更新的知识库
+# ----------------------------
+RELOAD_CHECK_INTERVAL = 5.0  # 秒；两次检查源文件 stat 的最小间隔
+
+# 当前线程 / 协程所在会话固定使用的快照（见 KnowledgeBase.session）
+_session_snapshot = contextvars.ContextVar("icd_kb_session_snapshot", default=None)
+
+
+class _InMemorySnapshot:
+    """快照无法写入/打开时的退化形式：直接由 jsonl 构建，接口同 ICDSnapshot"""
+
+    def __init__(self, node_dir, rule_dir, merge_path):
+        files = _source_files(node_dir, rule_dir, merge_path)
+        self.path = None
+        self.sources = _source_stats(files)
+        self.checksum = _source_checksum(files)
+        self.tree = ICDTree(node_dir, rule_dir)
+        self.code_tree = ICDTree.from_merge_path(merge_path) \
+            if merge_path and os.path.exists(merge_path) else None
+        self.keys = KeyIndex.from_trees(self.code_tree, self.tree)
+
+    @property
+    def version(self) -> str:
+        return self.checksum[:12]
+
+
+class KnowledgeBase:
+    """
+    版本化、可热更新的 ICD 知识库（node_index + rule_index + merge_path）。
+
+    - current() 返回当前版本的快照；每隔 check_interval 秒检查一次源文件 stat，
+      发现变化后在后台线程重新编译快照，完成后整体替换 self._current（单次赋值，原子）；
+    - 快照文件以 os.replace 覆盖，已 mmap 的旧版本仍指向旧 inode，正在进行的会话不受影响；
+    - session() 在会话（一个病人）期间固定使用同一版本，get_icd_snapshot / get_icd_tree 在会话内返回该版本；
+    - sharded=True 时使用按章分片的快照（node_dir/icd_kb.shards），各章在首次访问时才加载；
+    - attach_path 给定时直接只读打开该版本（进程池子进程挂载父进程发布的版本，见 attach_knowledge_base）。
+    """
+
+    def __init__(self, node_dir: str = Node_DIR, rule_dir: str = Rule_DIR, merge_path: Optional[str] = None,
+                 check_interval: Optional[float] = RELOAD_CHECK_INTERVAL, sharded: bool = SHARD_BY_CHAPTER,
+                 attach_path: Optional[str] = None):
+        if merge_path is None:
+            merge_path = os.path.join(node_dir, "merge_path.jsonl")
+        self.node_dir = node_dir
+        self.rule_dir = rule_dir
+        self.merge_path = merge_path
+        self.snapshot_path = os.path.join(node_dir, "icd_kb.snapshot")
+        self.shard_dir = os.path.join(node_dir, "icd_kb.shards")
+        self.sharded = sharded
+        self.check_interval = check_interval
+        self._files = _source_files(node_dir, rule_dir, merge_path)
+        self._lock = threading.Lock()
+        self._reloading = False
+        self._current = self._attach(attach_path) if attach_path else self._load()
+        self._seen_stats = self._current.sources
+        self._next_check = time.monotonic() + (check_interval or 0)
+
+    def _load(self):
+        try:
+            if self.sharded:
+                return load_shards(self.shard_dir, self.node_dir, self.rule_dir, self.merge_path)
+            return load_snapshot(self.snapshot_path, self.node_dir, self.rule_dir, self.merge_path)
+        except OSError as e:
+            print(f"⚠️ 快照加载失败（{e}），改为直接读取 jsonl")
+            return _InMemorySnapshot(self.node_dir, self.rule_dir, self.merge_path)
+
+    def _attach(self, path: str):
+        """打开已编译好的版本（不做新鲜度校验、不重建）；打不开时退回正常加载"""
+        try:
+            return ShardedSnapshot(path) if self.sharded else ICDSnapshot(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ 无法挂载已发布的快照 {path}（{e}），改为自行加载")
+            return self._load()
+
+    @property
+    def version(self) -> str:
+        return self._current.version
+
+    def current(self):
+        """当前版本的快照（到期时顺带检查源文件，发现变化则后台重建，不阻塞调用方）"""
+        if self.check_interval is not None and time.monotonic() >= self._next_check:
+            self._check()
+        return self._current
+
+    def _check(self):
+        with self._lock:
+            if self._reloading or time.monotonic() < self._next_check:
+                return
+            self._next_check = time.monotonic() + self.check_interval
+            if _source_stats(self._files) == self._seen_stats:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload_in_background, name="icd-kb-reload", daemon=True).start()
+
+    def _reload_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"❌ 知识库热更新失败，继续使用版本 {self.version}: {e}")
+        finally:
+            self._reloading = False
+
+    def reload(self) -> bool:
+        """同步检查并加载新版本；内容有变化并完成替换时返回 True"""
+        stats = _source_stats(self._files)
+        snapshot = self._load()
+        self._seen_stats = stats
+        if snapshot.version == self._current.version:
+            return False
+        previous, self._current = self._current.version, snapshot
+        print(f"🔄 知识库已更新: {previous} -> {snapshot.version}")
+        return True
+
+    @contextmanager
+    def session(self):
+        """在 with 块内固定使用进入时的版本；yield 该快照（可读取 .version 写入结果）"""
+        snapshot = self.current()
+        token = _session_snapshot.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            _session_snapshot.reset(token)
+
+
+# ----------------------------
+# 进程级单例
+# ----------------------------
+_knowledge_base = None
+_knowledge_base_lock = threading.Lock()
+
+
+def get_knowledge_base(node_dir: str = Node_DIR, rule_dir: str = Rule_DIR,
+                       merge_path: Optional[str] = None) -> KnowledgeBase:
+    """
+    获取进程内共享的 KnowledgeBase，首次调用时 mmap 打开快照（线程安全）。
+    默认使用 node_dir/icd_kb.shards 下按章分片的快照（SHARD_BY_CHAPTER），merge_path 默认为 node_dir/merge_path.jsonl。
+    """
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _knowledge_base_lock:
+            if _knowledge_base is None:
+                _knowledge_base = KnowledgeBase(node_dir, rule_dir, merge_path)
+    return _knowledge_base
+
+
+def publish_knowledge_base(node_dir: str = Node_DIR, rule_dir: str = Rule_DIR,
+                           merge_path: Optional[str] = None) -> Dict:
+    """
+    在父进程中编译（或确认）快照，返回传给子进程的句柄（只含路径与参数，可 pickle）。
+    与 attach_knowledge_base 配合作为进程池的 initializer，子进程不再各自解析 jsonl、校验或重建快照：
+        ProcessPoolExecutor(initializer=attach_knowledge_base, initargs=(publish_knowledge_base(),))
+    """
+    kb = get_knowledge_base(node_dir, rule_dir, merge_path)
+    return {"node_dir": kb.node_dir, "rule_dir": kb.rule_dir, "merge_path": kb.merge_path,
+            "sharded": kb.sharded, "check_interval": kb.check_interval, "path": kb.current().path}
+
+
+def attach_knowledge_base(handle: Dict) -> KnowledgeBase:
+    """
+    进程池子进程的 initializer：以只读 mmap 挂载父进程发布的版本，作为本进程的 get_knowledge_base 单例。
+    快照文件的页缓存由所有进程共享，get_child_node / get_coding_rule 等工具函数无需改动。
+    """
+    global _knowledge_base
+    with _knowledge_base_lock:
+        _knowledge_base = KnowledgeBase(handle["node_dir"], handle["rule_dir"], handle["merge_path"],
+                                        handle["check_interval"], handle["sharded"], attach_path=handle["path"])
+    return _knowledge_base
+
+
+def _reset_locks_after_fork():
+    """fork 出的子进程只继承调用线程：父进程中被后台重建线程持有的锁需要重建，重建标记清零"""
+    global _knowledge_base_lock
+    _knowledge_base_lock = threading.Lock()
+    kb = _knowledge_base
+    if kb is not None:
+        kb._lock = threading.Lock()
+        kb._reloading = False
+        tree = getattr(kb._current, "tree", None)
+        if isinstance(tree, ShardedICDTree):
+            tree._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks_after_fork)
+
+
+def get_icd_snapshot(node_dir: str = Node_DIR, rule_dir: str = Rule_DIR, merge_path: Optional[str] = None):
+    """会话内返回会话固定的版本，否则返回知识库当前版本"""
+    snapshot = _session_snapshot.get()
+    if snapshot is not None:
+        return snapshot
+    return get_knowledge_base(node_dir, rule_dir, merge_path).current()
+
+
+def get_icd_tree(node_dir: str = Node_DIR, rule_dir: str = Rule_DIR):
+    """获取当前（或会话固定版本的）ICDTree / ShardedICDTree（来自 get_icd_snapshot）"""
+    return get_icd_snapshot(node_dir, rule_dir).tree
+
+
+def get_code_ranges(node_dir: str = Node_DIR, rule_dir: str = Rule_DIR) -> CodeRangeIndex:
+    """当前（或会话固定版本的）编码区间索引，按快照缓存，随知识库热更新一起更新"""
+    snapshot = get_icd_snapshot(node_dir, rule_dir)
+    index = getattr(snapshot, "code_ranges", None)
+    if index is None:
+        index = snapshot.code_ranges = CodeRangeIndex(os.path.join(rule_dir, "chapter_index.jsonl"), snapshot.tree)
+    return index
@@ -1,91 +1,34 @@
 import json
 import os
 from collections import defaultdict
+from icd_keys import KeyIndex
+from icd_tree import CodeRangeIndex, ICDTree, load_snapshot
 
 # ==========================================
 # 0. 配置与全局常量
 # ==========================================
 # ⚠️ 请确保此路径正确
 ALL_PATH_FILE = "./merge_path.jsonl" 
-
-CHINESE_NUM_TO_INT = {
-    "第一章": 1, "第二章": 2, "第三章": 3, "第四章": 4, "第五章": 5,
-    "第六章": 6, "第七章": 7, "第八章": 8, "第九章": 9, "第十章": 10,
-    "第十一章": 11, "第十二章": 12, "第十三章": 13, "第十四章": 14, "第十五章": 15,
-    "第十六章": 16, "第十七章": 17, "第十八章": 18, "第十九章": 19, "第二十章": 20,
-    "第二十一章": 21, "第二十二章": 22,
-}
+# 章节 "节范围" 索引：用于定位码表外（模型编造）的预测编码
+CHAPTER_INDEX_FILE = "../rule_index/chapter_index.jsonl"
 
 # ==========================================
 # 1. 码表索引构建工具 (复用之前逻辑)
 # ==========================================
-def split_code_name(s):
-    if not s or not isinstance(s, str):
-        return None, None
-    parts = s.split(' ', 1)
-    if len(parts) < 2:
-        return s.strip(), ""
-    return parts[0].strip(), parts[1].strip()
-
-def build_full_hierarchy_index(jsonl_path):
-    index_map = {}
-    root_node = {"level": 0, "node_id": "root", "name": "根节点"}
-
-    if not os.path.exists(jsonl_path):
-        return {}
-
-    with open(jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line: continue
-            try:
-                entry = json.loads(line)
-                # L1
-                l1_raw = entry.get("first_chapter", "")
-                l1_code, l1_name = split_code_name(l1_raw)
-                if not l1_code: continue
-                node_l1 = {"node_id": l1_code, "name": l1_name, "level": 1}
-                path_l1 = [root_node, node_l1]
-                index_map[l1_code] = path_l1
-                
-                # L2
-                l2_raw = entry.get("second_chapter", "")
-                l2_code, l2_name = split_code_name(l2_raw)
-                path_l2 = path_l1
-                if l2_code:
-                    node_l2 = {"node_id": l2_code, "name": l2_name, "level": 2}
-                    path_l2 = path_l1 + [node_l2]
-                    index_map[l2_code] = path_l2
-                
-                # L3
-                l3_raw = entry.get("third_chapter", "")
-                l3_code, l3_name = split_code_name(l3_raw)
-                current_parent_path = path_l2
-                if l3_code:
-                    node_l3 = {"node_id": l3_code, "name": l3_name, "level": 3}
-                    path_l3 = path_l2 + [node_l3]
-                    index_map[l3_code] = path_l3
-                    current_parent_path = path_l3
-                
-                # L4
-                l4_code = entry.get("code")
-                l4_name = entry.get("name")
-                if l4_code:
-                    node_l4 = {"node_id": l4_code, "name": l4_name, "level": 4}
-                    path_l4 = current_parent_path + [node_l4]
-                    index_map[l4_code] = path_l4
-            except:
-                continue
-    return index_map
-
-# 初始化码表
+# 码表以紧凑树形式加载（编译为 mmap 快照，码表变化时自动重新编译），路径由父指针按需生成
 print(f"🔄 正在加载码表文件: {ALL_PATH_FILE} ...")
-CODE_TO_ENTRY = build_full_hierarchy_index(ALL_PATH_FILE)
-print(f"✅ 索引构建完成，包含 {len(CODE_TO_ENTRY)} 个节点。")
+SNAPSHOT = load_snapshot(ALL_PATH_FILE + ".snapshot", None, None, ALL_PATH_FILE) \
+    if os.path.exists(ALL_PATH_FILE) else None
+CODE_TREE = SNAPSHOT.code_tree if SNAPSHOT else ICDTree.empty()
+# 章节标签规范化表（"第1章“...”" / "第一章" -> "第一章"，并给出章序号用于过滤与排序）
+CHAPTER_KEYS = SNAPSHOT.keys if SNAPSHOT else KeyIndex()
+print(f"✅ 索引构建完成，包含 {len(CODE_TREE)} 个节点。")
+
+CODE_RANGES = CodeRangeIndex(CHAPTER_INDEX_FILE, CODE_TREE)
 
 def coda2path(code):
     """根据 code 获取完整路径"""
-    return CODE_TO_ENTRY.get(code, None)
+    return CODE_TREE.get_path(code)
 
 
 # ==========================================
@@ -105,7 +48,9 @@ def calculate_chapter_accuracy(file_path):
         "l1_correct": 0,
         "l2_correct": 0,
         "l3_correct": 0,
-        "l4_correct": 0
+        "l4_correct": 0,
+        "out_of_table": 0,     # 预测编码非空但不在码表中
+        "out_of_table_l1": 0   # 其中按节范围定位到的章节与答案一致
     }
 
     try:
@@ -132,13 +77,14 @@ def calculate_chapter_accuracy(file_path):
                     continue
 
                 # 获取章节归属
+                # 只统计 "第X章" 写法的章节（与原统计口径一致，merge_path 的 "第18章“...”" 写法不计入）
                 chapter = answer_path[0].get("node_id", "").strip()
-                if not chapter or chapter not in CHINESE_NUM_TO_INT:
+                if chapter not in CHAPTER_KEYS.chapter_numbers:
                     continue
 
                 # === 2. 获取预测路径 ===
-                # 注意：如果 suggest_icd 为空或不在码表中，predict_path 为 None
-                predict_path = coda2path(suggest_icd)
+                # 注意：如果 suggest_icd 为空或不在码表中，predict_ids 为 None
+                predict_ids = CODE_TREE.ancestor_ids(suggest_icd)
 
                 # === 3. 层级比对逻辑 ===
                 chapter_stats[chapter]["total"] += 1
@@ -149,37 +95,28 @@ def calculate_chapter_accuracy(file_path):
                 is_l3_ok = False
                 is_l4_ok = False
 
-                if predict_path:
-                    # --- Level 1 Check ---
-                    # answer_path[0] (Level 1) vs predict_path[1] (Level 1, index 0 is root)
-                    if len(answer_path) >= 1 and len(predict_path) > 1:
-                        if answer_path[0].get("node_id") == predict_path[1]["node_id"]:
-                            is_l1_ok = True
+                if predict_ids:
+                    # 定宽祖先 id 自顶向下比对：answer_path[i] 对应预测路径第 i 个槽位 (不含 Root)
+                    depth = CODE_TREE.agreement_depth(CODE_TREE.path_ids(answer_path), predict_ids)
 
-                    # --- Level 2 Check ---
-                    if is_l1_ok and len(answer_path) >= 2 and len(predict_path) > 2:
-                        if answer_path[1].get("node_id") == predict_path[2]["node_id"]:
-                            is_l2_ok = True
+                    # --- Level 1 / Level 2 Check ---
+                    is_l1_ok = depth >= 1
+                    is_l2_ok = depth >= 2
 
                     # --- Level 3 Check ---
-                    # 规则：若 answer 无 L3 (长度<3) 但 L2 正确，认为 L3 正确。
-                    if is_l2_ok:
-                        if len(answer_path) >= 3:
-                            # 答案有 L3，必须比对
-                            if len(predict_path) > 3:
-                                if answer_path[2].get("node_id") == predict_path[3]["node_id"]:
-                                    is_l3_ok = True
-                            else:
-                                # 答案有 L3，但预测路径没有 L3
-                                is_l3_ok = False
-                        else:
-                            # 答案没有 L3 (例如 I10)，但 L2 已正确，视为 L3 正确
-                            is_l3_ok = True
+                    # 规则：若 answer 无 L3 (长度<3) 但 L2 正确，认为 L3 正确；否则必须比对。
+                    is_l3_ok = is_l2_ok and (len(answer_path) < 3 or depth >= 3)
                     
                     # --- Level 4 Check (Code) ---
                     if suggest_icd == answer_code:
                         is_l4_ok = True
 
+                elif suggest_icd:
+                    # 码表外编码：按节范围二分定位所属章节
+                    global_stats["out_of_table"] += 1
+                    if CODE_RANGES.chapter_of(suggest_icd) == chapter:
+                        global_stats["out_of_table_l1"] += 1
+
                 # === 4. 更新统计 ===
                 if is_l1_ok: global_stats["l1_correct"] += 1
                 if is_l2_ok: global_stats["l2_correct"] += 1
@@ -193,7 +130,7 @@ def calculate_chapter_accuracy(file_path):
             print("❌ 未找到有效的章节数据。")
             return
 
-        all_chapters = sorted(chapter_stats.keys(), key=lambda x: CHINESE_NUM_TO_INT.get(x, 999))
+        all_chapters = sorted(chapter_stats.keys(), key=lambda x: CHAPTER_KEYS.chapter_numbers.get(x, 999))
 
         print(f"{'章节':<25} {'样本数':<10} {'正确数':<10} {'准确率(Acc)':<12}")
         print("-" * 75)
@@ -229,6 +166,8 @@ def calculate_chapter_accuracy(file_path):
             l4_acc = global_stats["l4_correct"] / total_all * 100
             print(f"{'Level 4':<20} {'编码 (Code)':<20} {global_stats['l4_correct']:<10} {l4_acc:.2f}%")
             print("-" * 75)
+            if global_stats["out_of_table"]:
+                print(f"⚠️ 码表外预测编码 {global_stats['out_of_table']} 条，按节范围定位章节正确 {global_stats['out_of_table_l1']} 条")
 
     except Exception as e:
         print(f"❌ 处理文件时出错: {e}")
@@ -243,7 +182,7 @@ if __name__ == "__main__":
     ]
 
     # 仅当码表构建成功时执行
-    if CODE_TO_ENTRY:
+    if len(CODE_TREE):
         for fp in file_paths:
             calculate_chapter_accuracy(fp)
     else:
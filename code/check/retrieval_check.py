@@ -1,121 +1,44 @@
 import json
 import os
 from collections import defaultdict
+from icd_keys import KeyIndex
+from icd_tree import CodeRangeIndex, ICDTree, load_snapshot
 
 # ==========================================
 # 0. 配置与全局常量
 # ==========================================
 # 请确保此路径正确，指向你的全量码表文件
 ALL_PATH_FILE = "./merge_path.jsonl"  # 示例路径，请修改为实际路径
-
-# 中文数字映射（用于排序）
-CHINESE_NUM_TO_INT = {
-    "第一章": 1, "第二章": 2, "第三章": 3, "第四章": 4, "第五章": 5,
-    "第六章": 6, "第七章": 7, "第八章": 8, "第九章": 9, "第十章": 10,
-    "第十一章": 11, "第十二章": 12, "第十三章": 13, "第十四章": 14, "第十五章": 15,
-    "第十六章": 16, "第十七章": 17, "第十八章": 18, "第十九章": 19, "第二十章": 20,
-    "第二十一章": 21, "第二十二章": 22,
-}
+# 章节 "节范围" 索引：用于定位码表外（模型编造）的预测编码
+CHAPTER_INDEX_FILE = "../rule_index/chapter_index.jsonl"
 
 # ==========================================
-# 1. 码表索引构建工具
-# ==========================================
-
-def split_code_name(s):
-    """
-    辅助工具：将 "B26.2+ 流行性腮腺炎性脑炎" 切割为 "B26.2+" 和 "流行性腮腺炎性脑炎"
-    """
-    if not s or not isinstance(s, str):
-        return None, None
-    parts = s.split(' ', 1)
-    if len(parts) < 2:
-        return s.strip(), ""
-    return parts[0].strip(), parts[1].strip()
-
-def build_full_hierarchy_index(jsonl_path):
-    index_map = {}
-    
-    # === 定义固定的根节点 ===
-    root_node = {
-        "level": 0,
-        "node_id": "root",
-        "name": "根节点"
-    }
-
-    if not os.path.exists(jsonl_path):
-        raise FileNotFoundError(f"码表文件不存在: {jsonl_path}")
-
-    with open(jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            
-            entry = json.loads(line)
-            
-            # --- Level 1 (First Chapter) ---
-            # 注意：此处使用 strict key access，如果码表格式不统一会报错
-            l1_raw = entry["first_chapter"]
-            l1_code, l1_name = split_code_name(l1_raw)
-            if not l1_code: continue 
-            
-            node_l1 = {"node_id": l1_code, "name": l1_name, "level": 1}
-            path_l1 = [root_node, node_l1]
-            index_map[l1_code] = path_l1
-            
-            # --- Level 2 (Second Chapter) ---
-            l2_raw = entry["second_chapter"]
-            l2_code, l2_name = split_code_name(l2_raw)
-            
-            path_l2 = path_l1 
-            if l2_code:
-                node_l2 = {"node_id": l2_code, "name": l2_name, "level": 2}
-                path_l2 = path_l1 + [node_l2]
-                index_map[l2_code] = path_l2
-            
-            # --- Level 3 (Third Chapter) ---
-            l3_raw = entry["third_chapter"]
-            l3_code, l3_name = split_code_name(l3_raw)
-            
-            current_parent_path = path_l2
-            
-            if l3_code:
-                node_l3 = {"node_id": l3_code, "name": l3_name, "level": 3}
-                path_l3 = path_l2 + [node_l3]
-                index_map[l3_code] = path_l3
-                current_parent_path = path_l3
-            
-            # --- Level 4 (Code) ---
-            l4_code = entry["code"]
-            l4_name = entry["name"]
-            
-            if l4_code:
-                node_l4 = {"node_id": l4_code, "name": l4_name, "level": 4}
-                path_l4 = current_parent_path + [node_l4]
-                index_map[l4_code] = path_l4
-
-    return index_map
-
-# ==========================================
-# 2. 全局索引初始化
+# 1. 全局索引初始化（紧凑树，路径由父指针按需生成）
 # ==========================================
 print(f"🔄 正在加载码表文件: {ALL_PATH_FILE} ...")
 try:
-    CODE_TO_ENTRY = build_full_hierarchy_index(ALL_PATH_FILE)
-    print(f"✅ 索引构建完成，包含 {len(CODE_TO_ENTRY)} 个节点。")
+    if not os.path.exists(ALL_PATH_FILE):
+        raise FileNotFoundError(ALL_PATH_FILE)
+    # 码表编译为 mmap 快照（码表变化时自动重新编译）
+    SNAPSHOT = load_snapshot(ALL_PATH_FILE + ".snapshot", None, None, ALL_PATH_FILE)
+    CODE_TREE = SNAPSHOT.code_tree
+    # 章节标签规范化表（"第1章“...”" / "第一章" -> "第一章"，并给出章序号用于过滤与排序）
+    CHAPTER_KEYS = SNAPSHOT.keys
+    print(f"✅ 索引构建完成，包含 {len(CODE_TREE)} 个节点。")
 except Exception as e:
     print(f"❌ 码表加载失败: {e}")
     print("⚠️ 请修正 ALL_PATH_FILE 路径后重试。后续计算将因为找不到路径而全部判错。")
-    CODE_TO_ENTRY = {}
+    CODE_TREE = ICDTree.empty()
+    CHAPTER_KEYS = KeyIndex()
+
+CODE_RANGES = CodeRangeIndex(CHAPTER_INDEX_FILE, CODE_TREE)
 
 def coda2path(code):
     """根据 code 获取完整路径 (Root -> L1 -> L2 -> L3 -> L4)"""
-    if code not in CODE_TO_ENTRY:
-        return None
-    return CODE_TO_ENTRY[code]
+    return CODE_TREE.get_path(code)
 
 # ==========================================
-# 3. 统计核心逻辑
+# 2. 统计核心逻辑
 # ==========================================
 
 def calculate_chapter_accuracy(data_file_path):
@@ -139,7 +62,9 @@ def calculate_chapter_accuracy(data_file_path):
         "l1_correct": 0,
         "l2_correct": 0,
         "l3_correct": 0,
-        "l4_correct": 0
+        "l4_correct": 0,
+        "out_of_table": 0,     # 预测编码非空但不在码表中
+        "out_of_table_l1": 0   # 其中按节范围定位到的章节与答案一致
     }
 
     with open(data_file_path, 'r', encoding='utf-8') as f:
@@ -171,13 +96,14 @@ def calculate_chapter_accuracy(data_file_path):
             
             # 获取章节名称 (例如 "第一章") 用于分组统计
             # 假设 answer_path[0] 是 Level 1
+            # 只统计 "第X章" 写法的章节（与原统计口径一致，merge_path 的 "第18章“...”" 写法不计入）
             chapter = answer_path[0]['node_id'].strip()
-            if not chapter or chapter not in CHINESE_NUM_TO_INT:
+            if chapter not in CHAPTER_KEYS.chapter_numbers:
                 continue
 
             # === 3. 获取预测路径 ===
-            # predict_path 结构: [Root, L1, L2, L3, L4] (由 build_full_hierarchy_index 生成)
-            predict_path = coda2path(predict_code)
+            # predict_ids: 定宽祖先 id (L1, L2, L3, L4)，与 coda2path 去掉 Root 后逐位对应
+            predict_ids = CODE_TREE.ancestor_ids(predict_code)
 
             # === 4. 层级比对逻辑 ===
             global_stats["total"] += 1
@@ -189,39 +115,29 @@ def calculate_chapter_accuracy(data_file_path):
             is_l3_ok = False
             is_l4_ok = False
 
-            # 如果 predict_path 为 None，所有层级均为 False，不需要处理
-            if predict_path:
-                # --- Level 1 Check ---
-                # answer_path[0] 对应 predict_path[1] (因为 predict_path 有 Root)
-                if len(answer_path) >= 1 and len(predict_path) > 1:
-                    if answer_path[0]['node_id'] == predict_path[1]['node_id']:
-                        is_l1_ok = True
+            # 如果 predict_ids 为 None，所有层级均为 False，不需要处理
+            if predict_ids:
+                # depth: answer_path 与预测路径自顶向下连续一致的层数 (整数 id 比较)
+                depth = CODE_TREE.agreement_depth(CODE_TREE.path_ids(answer_path), predict_ids)
 
-                # --- Level 2 Check ---
-                # answer_path[1] 对应 predict_path[2]
-                if is_l1_ok and len(answer_path) >= 2 and len(predict_path) > 2:
-                    if answer_path[1]['node_id'] == predict_path[2]['node_id']:
-                        is_l2_ok = True
+                # --- Level 1 / Level 2 Check ---
+                is_l1_ok = depth >= 1
+                is_l2_ok = depth >= 2
 
                 # --- Level 3 Check ---
-                # 规则：若 answer 无 L3 但 L2 正确，认为 L3 正确。
-                if is_l2_ok:
-                    if len(answer_path) >= 3:
-                        # 答案有 L3，必须比对
-                        if len(predict_path) > 3:
-                            if answer_path[2]['node_id'] == predict_path[3]['node_id']:
-                                is_l3_ok = True
-                        else:
-                            # 答案有 L3，但预测路径没有 L3，判错
-                            is_l3_ok = False
-                    else:
-                        # 答案没有 L3 (例如 I10)，但 L2 已正确，判对
-                        is_l3_ok = True
+                # 规则：若 answer 无 L3 但 L2 正确，判对；答案有 L3 时预测路径须在第 3 层一致。
+                is_l3_ok = is_l2_ok and (len(answer_path) < 3 or depth >= 3)
                 
                 # --- Level 4 Check (Code) ---
                 if answer_code == predict_code and answer_code != "":
                     is_l4_ok = True
 
+            elif predict_code:
+                # 码表外编码：按节范围二分定位所属章节
+                global_stats["out_of_table"] += 1
+                if CODE_RANGES.chapter_of(predict_code) == chapter:
+                    global_stats["out_of_table_l1"] += 1
+
             # === 5. 更新统计计数 ===
             if is_l1_ok: global_stats["l1_correct"] += 1
             if is_l2_ok: global_stats["l2_correct"] += 1
@@ -237,7 +153,7 @@ def calculate_chapter_accuracy(data_file_path):
         return
 
     # 按照章节顺序排序
-    all_chapters = sorted(chapter_stats.keys(), key=lambda x: CHINESE_NUM_TO_INT.get(x, 999))
+    all_chapters = sorted(chapter_stats.keys(), key=lambda x: CHAPTER_KEYS.chapter_numbers.get(x, 999))
 
     print(f"{'章节':<25} {'样本数':<10} {'Top1正确':<10} {'准确率(Acc)':<12}")
     print("-" * 75)
@@ -280,6 +196,8 @@ def calculate_chapter_accuracy(data_file_path):
         l4_acc = global_stats["l4_correct"] / total_all * 100
         print(f"{'Level 4':<20} {'编码 (Code)':<20} {global_stats['l4_correct']:<10} {l4_acc:.2f}%")
         print("-" * 75)
+        if global_stats["out_of_table"]:
+            print(f"⚠️ 码表外预测编码 {global_stats['out_of_table']} 条，按节范围定位章节正确 {global_stats['out_of_table_l1']} 条")
 
 # ================= 执行 =================
 if __name__ == "__main__":
@@ -292,6 +210,6 @@ if __name__ == "__main__":
     ]
 
     # 只有当码表加载成功时才执行
-    if CODE_TO_ENTRY:
+    if len(CODE_TREE):
         for df in data_files:
             calculate_chapter_accuracy(df)
\ No newline at end of file
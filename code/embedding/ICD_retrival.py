@@ -3,33 +3,916 @@ from langchain_chroma import Chroma
 from langchain_openai import OpenAIEmbeddings
 from config import VECTORSTORE_ROOT, EMBEDDING_API_URL, EMBEDDING_MODEL_NAME, DATA_FILES
 from typing import List, Dict, Optional, Union
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import math
 import os
+import shutil
+import sqlite3
+import threading
+import numpy as np
+from text_ngrams import ngram_counts
 VECTORSTORE_ROOT=""
 
 DATA_FILES = {
     "ICD-10-fix": "../../node_index/merge_path.jsonl",
 }
+# 查询向量缓存：内存 LRU 条数，及磁盘缓存（SQLite）路径，设为 None 则只用内存缓存
+EMBEDDING_CACHE_SIZE = 20000
+EMBEDDING_CACHE_PATH = os.path.join(VECTORSTORE_ROOT, "embedding_cache.sqlite")
+
+# 向量检索后端："chroma"（HNSW 近似检索）或 "numpy"（整库矩阵精确检索，向量矩阵由 Chroma 导出到 NUMPY_ROOT）
+VECTOR_BACKEND = "chroma"
+NUMPY_ROOT = os.path.join(VECTORSTORE_ROOT, "numpy")
+NUMPY_FORMAT = 2  # 导出格式版本；不一致时重新导出
+# NumPy 后端的量化检索：None（float32 原样）、"int8"（逐维缩放）或 "float16"；先在量化矩阵上检索
+# k * RESCORE_FACTOR 个候选，NUMPY_RESCORE 为 True 且有 float32 矩阵时再按 float32 精确重排取前 k 个
+NUMPY_QUANTIZATION = None
+NUMPY_RESCORE = True
+RESCORE_FACTOR = 4
+QUANTIZED_SCAN_BLOCK = 512  # 量化矩阵按块转换为 float32 计算相似度，每块行数（块留在缓存中）
+# 层级字段（章节 / 类目 / 亚目），导出时每行记录其所在节点的整数 id，每个节点对应矩阵中连续的一段行
+HIERARCHY_FIELDS = ("first_chapter", "second_chapter", "third_chapter")
+# 码表与向量库一致性校验时抽查的编码数
+CODE_TABLE_SAMPLE = 32
+# 混合检索：每一路（向量 / 词法）参与融合的候选数，及 RRF 的平滑常数
+HYBRID_DEPTH = 100
+RRF_K = 60
+# 向量库查询线程数：每个 source 各自一个线程池（至多 SEARCH_WORKERS 个查询同时在执行），
+# 另有一个同样大小的共享线程池供 aget_by_id 等异步接口使用；嵌入请求走异步 HTTP，不占线程
+SEARCH_WORKERS = 8
+# 单个 source 的检索超时（秒）：超时的 source 本次不计入结果，不阻塞整个查询
+SOURCE_TIMEOUT = 10.0
+
 # 全局嵌入模型（共享）
 _embeddings = None
 
 
+class CachedEmbeddings:
+    """
+    嵌入模型的两级缓存包装：内存 LRU + 磁盘 SQLite，键为 (模型名, 文本 sha1)。
+    同样的诊断名称（如 "高血压3级"、推荐诊断）在不同病人、不同次运行之间只请求一次嵌入服务；
+    向量按 float64 原样存取，命中与否检索结果都不变。
+    接口同 langchain 的 Embeddings（embed_query / embed_documents），可直接作为 Chroma 的 embedding_function。
+    多进程共享同一磁盘缓存（WAL 模式），每个进程的每个线程各自打开连接；
+    锁只保护内存 LRU 与计数，SQLite 读写不持锁，磁盘 I/O 不会让其他线程（及异步接口）排队等待。
+    """
+
+    def __init__(self, embeddings, model_name: str, cache_path: Optional[str] = EMBEDDING_CACHE_PATH,
+                 maxsize: int = EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache_path = cache_path
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # 每个线程自己的 SQLite 连接
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """当前线程的磁盘缓存连接（fork 出的子进程重新打开）；打不开时退化为只用内存缓存"""
+        if self.cache_path is None:
+            return None
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            try:
+                conn = sqlite3.connect(self.cache_path, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                             "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                             "PRIMARY KEY (model, text_hash))")
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ 嵌入磁盘缓存不可用（{e}），只使用内存缓存")
+                self.cache_path = None
+                return None
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _remember(self, key: str, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, texts: List[str]):
+        """
+        查内存与磁盘缓存，返回 (keys, vectors, pending)：vectors 中未命中处为 None，
+        pending 为仍需请求嵌入服务的 {key: 文本}（同一批中重复的文本只请求一次）
+        """
+        keys = [self._key(text) for text in texts]
+        vectors = [None] * len(texts)
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.memory_hits += 1
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        db = self._db() if missing else None
+        if db is not None:
+            wanted = list({keys[i] for i in missing})
+            stored = {}
+            try:
+                for start in range(0, len(wanted), 500):  # SQLite 单条语句的参数个数有上限
+                    chunk = wanted[start:start + 500]
+                    rows = db.execute("SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN (%s)"
+                                      % ",".join("?" * len(chunk)), [self.model_name] + chunk)
+                    stored.update((text_hash, array("d", blob).tolist()) for text_hash, blob in rows)
+            except sqlite3.Error as e:
+                print(f"⚠️ 读取嵌入磁盘缓存失败: {e}")
+            with self._lock:
+                for i in missing:
+                    vector = stored.get(keys[i])
+                    if vector is not None:
+                        vectors[i] = vector
+                        self._remember(keys[i], vector)
+                        self.disk_hits += 1
+
+        pending = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                pending.setdefault(keys[i], texts[i])
+        return keys, vectors, pending
+
+    def _store(self, keys: List[str], vectors: List, fresh: Dict[str, List[float]]) -> List[List[float]]:
+        """写入嵌入服务新返回的向量（内存与磁盘），并填入 vectors 中未命中的位置"""
+        with self._lock:
+            self.api_calls += 1
+            self.misses += sum(1 for vector in vectors if vector is None)
+            for key, vector in fresh.items():
+                self._remember(key, vector)
+        db = self._db()
+        if db is not None:
+            try:
+                with db:  # 事务：成功提交，出错回滚
+                    db.executemany("INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                                   [(self.model_name, key, array("d", vector).tobytes())
+                                    for key, vector in fresh.items()])
+            except sqlite3.Error as e:
+                print(f"⚠️ 写入嵌入磁盘缓存失败: {e}")
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                vectors[i] = fresh[keys[i]]
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, pending = self._lookup(texts)
+        if pending:
+            # 未命中的文本一次请求嵌入服务；请求期间不持锁
+            fresh = dict(zip(pending, self.embeddings.embed_documents(list(pending.values()))))
+            self._store(keys, vectors, fresh)
+        return vectors
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        异步版本：嵌入服务用底层模型的异步 HTTP 客户端（aembed_documents）请求，
+        缓存的 SQLite 读写放到线程中执行，不阻塞事件循环
+        """
+        loop = asyncio.get_running_loop()
+        keys, vectors, pending = await loop.run_in_executor(None, self._lookup, texts)
+        if pending:
+            texts_to_embed = list(pending.values())
+            aembed = getattr(self.embeddings, "aembed_documents", None)
+            if aembed is not None:
+                embedded = await aembed(texts_to_embed)
+            else:
+                embedded = await loop.run_in_executor(None, self.embeddings.embed_documents, texts_to_embed)
+            await loop.run_in_executor(None, self._store, keys, vectors, dict(zip(pending, embedded)))
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def cache_stats(self) -> Dict:
+        """命中情况：内存命中、磁盘命中、未命中条数，以及实际请求嵌入服务的次数"""
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "api_calls": self.api_calls, "hit_rate": (total - self.misses) / total if total else 0.0,
+                "entries": len(self._memory)}
+
+
 def get_embeddings():
     global _embeddings
     if _embeddings is None:
-        _embeddings = OpenAIEmbeddings(
-            model=EMBEDDING_MODEL_NAME,
-            base_url=EMBEDDING_API_URL,
-            api_key="none",
-            check_embedding_ctx_length=False,
+        _embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(
+                model=EMBEDDING_MODEL_NAME,
+                base_url=EMBEDDING_API_URL,
+                api_key="none",
+                check_embedding_ctx_length=False,
+            ),
+            EMBEDDING_MODEL_NAME,
         )
     return _embeddings
 
 
+class _Document:
+    """检索结果文档，字段同 langchain 的 Document（metadata / page_content）"""
+    __slots__ = ("metadata", "page_content")
+
+    def __init__(self, metadata: Dict, page_content: str):
+        self.metadata = metadata
+        self.page_content = page_content
+
+
+def _chroma_stamp(persist_dir: str) -> Optional[list]:
+    """Chroma 库文件的 (mtime_ns, size)，用于判断导出的向量矩阵是否过期"""
+    db_file = os.path.join(persist_dir, "chroma.sqlite3")
+    if not os.path.exists(db_file):
+        return None
+    st = os.stat(db_file)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def export_numpy_backend(vectorstore, out_dir: str, persist_dir: Optional[str] = None, batch_size: int = 5000) -> str:
+    """
+    将 Chroma 向量库的全部向量与元数据导出为 NumpyVectorBackend 的文件：
+      vectors.npy     按行 L2 归一化的 float32 矩阵
+      metadata.jsonl  逐行 {"id", "metadata", "document"}，与矩阵行号一一对应
+      hierarchy.npy   int32 (行数, 3)，每行在章节 / 类目 / 亚目层的节点 id（无则为 -1）
+      hierarchy.json  各层节点的标签与行区间 [start, end)
+      source.json     导出格式版本与导出时 Chroma 库文件的 stat（库重新入库后自动重新导出）
+    行按 (章节, 类目, 亚目, 编码) 排序，每个节点的行连续，按节点过滤即取矩阵的一段切片。
+    先写入临时目录再整体替换，读者不会看到写了一半的文件。
+    """
+    collection = vectorstore._collection
+    total = collection.count()
+    blocks, rows = [], []
+    for offset in range(0, total, batch_size):
+        batch = collection.get(limit=batch_size, offset=offset, include=["embeddings", "metadatas", "documents"])
+        blocks.append(np.asarray(batch["embeddings"], dtype=np.float32))
+        rows += [{"id": i, "metadata": m, "document": d}
+                 for i, m, d in zip(batch["ids"], batch["metadatas"], batch["documents"])]
+    matrix = np.concatenate(blocks) if blocks else np.zeros((0, 0), dtype=np.float32)
+    order = sorted(range(len(rows)), key=lambda i: tuple(
+        str(rows[i]["metadata"].get(field) or "") for field in HIERARCHY_FIELDS + ("code",)))
+    rows = [rows[i] for i in order]
+    matrix = matrix[order] if len(rows) else matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+
+    node_ids = np.full((len(rows), len(HIERARCHY_FIELDS)), -1, dtype=np.int32)
+    labels = [[] for _ in HIERARCHY_FIELDS]
+    ranges = [[] for _ in HIERARCHY_FIELDS]
+    for level, field in enumerate(HIERARCHY_FIELDS):
+        ids = {}
+        for row_idx, row in enumerate(rows):
+            label = row["metadata"].get(field)
+            if not label:
+                continue
+            node = ids.get(label)
+            if node is None:
+                node = ids[label] = len(labels[level])
+                labels[level].append(label)
+                ranges[level].append([row_idx, row_idx + 1])
+            elif ranges[level][node] is not None:
+                # 同一标签挂在不同上级下时行不连续，该节点退化为按 hierarchy.npy 生成掩码
+                start, end = ranges[level][node]
+                ranges[level][node] = [start, row_idx + 1] if end == row_idx else None
+            node_ids[row_idx, level] = node
+
+    tmp_dir = f"{out_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), matrix)
+    with open(os.path.join(tmp_dir, "metadata.jsonl"), "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    np.save(os.path.join(tmp_dir, "hierarchy.npy"), node_ids)
+    with open(os.path.join(tmp_dir, "hierarchy.json"), "w", encoding="utf-8") as f:
+        json.dump({"fields": list(HIERARCHY_FIELDS), "labels": labels, "ranges": ranges}, f, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, "source.json"), "w", encoding="utf-8") as f:
+        json.dump({"format": NUMPY_FORMAT, "count": len(rows),
+                   "chroma": _chroma_stamp(persist_dir) if persist_dir else None}, f)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+QUANTIZATIONS = ("int8", "float16")
+
+
+def _quantized_files(path: str, quantization: str) -> List[str]:
+    if quantization == "int8":
+        return [os.path.join(path, "vectors.int8.npy"), os.path.join(path, "scales.npy")]
+    if quantization == "float16":
+        return [os.path.join(path, "vectors.float16.npy")]
+    raise ValueError(f"不支持的量化格式: {quantization}（可选 {QUANTIZATIONS}）")
+
+
+def quantize_numpy_backend(path: str, quantization: str) -> List[str]:
+    """
+    由导出目录中的 vectors.npy 生成量化矩阵（已存在则直接返回），行序与 vectors.npy 相同：
+      int8     vectors.int8.npy + scales.npy：每一维按该维最大绝对值缩放到 [-127, 127]，
+               scales.npy 为 float32 的逐维缩放系数（x ≈ q * scale）
+      float16  vectors.float16.npy
+    只需检索、不需精确重排的节点可只拷贝量化文件、metadata.jsonl、hierarchy.* 与 source.json（不含 vectors.npy）。
+    """
+    files = _quantized_files(path, quantization)
+    if all(os.path.exists(f) for f in files):
+        return files
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    tmp = f".tmp{os.getpid()}.npy"
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=0).astype(np.float32) / 127 if len(vectors) else \
+            np.ones(vectors.shape[1], dtype=np.float32)
+        scales[scales == 0] = 1
+        quantized = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), QUANTIZED_SCAN_BLOCK):
+            block = np.asarray(vectors[start:start + QUANTIZED_SCAN_BLOCK]) / scales
+            quantized[start:start + QUANTIZED_SCAN_BLOCK] = np.clip(np.rint(block), -127, 127)
+        arrays = [quantized, scales]
+    else:
+        arrays = [np.asarray(vectors, dtype=np.float16)]
+    for f, array_ in zip(files, arrays):
+        np.save(f[:-len(".npy")] + tmp, array_)
+    for f in files:
+        os.replace(f[:-len(".npy")] + tmp, f)
+    return files
+
+
+class _MetadataIndex:
+    """
+    按元数据过滤行（NumpyVectorBackend 与 LexicalIndex 共用）。子类提供 metadatas 与 _all_rows，并初始化 _field_rows。
+    where 语法同 Chroma：字段等值、$eq / $ne / $in / $nin 及 $and / $or。
+    """
+
+    def _field_index(self, field: str) -> Dict:
+        index = self._field_rows.get(field)
+        if index is None:
+            groups = {}
+            for row, metadata in enumerate(self.metadatas):
+                groups.setdefault(metadata.get(field), []).append(row)
+            index = {value: np.asarray(rows, dtype=np.int64) for value, rows in groups.items()}
+            self._field_rows[field] = index
+        return index
+
+    def _match(self, where: Dict) -> np.ndarray:
+        """过滤条件 -> 升序行号数组"""
+        empty = self._all_rows[:0]
+        rows = None
+        for field, cond in where.items():
+            if field == "$and":
+                matched = self._all_rows
+                for sub in cond:
+                    matched = np.intersect1d(matched, self._match(sub), assume_unique=True)
+            elif field == "$or":
+                matched = empty
+                for sub in cond:
+                    matched = np.union1d(matched, self._match(sub))
+            else:
+                index = self._field_index(field)
+                op, value = next(iter(cond.items())) if isinstance(cond, dict) else ("$eq", cond)
+                if op in ("$eq", "$ne"):
+                    matched = index.get(value, empty)
+                elif op in ("$in", "$nin"):
+                    matched = np.unique(np.concatenate([index.get(v, empty) for v in value] or [empty]))
+                else:
+                    raise ValueError(f"不支持的过滤条件: {op}")
+                if op in ("$ne", "$nin"):
+                    matched = np.setdiff1d(self._all_rows, matched, assume_unique=True)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return self._all_rows if rows is None else rows
+
+
+class NumpyVectorBackend(_MetadataIndex):
+    """
+    精确暴力检索：整库向量矩阵（ICD-10-fix 约 4.5 万条 × 1024 维，float32 约 180 MB）mmap 加载，
+    一次矩阵乘 + argpartition 得到精确 top-k；多条 query 合成一次矩阵-矩阵乘。
+    实现 ICDRetriever 用到的 Chroma 接口子集（similarity_search_with_score / get / _collection.query / count），
+    距离同 Chroma 的 cosine 空间（1 - 余弦相似度），返回结构与 Chroma 路径相同。
+    where 支持字段等值、$eq / $ne / $in / $nin 及 $and / $or；各字段的 取值 -> 行号 索引首次用到时建立。
+    按章节 / 类目 / 亚目等值过滤（可用 $and 组合）直接由导出时预计算的节点行区间得到矩阵切片，不扫描元数据。
+    quantization 为 "int8" / "float16" 时在量化矩阵上检索（int8 约为 float32 的 1/4，float16 为 1/2），
+    rescore 时取 k * RESCORE_FACTOR 个候选，按 float32 矩阵（mmap，只读候选行）精确重排后返回前 k 个，
+    距离为 float32 的精确值；不重排时距离为量化矩阵上的近似值。目录中没有 vectors.npy 时不重排。
+    """
+
+    def __init__(self, path: str, embedding_function=None, where_cache_size: int = 4096,
+                 quantization: Optional[str] = None, rescore: bool = True):
+        self.path = path
+        self.embedding_function = embedding_function or get_embeddings()
+        float_file = os.path.join(path, "vectors.npy")
+        self.vectors = np.load(float_file, mmap_mode="r") if os.path.exists(float_file) else None
+        self.quantization = quantization
+        self.scales = None
+        if quantization:
+            files = quantize_numpy_backend(path, quantization)
+            self.qvectors = np.load(files[0], mmap_mode="r")
+            if quantization == "int8":
+                self.scales = np.load(files[1])
+        else:
+            if self.vectors is None:
+                raise FileNotFoundError(f"{float_file} 不存在（只有量化矩阵时需指定 quantization）")
+            self.qvectors = self.vectors
+        self.rescore = bool(quantization) and rescore and self.vectors is not None
+        self.ids, self.metadatas, self.documents = [], [], []
+        with open(os.path.join(path, "metadata.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                self.ids.append(row["id"])
+                self.metadatas.append(row["metadata"])
+                self.documents.append(row["document"])
+        self._all_rows = np.arange(len(self.ids), dtype=np.int64)
+        self.node_ids = np.load(os.path.join(path, "hierarchy.npy"), mmap_mode="r")
+        with open(os.path.join(path, "hierarchy.json"), encoding="utf-8") as f:
+            hierarchy = json.load(f)
+        # 字段 -> {标签: (层级序号, 节点 id, 行区间或 None)}
+        self._nodes = {field: {label: (level, node, span) for node, (label, span)
+                               in enumerate(zip(hierarchy["labels"][level], hierarchy["ranges"][level]))}
+                       for level, field in enumerate(hierarchy["fields"])}
+        self._field_rows = {}  # 字段 -> {取值: 行号数组}
+        self._id_rows = None  # id -> 行号（get(ids=...) 首次用到时建立）
+        self._where_rows = OrderedDict()  # 过滤条件 -> 行号数组（LRU）
+        self.where_cache_size = where_cache_size
+        self._lock = threading.Lock()
+        self._collection = self
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _node_scope(self, where: Dict):
+        """
+        仅由层级字段等值条件（可 $and 组合）构成的过滤 -> 行区间 slice 或掩码行号；其他条件返回 None。
+        行区间之间取交集即可；不连续的节点由 hierarchy.npy 生成掩码。
+        """
+        conds = where["$and"] if set(where) == {"$and"} else [{field: cond} for field, cond in where.items()]
+        start, end, masks = 0, len(self.ids), []
+        for cond in conds:
+            if len(cond) != 1:
+                return None
+            (field, value), = cond.items()
+            if isinstance(value, dict):
+                if set(value) != {"$eq"}:
+                    return None
+                value = value["$eq"]
+            if field not in self._nodes:
+                return None
+            node = self._nodes[field].get(value)
+            if node is None:
+                return slice(0, 0)
+            level, node_id, span = node
+            if span is None:
+                masks.append(np.flatnonzero(np.asarray(self.node_ids[:, level]) == node_id))
+            else:
+                start, end = max(start, span[0]), min(end, span[1])
+        end = max(start, end)
+        if not masks:
+            return slice(start, end)
+        rows = self._all_rows[start:end]
+        for mask in masks:
+            rows = np.intersect1d(rows, mask, assume_unique=True)
+        return rows
+
+    def _rows(self, where: Optional[Dict]):
+        """
+        过滤后的行：None 表示全库，slice 为连续行区间（层级过滤），否则为升序行号数组；
+        同一过滤条件（如同一章节）反复出现，结果按 LRU 缓存
+        """
+        if not where:
+            return None
+        scope = self._node_scope(where)
+        if isinstance(scope, slice):
+            return scope
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            rows = self._where_rows.get(key)
+            if rows is not None:
+                self._where_rows.move_to_end(key)
+                return rows
+        rows = self._match(where) if scope is None else scope
+        with self._lock:
+            self._where_rows[key] = rows
+            while len(self._where_rows) > self.where_cache_size:
+                self._where_rows.popitem(last=False)
+        return rows
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[Dict] = None,
+              include=("metadatas", "documents", "distances")) -> Dict:
+        """同 Chroma collection.query：每条 query 一组按距离升序的结果"""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+        rows = self._rows(where)
+        matrix = self.qvectors if rows is None else self.qvectors[rows]
+        result = {"ids": [], "metadatas": [], "documents": [], "distances": []}
+        k = min(n_results, matrix.shape[0])
+        if k <= 0:
+            for field in result:
+                result[field] = [[] for _ in queries]
+            return result
+
+        scores = self._scores(queries, matrix)
+        depth = min(k * RESCORE_FACTOR, matrix.shape[0]) if self.rescore else k
+        top = np.argpartition(-scores, depth - 1, axis=1)[:, :depth]
+        for q in range(len(queries)):
+            candidates = top[q]
+            if rows is None:
+                picked = candidates
+            elif isinstance(rows, slice):
+                picked = candidates + rows.start
+            else:
+                picked = rows[candidates]
+            if self.rescore:
+                # 候选行升序读取 float32 矩阵（mmap 顺序读），精确相似度重排
+                by_row = np.argsort(picked, kind="stable")
+                picked, candidates = picked[by_row], candidates[by_row]
+                exact = np.asarray(self.vectors[picked]) @ queries[q]
+            else:
+                exact = scores[q, candidates]
+            order = np.argsort(-exact, kind="stable")[:k]
+            picked = picked[order]
+            result["ids"].append([self.ids[i] for i in picked])
+            result["metadatas"].append([self.metadatas[i] for i in picked])
+            result["documents"].append([self.documents[i] for i in picked])
+            result["distances"].append((1 - exact[order]).tolist())
+        return result
+
+    def _scores(self, queries: np.ndarray, matrix) -> np.ndarray:
+        """(query 数, 行数) 的相似度；量化矩阵按块转入同一个 float32 缓冲区计算，不整体展开"""
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        if self.scales is not None:
+            # q · (x_int8 * scale) = (q * scale) · x_int8
+            queries = queries * self.scales
+        scores = np.empty((len(queries), matrix.shape[0]), dtype=np.float32)
+        buffer = np.empty((min(QUANTIZED_SCAN_BLOCK, matrix.shape[0]), matrix.shape[1]), dtype=np.float32)
+        for start in range(0, matrix.shape[0], QUANTIZED_SCAN_BLOCK):
+            block = matrix[start:start + QUANTIZED_SCAN_BLOCK]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting="unsafe")
+            scores[:, start:start + len(block)] = queries @ converted.T
+        return scores
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[Dict] = None):
+        result = self.query([self.embedding_function.embed_query(query)], n_results=k, where=filter)
+        return [(_Document(metadata, document), distance) for metadata, document, distance
+                in zip(result["metadatas"][0], result["documents"][0], result["distances"][0])]
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include=("metadatas", "documents")) -> Dict:
+        """同 Chroma 的 get：按 id 列表和 / 或过滤条件取条目（不做向量检索）"""
+        rows = self._rows(where)
+        rows = self._all_rows[rows] if isinstance(rows, slice) else self._all_rows if rows is None else rows
+        if ids is not None:
+            if self._id_rows is None:
+                self._id_rows = {id_: row for row, id_ in enumerate(self.ids)}
+            wanted = np.asarray(sorted({self._id_rows[i] for i in ids if i in self._id_rows}), dtype=np.int64)
+            rows = np.intersect1d(rows, wanted, assume_unique=True)
+        offset = offset or 0
+        rows = rows[offset:None if limit is None else offset + limit]
+        return {
+            "ids": [self.ids[i] for i in rows],
+            "metadatas": [self.metadatas[i] for i in rows] if "metadatas" in include else None,
+            "documents": [self.documents[i] for i in rows] if "documents" in include else None,
+        }
+
+
+def load_numpy_backend(source: str, vectorstore=None, quantization: Optional[str] = None,
+                       rescore: Optional[bool] = None) -> NumpyVectorBackend:
+    """
+    打开 source 导出的向量矩阵；尚未导出、导出格式版本不同或 Chroma 库在导出后有变化时，
+    由 vectorstore（未给出则打开 Chroma 库）重新导出。
+    quantization / rescore 默认取 NUMPY_QUANTIZATION / NUMPY_RESCORE，量化矩阵不存在时由 vectors.npy 生成
+    """
+    quantization = NUMPY_QUANTIZATION if quantization is None else quantization
+    rescore = NUMPY_RESCORE if rescore is None else rescore
+    persist_dir = os.path.join(VECTORSTORE_ROOT, source)
+    out_dir = os.path.join(NUMPY_ROOT, source)
+    source_file = os.path.join(out_dir, "source.json")
+    if os.path.exists(source_file):
+        with open(source_file, encoding="utf-8") as f:
+            info = json.load(f)
+        stamp = info.get("chroma")
+        fresh = stamp is None or stamp == _chroma_stamp(persist_dir) or not os.path.exists(persist_dir)
+        if info.get("format") == NUMPY_FORMAT and fresh:
+            return NumpyVectorBackend(out_dir, quantization=quantization, rescore=rescore)
+    if vectorstore is None:
+        vectorstore = Chroma(
+            persist_directory=persist_dir,
+            embedding_function=get_embeddings(),
+            collection_metadata={"hnsw:space": "cosine"}
+        )
+    print(f"🔄 导出 {source} 向量矩阵: {out_dir}")
+    os.makedirs(NUMPY_ROOT, exist_ok=True)
+    export_numpy_backend(vectorstore, out_dir, persist_dir)
+    return NumpyVectorBackend(out_dir, quantization=quantization, rescore=rescore)
+
+
+class CodeTable(_MetadataIndex):
+    """
+    码表 jsonl（DATA_FILES，与向量库同源，insert.py 即由其入库）在进程内的只读表：
+    每个编码一行（同一编码以最后出现的行为准，同入库时按 id 覆盖），按编码排序，行号顺序即 keyset 顺序。
+    层级过滤（章节 / 类目 / 亚目）与其他 where 条件都在内存中求出行号，不访问向量库；
+    另有 编码 -> 行号 的哈希索引（get / get_many）与各层级节点下的条目数（subtree_counts，count 用）。
+    """
+
+    def __init__(self, jsonl_path: str):
+        self.path = jsonl_path
+        items = {}
+        with open(jsonl_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "code" not in item or "name" not in item:
+                    continue
+                items[item["code"]] = item
+        self.codes = sorted(items)
+        self.metadatas = [items[code] for code in self.codes]
+        self._all_rows = np.arange(len(self.codes), dtype=np.int64)
+        self._field_rows = {}
+        self._code_rows = {code: row for row, code in enumerate(self.codes)}
+        # 字段 -> {节点标签: 该节点下的条目数}
+        self.subtree_counts = {field: {} for field in HIERARCHY_FIELDS}
+        for item in self.metadatas:
+            for field, counts in self.subtree_counts.items():
+                value = item.get(field)
+                if value is not None:
+                    counts[value] = counts.get(value, 0) + 1
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, code: str) -> Optional[Dict]:
+        row = self._code_rows.get(code)
+        return None if row is None else self.metadatas[row]
+
+    def count(self, where: Optional[Dict] = None) -> int:
+        """单个层级等值条件直接查 subtree_counts，其余条件按行号求交后计数"""
+        if not where:
+            return len(self.codes)
+        if len(where) == 1:
+            (field, value), = where.items()
+            if isinstance(value, dict) and set(value) == {"$eq"}:
+                value = value["$eq"]
+            if field in self.subtree_counts and not isinstance(value, dict):
+                return self.subtree_counts[field].get(value, 0)
+        return len(self.rows(where))
+
+    def rows(self, where: Optional[Dict] = None, start_after: Optional[str] = None) -> np.ndarray:
+        """满足 where 的行号（升序即按编码升序），只取编码大于 start_after 的部分"""
+        rows = self._match(where) if where else self._all_rows
+        if start_after is not None:
+            rows = rows[rows >= bisect.bisect_right(self.codes, start_after)]
+        return rows
+
+
+_code_tables = {}
+_code_tables_lock = threading.Lock()
+
+
+def get_code_table(source: str) -> Optional[CodeTable]:
+    """进程内共享的 source 码表（首次使用时由 DATA_FILES[source] 读入）；码表文件不存在时返回 None"""
+    if source not in _code_tables:
+        with _code_tables_lock:
+            if source not in _code_tables:
+                path = DATA_FILES.get(source)
+                if not path or not os.path.exists(path):
+                    print(f"⚠️  {source} 码表不存在: {path}，词法检索与层级过滤快速路径不可用")
+                    _code_tables[source] = None
+                else:
+                    _code_tables[source] = CodeTable(path)
+    return _code_tables[source]
+
+
+_code_table_checks = {}  # source -> (向量库文件 stat, 码表文件 stat, 校验是否通过)
+
+
+def _file_stamp(path: str) -> Optional[list]:
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def verified_code_table(source: str, vectorstore) -> Optional[CodeTable]:
+    """
+    与向量库核对过的 source 码表；不一致时返回 None（调用方回退到向量库）。
+    码表来自 DATA_FILES 的 jsonl，与实际检索的向量库（Chroma / NumPy 导出）是两份数据：
+    入库后改动了 jsonl 或重新入库，两者就可能不一致。这里核对条目数，并按编码均匀抽查 CODE_TABLE_SAMPLE 条元数据；
+    校验结果按向量库文件（Chroma 库文件；没有时为 NumPy 导出的 source.json）与码表文件的 stat 缓存，
+    都没变时不重复校验（同 NumPy 导出的过期判断）；两种向量库文件都没有时只按码表文件的 stat 缓存。
+    """
+    table = get_code_table(source)
+    if table is None:
+        return None
+    store_stamp = _chroma_stamp(os.path.join(VECTORSTORE_ROOT, source)) or \
+        _file_stamp(os.path.join(NUMPY_ROOT, source, "source.json"))
+    stamp = (store_stamp, _file_stamp(table.path))
+    checked = _code_table_checks.get(source)
+    if checked is not None and checked[:2] == stamp:
+        return table if checked[2] else None
+
+    problem = None
+    try:
+        count = vectorstore._collection.count()
+        if count != len(table):
+            problem = f"向量库 {count} 条，码表 {len(table)} 条"
+        else:
+            step = max(1, len(table) // CODE_TABLE_SAMPLE)
+            codes = table.codes[::step][:CODE_TABLE_SAMPLE]
+            stored = {meta["code"]: meta for meta in
+                      vectorstore.get(ids=codes, include=["metadatas"])["metadatas"]}
+            for code in codes:
+                # 入库时的元数据为 {"source": source, **item}（insert.py）
+                if stored.get(code) != {"source": source, **table.get(code)}:
+                    problem = f"编码 {code} 的元数据与向量库不一致"
+                    break
+    except Exception as e:
+        problem = f"校验失败: {e}"
+    if problem:
+        print(f"⚠️  {source} 码表与向量库不一致（{problem}），get_by_id / count 等改为查询向量库；请重新入库或导出")
+    _code_table_checks[source] = (stamp[0], stamp[1], problem is None)
+    return None if problem else table
+
+
+class LexicalIndex:
+    """
+    ICD 名称的字符 n-gram BM25 倒排索引，建立在 CodeTable（码表）之上，行号与码表一致。
+    每个词的倒排表为 (行号数组, 预先算好的 BM25 权重数组)，查询时只需拼接命中词的倒排表、bincount 累加，
+    不请求嵌入服务；query 中每个词只计一次。where 过滤语法同 Chroma（见 _MetadataIndex）。
+    """
+
+    def __init__(self, table: CodeTable, n: int = 2, k1: float = 1.2, b: float = 0.75):
+        self.table = table
+        self.metadatas = table.metadatas
+        self.n = n
+        postings = {}
+        lengths = []
+        for row, item in enumerate(self.metadatas):
+            grams = ngram_counts(item["name"], n)
+            lengths.append(sum(grams.values()))
+            for gram, tf in grams.items():
+                entry = postings.setdefault(gram, ([], []))
+                entry[0].append(row)
+                entry[1].append(tf)
+
+        total = len(self.metadatas)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if total and lengths.mean() > 0 else 1.0
+        self._postings = {}
+        for gram, (rows, tfs) in postings.items():
+            rows = np.asarray(rows, dtype=np.int64)
+            tf = np.asarray(tfs, dtype=np.float32)
+            idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = k1 * (1 - b + b * lengths[rows] / avg_length)
+            self._postings[gram] = (rows, (idf * tf * (k1 + 1) / (tf + norm)).astype(np.float32))
+
+    def __len__(self):
+        return len(self.metadatas)
+
+    def search(self, query: str, k: int, where: Optional[Dict] = None) -> List[tuple]:
+        """返回按 BM25 分降序的 [(行号, 分数)]，至多 k 条，只含至少命中一个词的行"""
+        hits = [self._postings[gram] for gram in ngram_counts(query, self.n) if gram in self._postings]
+        if not hits or k <= 0:
+            return []
+        rows = np.concatenate([h[0] for h in hits])
+        weights = np.concatenate([h[1] for h in hits])
+        if where:
+            keep = np.isin(rows, self.table.rows(where), assume_unique=False)
+            rows, weights = rows[keep], weights[keep]
+            if not len(rows):
+                return []
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights)
+        k = min(k, len(unique_rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return list(zip(unique_rows[top].tolist(), scores[top].tolist()))
+
+
+_lexical_indexes = {}
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index(source: str, vectorstore) -> Optional[LexicalIndex]:
+    """
+    进程内共享的 source 词法索引，只由与向量库核对一致的码表构建（见 verified_code_table）；
+    码表不存在或与向量库不一致时返回 None，该 source 不走词法检索
+    """
+    table = verified_code_table(source, vectorstore)
+    if table is None:
+        return None
+    index = _lexical_indexes.get(source)
+    if index is None or index.table is not table:
+        with _lexical_lock:
+            index = _lexical_indexes.get(source)
+            if index is None or index.table is not table:
+                index = _lexical_indexes[source] = LexicalIndex(table)
+    return index
+
+
+def _is_hierarchy_filter(where: Optional[Dict]) -> bool:
+    """过滤条件是否只由章节 / 类目 / 亚目的等值条件（可 $and 组合）构成"""
+    if not where:
+        return False
+    conds = where["$and"] if set(where) == {"$and"} else [{field: cond} for field, cond in where.items()]
+    for cond in conds:
+        if len(cond) != 1:
+            return False
+        (field, value), = cond.items()
+        if field not in HIERARCHY_FIELDS or (isinstance(value, dict) and set(value) != {"$eq"}):
+            return False
+    return True
+
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+
+_source_executors = {}
+
+
+def get_source_executor(source: str) -> ThreadPoolExecutor:
+    """
+    source 专用的检索线程池（SEARCH_WORKERS 个线程，进程内各检索器共用）。
+    每个库各用各的线程：一个库卡住时至多占满自己的线程，其他库的检索不受影响。
+    """
+    executor = _source_executors.get(source)
+    if executor is None:
+        with _search_executor_lock:
+            executor = _source_executors.get(source)
+            if executor is None:
+                executor = _source_executors[source] = ThreadPoolExecutor(
+                    max_workers=SEARCH_WORKERS, thread_name_prefix=f"icd-search-{source}")
+    return executor
+
+
+_source_stuck = {}  # source -> 调用方已超时、但仍在执行（占着线程）的查询数
+
+
+def _submit_search(source: str, fn, *args):
+    """
+    提交到 source 的线程池；该库的线程全部被超时未返回的查询占住时不再提交（返回 None），
+    直接跳过该库，避免任务在卡住的库的队列中越积越多
+    """
+    if _source_stuck.get(source, 0) >= SEARCH_WORKERS:
+        print(f"⏱️ {source} 的检索线程均被超时未返回的查询占用，本次结果不含该库")
+        return None
+    return get_source_executor(source).submit(fn, *args)
+
+
+def _abandon_search(source: str, future):
+    """调用方超时放弃 future：仍在排队的直接取消；已在执行的无法中断，记为占用线程，直到其返回"""
+    if future.cancel():
+        return
+    with _search_executor_lock:
+        _source_stuck[source] = _source_stuck.get(source, 0) + 1
+
+    def release(_):
+        with _search_executor_lock:
+            _source_stuck[source] -= 1
+    future.add_done_callback(release)
+
+
+def get_search_executor() -> ThreadPoolExecutor:
+    """异步接口（aget_by_id 等）共享的线程池（SEARCH_WORKERS 个线程）；向量检索走 get_source_executor"""
+    global _search_executor
+    if _search_executor is None:
+        with _search_executor_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="icd-search")
+    return _search_executor
+
+
 class ICDRetriever:
     """
     ICD 向量检索器（支持单 source / 多 source / 全量检索）
+    backend 为 "chroma"（默认，见 VECTOR_BACKEND）或 "numpy"（NumpyVectorBackend 精确检索）
+    metadata_index 为 True 时随向量库一起加载各 source 的码表（CodeTable，即 DATA_FILES 中的 jsonl，而非向量库本身），
+    get_by_id / get_many_by_id、层级过滤的 count 与 iter_by_filter 直接查表，不访问向量库；
+    加载时与向量库核对（见 verified_code_table），不一致的 source 不用码表。运行期间重新入库需重新创建检索器
+    各库在各自的线程池中并发检索，timeout（默认 SOURCE_TIMEOUT 秒）内未返回的 source 本次跳过
     """
-    def __init__(self, sources: Optional[Union[str, List[str]]] = None, k: int = 5):
+    def __init__(self, sources: Optional[Union[str, List[str]]] = None, k: int = 5, backend: Optional[str] = None,
+                 metadata_index: bool = True, timeout: Optional[float] = None):
         if sources is None:
             self.sources = list(DATA_FILES.keys())
         elif isinstance(sources, str):
@@ -38,23 +921,32 @@ class ICDRetriever:
             self.sources = sources
 
         self.k = k
+        self.backend = backend or VECTOR_BACKEND
+        self.timeout = SOURCE_TIMEOUT if timeout is None else timeout
         self.vectorstores = {} #向量数据库字典
         self._load_vectorstores()
+        # source -> CodeTable（码表不存在或与向量库不一致的 source 为 None，回退到向量库）
+        self.code_tables = {source: verified_code_table(source, vectorstore)
+                            for source, vectorstore in self.vectorstores.items()} if metadata_index else {}
 
     def _load_vectorstores(self):
         """惰性加载指定的向量库"""
         for source in self.sources:
             persist_dir = os.path.join(VECTORSTORE_ROOT, source)
-            if not os.path.exists(persist_dir):
+            exported = os.path.exists(os.path.join(NUMPY_ROOT, source, "source.json"))
+            if not os.path.exists(persist_dir) and not (self.backend == "numpy" and exported):
                 print(f"⚠️  向量库不存在: {persist_dir}（跳过）")
                 continue
 
             try:
-                self.vectorstores[source] = Chroma(
-                    persist_directory=persist_dir,
-                    embedding_function=get_embeddings(),
-                    collection_metadata={"hnsw:space": "cosine"}  # ✅ 保持一致：余弦相似度
-                )
+                if self.backend == "numpy":
+                    self.vectorstores[source] = load_numpy_backend(source)
+                else:
+                    self.vectorstores[source] = Chroma(
+                        persist_directory=persist_dir,
+                        embedding_function=get_embeddings(),
+                        collection_metadata={"hnsw:space": "cosine"}  # ✅ 保持一致：余弦相似度
+                    )
             except Exception as e:
                 print(f"❌ 加载 {source} 失败: {e}")
 
@@ -69,43 +961,220 @@ class ICDRetriever:
         :param filter_dict: 可选，覆盖初始化时的过滤条件
         """
         k = k or self.k
-        filter_to_use = filter_dict if filter_dict else None
-        all_results = []
+        try:
+            # query 只嵌入一次，各向量库共用同一个查询向量
+            vector = get_embeddings().embed_query(query)
+        except Exception as e:
+            print(f"❌ 嵌入失败: {e}")
+            return []
+        return self._search_vectors([vector], k, [filter_dict])[0]
 
-        for source, vectorstore in self.vectorstores.items():
+    def retrieve_many(self, queries: List[str], k: Optional[int] = None,
+                      filters: Optional[Union[Dict, List[Optional[Dict]]]] = None) -> List[List[Dict]]:
+        """
+        批量检索：全部 query 一次嵌入请求，每个向量库按过滤条件分组、每组一次 query_embeddings 调用
+        （Chroma 一次查询只能带一个 where；所有 query 共用同一 filter 时即每库一次调用）。
+        :param queries: 查询文本列表
+        :param k: 每个 query 的返回结果数
+        :param filters: 可选，所有 query 共用的过滤条件，或与 queries 等长的过滤条件列表
+        :return: 与 queries 同序，每项与 retrieve 的返回结构相同
+        """
+        if not queries:
+            return []
+        k = k or self.k
+        filters = self._normalize_filters(queries, filters)
+        try:
+            vectors = get_embeddings().embed_documents(list(queries))
+        except Exception as e:
+            print(f"❌ 批量嵌入失败: {e}")
+            return [[] for _ in queries]
+        return self._search_vectors(vectors, k, filters)
+
+    @staticmethod
+    def _normalize_filters(queries: List[str], filters) -> List[Optional[Dict]]:
+        if filters is None or isinstance(filters, dict):
+            filters = [filters] * len(queries)
+        if len(filters) != len(queries):
+            raise ValueError(f"filters 长度 ({len(filters)}) 与 queries 长度 ({len(queries)}) 不一致")
+        return filters
+
+    @staticmethod
+    def _group_filters(filters: List[Optional[Dict]]) -> List[tuple]:
+        """过滤条件相同的 query 合为一组：[(where, [query 序号])]"""
+        groups = {}
+        for idx, filter_dict in enumerate(filters):
+            where = filter_dict if filter_dict else None
+            key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+            groups.setdefault(key, (where, []))[1].append(idx)
+        return list(groups.values())
+
+    def _search_source(self, source: str, vectorstore, vectors: List[List[float]], k: int,
+                       groups: List[tuple]) -> List[List[Dict]]:
+        """单个向量库：每组过滤条件一次 query_embeddings 调用，返回与 vectors 同序、各自按相似度降序的命中"""
+        hits = [[] for _ in vectors]
+        for where, indices in groups:
             try:
-                # ✅ 传入 filter 参数
-                results = vectorstore.similarity_search_with_score(
-                    query,
-                    k=k,
-                    filter=filter_to_use  # ← 关键修改！
+                results = vectorstore._collection.query(
+                    query_embeddings=[vectors[idx] for idx in indices],
+                    n_results=k,
+                    where=where,
+                    include=["metadatas", "documents", "distances"],
                 )
-                for doc, distance in results:
-                    similarity = 1 - distance # 1-距离就是相似度
-                    all_results.append({
-                        "code": doc.metadata["code"],
-                        "name": doc.metadata["name"],
-                        "source": source,
-                        "score": distance,
-                        "base_info": doc.page_content,
-                        "similarity": similarity
-                    })
             except Exception as e:
                 print(f"❌ {source} 检索失败: {e}")
+                continue
+            for idx, metadatas, documents, distances in zip(
+                    indices, results["metadatas"], results["documents"], results["distances"]):
+                hits[idx] = [self._hit(source, metadata, document, distance)
+                             for metadata, document, distance in zip(metadatas, documents, distances)]
+        return hits
 
-        # 排序 + 去重
-        all_results.sort(key=lambda x: x["similarity"], reverse=True)
+    def _search_vectors(self, vectors: List[List[float]], k: int, filters: List[Optional[Dict]]) -> List[List[Dict]]:
+        """
+        已嵌入的查询向量 -> 各向量库在各自的线程池中并发检索（每库按过滤条件分组、每组一次 query_embeddings 调用），
+        再按 query 归并各库结果，与输入同序。只有一个向量库时同样受 timeout 限制。
+        """
+        futures = self._submit_sources(vectors, k, filters)
+        done, not_done = wait(futures, timeout=self.timeout) if futures else (set(), set())
+        for future in not_done:
+            _abandon_search(futures[future], future)
+            print(f"⏱️ {futures[future]} 检索超时（{self.timeout}s），本次结果不含该库")
+        per_source = [future.result() for future in futures if future in done]
+        return [self._merge([hits[idx] for hits in per_source], k) for idx in range(len(vectors))]
+
+    def _submit_sources(self, vectors: List[List[float]], k: int, filters: List[Optional[Dict]]) -> Dict:
+        """各库的检索任务提交到各自的线程池：{future: source}（线程全被占住的库不提交）"""
+        groups = self._group_filters(filters)
+        futures = {}
+        for source, vectorstore in self.vectorstores.items():
+            future = _submit_search(source, self._search_source, source, vectorstore, vectors, k, groups)
+            if future is not None:
+                futures[future] = source
+        return futures
+
+    async def aretrieve_many(self, queries: List[str], k: Optional[int] = None,
+                             filters: Optional[Union[Dict, List[Optional[Dict]]]] = None) -> List[List[Dict]]:
+        """
+        retrieve_many 的协程版本：嵌入请求走异步 HTTP，向量库查询（Chroma / NumPy）在各库的线程池中执行，
+        单个事件循环即可同时驱动大量会话。参数与返回同 retrieve_many。
+        """
+        if not queries:
+            return []
+        k = k or self.k
+        filters = self._normalize_filters(queries, filters)
+        try:
+            vectors = await get_embeddings().aembed_documents(list(queries))
+        except Exception as e:
+            print(f"❌ 批量嵌入失败: {e}")
+            return [[] for _ in queries]
+        # 各库分别提交到各自的线程池（与 _search_vectors 相同），在事件循环中等待
+        futures = self._submit_sources(vectors, k, filters)
+        waiters = {asyncio.wrap_future(future): future for future in futures}
+        done, not_done = await asyncio.wait(waiters, timeout=self.timeout) if waiters else (set(), set())
+        for waiter in not_done:
+            future = waiters[waiter]
+            _abandon_search(futures[future], future)
+            waiter.cancel()
+            print(f"⏱️ {futures[future]} 检索超时（{self.timeout}s），本次结果不含该库")
+        per_source = [waiter.result() for waiter in waiters if waiter in done]
+        return [self._merge([hits[idx] for hits in per_source], k) for idx in range(len(vectors))]
+
+    async def aretrieve(self, query: str, k: Optional[int] = None, filter_dict: Optional[Dict] = None) -> List[Dict]:
+        """retrieve 的协程版本（经由 aretrieve_many，结果同 retrieve）"""
+        return (await self.aretrieve_many([query], k, filter_dict))[0]
+
+    async def aget_by_id(self, code: str) -> Optional[Dict]:
+        """get_by_id 的协程版本（在共享线程池中执行）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_search_executor(), self.get_by_id, code)
+
+    @staticmethod
+    def _hit(source: str, metadata: Dict, document: str, distance: float) -> Dict:
+        return {
+            "code": metadata["code"],
+            "name": metadata["name"],
+            "source": source,
+            "score": distance,
+            "base_info": document,
+            "similarity": 1 - distance  # 1-距离就是相似度
+        }
+
+    @staticmethod
+    def _merge(ranked_lists: List[List[Dict]], k: int) -> List[Dict]:
+        """
+        各向量库已按相似度降序的结果做 k 路归并，边归并边去重（同一编码只保留相似度最高的一条），
+        凑够 k 个编码即停止；相似度相同时按向量库顺序，与整体排序后去重的结果一致。
+        """
         seen_codes, unique_results = set(), []
-        for item in all_results:
+        for item in heapq.merge(*ranked_lists, key=lambda x: -x["similarity"]):
             if item["code"] not in seen_codes:
                 seen_codes.add(item["code"])
                 unique_results.append(item)
+                if len(unique_results) >= k:
+                    break
+        return unique_results
 
+    def lexical_search(self, query: str, k: Optional[int] = None, filter_dict: Optional[Dict] = None) -> List[Dict]:
+        """
+        只用词法索引（字符 n-gram BM25）检索，不请求嵌入服务；码表与向量库不一致的 source 不参与（见 get_lexical_index）。
+        结果结构同 retrieve，另加 lexical_score；similarity / score 为向量检索的指标，这里分别为 0.0 / None。
+        """
+        k = k or self.k
+        all_results = []
+        for source, vectorstore in self.vectorstores.items():
+            index = get_lexical_index(source, vectorstore)
+            if index is None:
+                continue
+            for row, score in index.search(query, k, filter_dict if filter_dict else None):
+                metadata = index.metadatas[row]
+                all_results.append({
+                    "code": metadata["code"],
+                    "name": metadata["name"],
+                    "source": source,
+                    "score": None,
+                    "base_info": metadata["name"],
+                    "similarity": 0.0,
+                    "lexical_score": score
+                })
+        all_results.sort(key=lambda x: x["lexical_score"], reverse=True)
+        seen_codes, unique_results = set(), []
+        for item in all_results:
+            if item["code"] not in seen_codes:
+                seen_codes.add(item["code"])
+                unique_results.append(item)
         return unique_results[:k]
 
-    def hybrid_search(self, query: str, k: Optional[int] = None, alpha: float = 0.5) -> List[Dict]:
-        """混合检索（预留接口）"""
-        return self.retrieve(query, k)
+    def hybrid_search(self, query: str, k: Optional[int] = None, alpha: Optional[float] = None,
+                      filter_dict: Optional[Dict] = None) -> List[Dict]:
+        """
+        混合检索：向量检索与词法检索（病原体名、解剖部位如 "伞部"、"O1群" 等精确字面信号）各取 HYBRID_DEPTH 个候选后融合。
+        :param alpha: None 时按排名倒数融合（RRF）；给出时按 alpha * 相似度 + (1 - alpha) * 归一化 BM25 分加权
+        :return: 按融合分 hybrid_score 降序，结构同 retrieve，另加 lexical_score / hybrid_score；
+                 仅词法命中的条目 similarity 为 0.0、score 为 None
+        """
+        k = k or self.k
+        depth = max(k, HYBRID_DEPTH)
+        dense = self.retrieve(query, depth, filter_dict)
+        lexical = self.lexical_search(query, depth, filter_dict)
+
+        fused = {}
+        for item in dense:
+            fused[item["code"]] = dict(item, lexical_score=0.0, hybrid_score=0.0)
+        for item in lexical:
+            entry = fused.setdefault(item["code"], dict(item, hybrid_score=0.0))
+            entry["lexical_score"] = item["lexical_score"]
+
+        if alpha is None:
+            for ranked in (dense, lexical):
+                for rank, item in enumerate(ranked):
+                    fused[item["code"]]["hybrid_score"] += 1.0 / (RRF_K + rank + 1)
+        else:
+            top_lexical = lexical[0]["lexical_score"] if lexical else 0.0
+            for entry in fused.values():
+                lexical_part = entry["lexical_score"] / top_lexical if top_lexical else 0.0
+                entry["hybrid_score"] = alpha * entry["similarity"] + (1 - alpha) * lexical_part
+
+        return sorted(fused.values(), key=lambda x: x["hybrid_score"], reverse=True)[:k]
 
     def get_stats(self) -> Dict:
         """获取库统计信息"""
@@ -123,20 +1192,45 @@ class ICDRetriever:
     # 新增的函数方法
     def get_by_id(self, code: str) -> Optional[Dict]:
         """通过 code 直接获取一条item"""
+        return self.get_many_by_id([code]).get(code)
+
+    def get_many_by_id(self, codes: List[str]) -> Dict[str, Dict]:
+        """
+        批量按 code 取 item：返回 {code: 元数据}，找不到的 code 不出现在结果中；
+        多个 source 中都有的 code 以 self.vectorstores 中靠前的为准（同 get_by_id）。
+        有码表的 source 直接查哈希索引，其余 source 对剩下的 code 发一次 get(ids=...)（入库时 id 即 code）。
+        """
+        found = {}
+        pending = list(dict.fromkeys(codes))
         for source, vectorstore in self.vectorstores.items():
-            try:
-                result = vectorstore.get(where={"code": code}, limit=1)
-                if result and result['metadatas']:
-                    return result['metadatas'][0]
-            except Exception as e:
-                print(f"❌ 在 {source} 中通过ID获取失败: {e}")
-        return None
-    
-    
+            if not pending:
+                break
+            table = self.code_tables.get(source)
+            if table is not None:
+                for code in pending:
+                    item = table.get(code)
+                    if item is not None:
+                        # 与入库时的元数据一致（insert.py: {"source": source, **item}）
+                        found[code] = {"source": source, **item}
+            else:
+                try:
+                    result = vectorstore.get(ids=pending, include=["metadatas"])
+                    for meta in result["metadatas"]:
+                        found.setdefault(meta["code"], meta)
+                except Exception as e:
+                    print(f"❌ 在 {source} 中通过ID获取失败: {e}")
+            pending = [code for code in pending if code not in found]
+        return found
+
     def count(self, filter_dict: Dict) -> int:
-        """根据filter过滤条件统计item数量"""
+        """根据filter过滤条件统计item数量（层级过滤在有码表时直接查 subtree_counts）"""
         total_count = 0
+        hierarchy = _is_hierarchy_filter(filter_dict)
         for source, vectorstore in self.vectorstores.items():
+            table = self.code_tables.get(source)
+            if table is not None and hierarchy:
+                total_count += table.count(filter_dict)
+                continue
             try:
                 results = vectorstore.get(where=filter_dict, include=[]) # include=[] 表示只获取id，提高效率
                 total_count += len(results.get('ids', []))
@@ -145,31 +1239,51 @@ class ICDRetriever:
         return total_count
     
     def get_all_by_filter(self, filter_dict: Dict) -> List[Dict]:
-        """根据 filter 获取所有匹配的item"""
-        all_items = []
-        seen_codes = set()
-        for source, vectorstore in self.vectorstores.items():
-            try:
-                # ChromaDB 的 get 方法有上限，需要分批获取
-                offset = 0
-                limit = 1000 # 每次获取1000条
-                while True:
-                    results = vectorstore.get(where=filter_dict, limit=limit, offset=offset, include=["metadatas"])
-                    if not results or not results['metadatas']:
-                        break
-                    
-                    for meta in results['metadatas']:
-                        if meta['code'] not in seen_codes:
-                            all_items.append(meta)
-                            seen_codes.add(meta['code'])
-                    
-                    if len(results['metadatas']) < limit:
-                        break
-                    offset += limit
+        """根据 filter 获取所有匹配的item（按编码排序，见 iter_by_filter）"""
+        return list(self.iter_by_filter(filter_dict))
+
+    def iter_by_filter(self, filter_dict: Optional[Dict] = None, batch_size: int = 1000,
+                       use_code_table: bool = True):
+        """
+        按编码顺序（keyset）流式返回满足 filter 的 item 元数据，多个向量库之间按编码归并去重。
+        - 仅含章节 / 类目 / 亚目等值条件的过滤（use_code_table 且加载了码表时）直接由码表（CodeTable）回答，不访问向量库；
+        - NumPy 后端的元数据本就在内存中，直接按行号取；
+        - Chroma 只取一次匹配的 id（include=[]，不含元数据），排序后按 id 分批取元数据，
+          每批只按 id 查找，避免 offset 分页重复扫描已跳过的行，内存中只有 id 列表与一批元数据。
+        """
+        streams = [self._iter_source(source, vectorstore, filter_dict if filter_dict else None,
+                                     batch_size, use_code_table)
+                   for source, vectorstore in self.vectorstores.items()]
+        last_code = None
+        for meta in heapq.merge(*streams, key=lambda meta: meta["code"]):
+            if meta["code"] != last_code:
+                last_code = meta["code"]
+                yield meta
 
+    def _iter_source(self, source: str, vectorstore, where: Optional[Dict], batch_size: int, use_code_table: bool):
+        """单个向量库中满足 where 的元数据，按编码升序"""
+        try:
+            table = self.code_tables.get(source) if use_code_table and _is_hierarchy_filter(where) else None
+            if table is not None:
+                for row in table.rows(where):
+                    # 与入库时的元数据一致（insert.py: {"source": source, **item}）
+                    yield {"source": source, **table.metadatas[row]}
+                return
+            if isinstance(vectorstore, NumpyVectorBackend):
+                rows = vectorstore.get(where=where, include=["metadatas"])["metadatas"]
+                yield from sorted(rows, key=lambda meta: meta["code"])
+                return
+            ids = sorted(vectorstore.get(where=where, include=[])["ids"])
+        except Exception as e:
+            print(f"❌ 在 {source} 中按filter获取全部数据失败: {e}")
+            return
+        for start in range(0, len(ids), batch_size):
+            try:
+                results = vectorstore.get(ids=ids[start:start + batch_size], include=["metadatas"])
             except Exception as e:
                 print(f"❌ 在 {source} 中按filter获取全部数据失败: {e}")
-        return all_items
+                return
+            yield from sorted(results["metadatas"], key=lambda meta: meta["code"])
     
 
 
@@ -4,6 +4,7 @@ import os
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from ICD_retrival import get_embeddings
 
 # === 配置路径 ===
 
@@ -143,6 +144,12 @@ def main():
                 write_result_to_jsonl(output, 'XXX.jsonl')
 
     print(f"✅ 并发处理完成！成功: {success_count} 条，结果追加至: {out_file}")
+    stats = tool_icd.get_rule_manager().cache_stats()
+    print(f"📊 规则文本缓存: 命中 {stats['hits']} / {stats['hits'] + stats['misses']} 次"
+          f"（命中率 {stats['hit_rate']:.1%}），缓存 {stats['entries']} 条")
+    stats = get_embeddings().cache_stats()
+    print(f"📊 查询向量缓存: 内存命中 {stats['memory_hits']}，磁盘命中 {stats['disk_hits']}，未命中 {stats['misses']}"
+          f"（命中率 {stats['hit_rate']:.1%}），请求嵌入服务 {stats['api_calls']} 次")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
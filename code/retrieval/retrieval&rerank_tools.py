@@ -2,6 +2,10 @@ import os,json
 import base64,mimetypes
 from ICD_retrival import ICDRetriever as ICDRetriever2
 import re,ast
+import threading
+from collections import OrderedDict
+from rule_selector import CODE_PATTERN, CODE_RE, normalize_code, select_rules
+from icd_keys import KeyIndex
 
 def extract_operations(text,required_fields):
     """
@@ -290,36 +294,91 @@ def merge_round_robin_advanced(sub_lists):
 
     return merged
 
+# 规则正文中的编码范围，如 "B20-B24"、"T36–T50"（单个编码的写法与规范化见 rule_selector）
+_RULE_RANGE_RE = re.compile(f"({CODE_PATTERN})\\s*[-－—–~～至到]\\s*({CODE_PATTERN})")
+
+
+def _category_range(start, end):
+    """编码范围覆盖的三位类目键：("B20", "B24") -> B20..B24，跨字母的范围（如 A00-B99）逐字母展开"""
+    keys = []
+    for letter in range(ord(start[0]), ord(end[0]) + 1):
+        lo = int(start[1:3]) if letter == ord(start[0]) else 0
+        hi = int(end[1:3]) if letter == ord(end[0]) else 99
+        keys += [f"{chr(letter)}{n:02d}" for n in range(lo, hi + 1)]
+    return keys
+
+
 class ICDRuleManager:
-    def __init__(self, level1_path, level2_path, level3_path):
+    def __init__(self, level1_path, level2_path, level3_path, cache_size=4096, keys=None):
         """
         初始化：加载三个层级的规则文件到内存字典中。
+        get_rules_text 的结果按候选涉及的 (章节, 类目, 亚目) key 集合缓存（LRU，cache_size 条）。
+        keys 为章节 / 类目 / 亚目标签的规范化表（KeyIndex，可传入知识库快照的 keys 共享），默认新建。
         """
         self.rules_l1 = self._load_jsonl(level1_path, key_field="chapter")
         self.rules_l2 = self._load_jsonl(level2_path, key_field="sub_chapter")
         self.rules_l3 = self._load_jsonl(level3_path, key_field="de_chapter")
         
-        # 预生成数字映射表 (0-99)，用于将 "第18章" 转为 "第十八章"
-        self.num_map = self._generate_num_map()
-
-    def _generate_num_map(self):
-        """生成阿拉伯数字到中文数字的映射 (支持0-99)"""
-        chars = '零一二三四五六七八九十'
-        mapping = {}
-        for i in range(100):
-            s_i = str(i)
-            if i <= 10:
-                mapping[s_i] = chars[i]
-            elif i < 20:
-                mapping[s_i] = '十' + chars[i % 10]
-            else:
-                tens = chars[i // 10]
-                unit = chars[i % 10]
-                if unit == '零':
-                    mapping[s_i] = f"{tens}十"
-                else:
-                    mapping[s_i] = f"{tens}十{unit}"
-        return mapping
+        # 标签 -> 规则 key 的规范化表："第18章“...”" -> "第十八章"，"R16 肝大和脾大" -> "R16"
+        self.keys = keys if keys is not None else KeyIndex()
+
+        # 倒排索引：编码 -> 引用它的规则
+        self._build_reference_index()
+
+        # get_rules_text 缓存：许多病人的候选列表落在同样的章节 / 类目 / 亚目上
+        self.cache_size = cache_size
+        self._text_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _build_reference_index(self):
+        """
+        建立 编码 -> 规则 的倒排索引，来源为每条规则的 abstart_code（编码或章节 key），
+        以及 rule_content 中出现的编码；编码范围（如 "B20-B24"）按三位类目键展开到 category_refs。
+        rule_id 在文件中并不唯一（同一 id 可能对应不同正文），规则按 (rule_id, 正文) 去重。
+        """
+        self.reference_rules = []   # 序号 -> {"rule_id", "level", "key", "rule_content"}
+        self.code_refs = {}         # 规范化编码 / 章节 key -> {规则序号}
+        self.category_refs = {}     # 三位类目键 -> {规则序号}（来自编码范围）
+        seen = {}
+        tables = ((1, self.rules_l1, "chapter_rules"), (2, self.rules_l2, "category_rules"),
+                  (3, self.rules_l3, "subcategory_rules"))
+        for level, table, rule_field in tables:
+            for key, rule_data in table.items():
+                for r in rule_data.get(rule_field, []):
+                    content = r.get("rule_content", "").strip()
+                    if (r.get("rule_id"), content) in seen:
+                        continue
+                    idx = seen[(r.get("rule_id"), content)] = len(self.reference_rules)
+                    self.reference_rules.append(
+                        {"rule_id": r.get("rule_id"), "level": level, "key": key, "rule_content": content})
+                    for code in r.get("abstart_code", []):
+                        code = normalize_code(code) if CODE_RE.fullmatch(code) else code
+                        self.code_refs.setdefault(code, set()).add(idx)
+                    for code in CODE_RE.findall(content):
+                        self.code_refs.setdefault(normalize_code(code), set()).add(idx)
+                    for start, end in _RULE_RANGE_RE.findall(content):
+                        for cat in _category_range(normalize_code(start), normalize_code(end)):
+                            self.category_refs.setdefault(cat, set()).add(idx)
+
+    def find_referencing_rules(self, codes):
+        """
+        候选编码（亦可为章节 key）集合 -> 引用了其中任一编码的全部规则（一次集合并），按文件顺序返回。
+        编码同时按其亚目（如 A16.2）、类目（如 A16）前缀及所在的编码范围匹配。
+        """
+        hits = set()
+        for code in codes:
+            if not code:
+                continue
+            hits |= self.code_refs.get(code, set())
+            code = normalize_code(code)
+            if not CODE_RE.match(code):
+                continue
+            for key in {code, code[:5], code[:3]}:
+                hits |= self.code_refs.get(key, set())
+            hits |= self.category_refs.get(code[:3], set())
+        return [self.reference_rules[idx] for idx in sorted(hits)]
 
     def _load_jsonl(self, path, key_field):
         """读取 jsonl 文件并建立索引"""
@@ -344,28 +403,6 @@ class ICDRuleManager:
             print(f"读取文件 {path} 出错: {e}")
         return data_map
 
-    def _get_chapter_key(self, raw_str):
-        """
-        输入: "第18章“症状...”"
-        输出: "第十八章" (匹配 level_1.jsonl 的 key)
-        """
-        if not raw_str: return ""
-        # 提取 "第" 和 "章" 之间的数字
-        match = re.search(r"第(\d+)章", raw_str)
-        if match:
-            num = match.group(1)
-            cn_num = self.num_map.get(num, num)
-            return f"第{cn_num}章"
-        return raw_str.split("“")[0] # 兜底策略
-
-    def _get_code_key(self, raw_str):
-        """
-        输入: "R16 肝大和脾大..."
-        输出: "R16"
-        """
-        if not raw_str: return ""
-        return raw_str.split(" ")[0].strip()
-
     def get_rules_text(self, items):
         """
         主函数：输入 items 列表，返回格式化的规则文本
@@ -380,11 +417,67 @@ class ICDRuleManager:
 
         for item in items:
             if item.get('章节'):
-                chapters.add(self._get_chapter_key(item['章节']))
+                chapters.add(self.keys.key(item['章节']))
+            if item.get('类目'):
+                categories.add(self.keys.key(item['类目']))
+            if item.get('亚目'):
+                sub_categories.add(self.keys.key(item['亚目']))
+
+        # 输出只取决于三个 key 集合（均排序后输出），以其为缓存键
+        key = (frozenset(chapters), frozenset(categories), frozenset(sub_categories))
+        with self._cache_lock:
+            text = self._text_cache.get(key)
+            if text is not None:
+                self._text_cache.move_to_end(key)
+                self.cache_hits += 1
+                return text
+            self.cache_misses += 1
+        text = self._render_rules_text(chapters, categories, sub_categories)
+        with self._cache_lock:
+            self._text_cache[key] = text
+            while len(self._text_cache) > self.cache_size:
+                self._text_cache.popitem(last=False)
+        return text
+
+    def cache_stats(self):
+        """get_rules_text 的缓存命中情况"""
+        total = self.cache_hits + self.cache_misses
+        return {"entries": len(self._text_cache), "hits": self.cache_hits, "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / total if total else 0.0}
+
+    def get_budgeted_rules_text(self, items, query, token_budget):
+        """
+        与 get_rules_text 相同的版式，但只保留 token_budget 内与 query（病历、候选名称）BM25 相关度最高的规则；
+        abstart_code 或正文引用了任一候选编码的规则始终保留。token_budget 为 None 时等同 get_rules_text。
+        """
+        if token_budget is None or not items:
+            return self.get_rules_text(items)
+        chapters, categories, sub_categories, codes = set(), set(), set(), set()
+        for item in items:
+            codes.add(item.get('code', ''))
+            if item.get('章节'):
+                chapters.add(self.keys.key(item['章节']))
             if item.get('类目'):
-                categories.add(self._get_code_key(item['类目']))
+                categories.add(self.keys.key(item['类目']))
             if item.get('亚目'):
-                sub_categories.add(self._get_code_key(item['亚目']))
+                sub_categories.add(self.keys.key(item['亚目']))
+        rules = []
+        for keys, table, rule_field in ((chapters, self.rules_l1, "chapter_rules"),
+                                        (categories, self.rules_l2, "category_rules"),
+                                        (sub_categories, self.rules_l3, "subcategory_rules")):
+            for key in sorted(keys):
+                rules += table.get(key, {}).get(rule_field, [])
+        query = "\n".join([query] + [str(item.get('name', '')) for item in items])
+        kept = select_rules(rules, query, token_budget, codes | categories | sub_categories)
+        return self._render_rules_text(chapters, categories, sub_categories, keep={id(r) for r in kept})
+
+    def _render_rules_text(self, chapters, categories, sub_categories, keep=None):
+        """
+        按章节 / 类目 / 亚目 key 集合拼出规则文本。
+        keep 为保留规则的 id() 集合（见 get_budgeted_rules_text），为 None 时保留全部；被筛空的节点整段省略。
+        """
+        def pick(rules):
+            return rules if keep is None else [r for r in rules if id(r) in keep]
 
         lines = []
 
@@ -395,10 +488,12 @@ class ICDRuleManager:
             for chap in sorted(chapters):
                 rule_data = self.rules_l1.get(chap)
                 if rule_data:
+                    rules = pick(rule_data.get("chapter_rules", []))
+                    if keep is not None and not rules:
+                        continue
                     name = rule_data.get('name', '').replace('“', '').replace('”', '')
                     lines.append(f"当涉及 {chap} ({name}) 时,需要注意以下规则：")
                     
-                    rules = rule_data.get("chapter_rules", [])
                     if not rules:
                         lines.append("  (无特定规则)")
                     for idx, r in enumerate(rules, 1):
@@ -413,9 +508,11 @@ class ICDRuleManager:
             for cat in sorted(categories):
                 rule_data = self.rules_l2.get(cat)
                 if rule_data:
+                    rules = pick(rule_data.get("category_rules", []))
+                    if keep is not None and not rules:
+                        continue
                     found_any = True
                     temp_lines.append(f"当涉及类目 {cat} ({rule_data.get('name', '')}) 时,需要注意以下规则：")
-                    rules = rule_data.get("category_rules", [])
                     for idx, r in enumerate(rules, 1):
                     
                         content = r.get("rule_content", "").strip()
@@ -432,7 +529,7 @@ class ICDRuleManager:
             for sub in sorted(sub_categories):
                 rule_data = self.rules_l3.get(sub)
                 if rule_data:
-                    rules = rule_data.get("subcategory_rules", [])
+                    rules = pick(rule_data.get("subcategory_rules", []))
                     if rules: # 只有当规则列表不为空时才显示
                         found_any = True
                         temp_lines.append(f"当涉及亚目 {sub} ({rule_data.get('name', '')}) 时,需要注意以下规则：")
@@ -446,6 +543,60 @@ class ICDRuleManager:
 
         return "\n".join(lines)
 
+    def get_referenced_rules_text(self, items):
+        """
+        返回引用了候选编码（及其章节、类目、亚目）的规则文本，
+        不含 get_rules_text 已按候选的章节 / 类目 / 亚目列出的规则。
+        """
+        if not items:
+            return ""
+        codes = set()
+        own = set()
+        for item in items:
+            codes.add(item.get('code', ''))
+            if item.get('章节'):
+                chap = self.keys.key(item['章节'])
+                codes.add(chap)
+                own.update(r.get("rule_content", "").strip()
+                           for r in self.rules_l1.get(chap, {}).get("chapter_rules", []))
+            if item.get('类目'):
+                cat = self.keys.key(item['类目'])
+                codes.add(cat)
+                own.update(r.get("rule_content", "").strip()
+                           for r in self.rules_l2.get(cat, {}).get("category_rules", []))
+            if item.get('亚目'):
+                sub = self.keys.key(item['亚目'])
+                codes.add(sub)
+                own.update(r.get("rule_content", "").strip()
+                           for r in self.rules_l3.get(sub, {}).get("subcategory_rules", []))
+
+        rules = [r for r in self.find_referencing_rules(codes) if r["rule_content"] not in own]
+        if not rules:
+            return ""
+        lines = ["【候选编码相关规则】"]
+        for idx, r in enumerate(rules, 1):
+            lines.append(f"  {idx}. ({r['key']}) {r['rule_content']}")
+        return "\n".join(lines)
+
+RULE_INDEX_DIR = "./rule_index"
+
+_rule_managers = {}
+_rule_managers_lock = threading.Lock()
+
+
+def get_rule_manager(level1_path=os.path.join(RULE_INDEX_DIR, "level_1.jsonl"),
+                     level2_path=os.path.join(RULE_INDEX_DIR, "level_2.jsonl"),
+                     level3_path=os.path.join(RULE_INDEX_DIR, "level_3.jsonl")):
+    """进程内共享的 ICDRuleManager（按文件路径区分），规则文件只读一次，get_rules_text 缓存跨病人复用"""
+    key = (level1_path, level2_path, level3_path)
+    manager = _rule_managers.get(key)
+    if manager is None:
+        with _rule_managers_lock:
+            manager = _rule_managers.get(key)
+            if manager is None:
+                manager = _rule_managers[key] = ICDRuleManager(*key)
+    return manager
+
 def ICD_CALL_DESIESE_with_item(process_dict:dict, previous_func:str, params:dict):
     """
     召回上下位关系
@@ -464,11 +615,9 @@ def ICD_CALL_DESIESE_with_item(process_dict:dict, previous_func:str, params:dict
             item=json.loads(line.strip())
             node_dict[item['code']]=item
     retriever3 = ICDRetriever2(sources="ICD-10-fix", k=40)
-    sub_results_lists = []  
     content_summary=process_dict.get('content_summary',[])
-    for item in content_summary:
-        sub_list=retriever3.retrieve(item['推荐诊断'])
-        sub_results_lists.append(sub_list)
+    # 全部推荐诊断一次嵌入、一次向量库查询
+    sub_results_lists = retriever3.retrieve_many([item['推荐诊断'] for item in content_summary])
     final_results = merge_round_robin_advanced(sub_results_lists)
     seen_codes = set()
     merged = []
@@ -509,12 +658,22 @@ def ICD_Jugde_rethink(process_dict:dict, previous_func:str, params:dict):
     main_name=process_dict.get("main_name")
     unique_data=process_dict.get("Call_ICD_List",[])
 
-    manager = ICDRuleManager(
+    manager = get_rule_manager(
     level1_path="./rule_index/level_1.jsonl",
     level2_path="./rule_index/level_2.jsonl",
     level3_path="./rule_index/level_3.jsonl"
     )
-    rule_text = manager.get_rules_text(unique_data)
+    rule_token_budget = params.get("rule_token_budget")
+    if rule_token_budget is None:
+        rule_text = manager.get_rules_text(unique_data)
+    else:
+        # 按 token 预算截取规则：与病历、候选名称最相关的规则优先，引用候选编码的规则始终保留
+        rule_text = manager.get_budgeted_rules_text(unique_data, str(file_content), rule_token_budget)
+    if params.get("include_referenced_rules", False):
+        # 额外附上正文 / abstart_code 中引用了任一候选编码的规则（不限于候选自身祖先节点上的规则）
+        referenced_text = manager.get_referenced_rules_text(unique_data)
+        if referenced_text:
+            rule_text = f"{rule_text}\n\n{referenced_text}" if rule_text else referenced_text
     icd_prompt=f"""
 任务描述：
 - 你是一位专业的临床医生兼疾病分类专家，请根据提供的病历内容与基于病案主要诊断获得的候选ICD编码列表，严格依据临床诊疗逻辑与ICD编码规范，从中选择1个最精确、最具体的1个ICD编码。
@@ -0,0 +1,17 @@
+import re
+from collections import Counter
+
+# 字符 n-gram 切分（agent、retrieval、embedding 三处各有一份相同的拷贝）：
+# 规则筛选（rule_selector 的 BM25）与 ICD 名称的词法检索（ICD_retrival.LexicalIndex）共用，
+# 同一段中文在两处切出的词完全相同。
+
+# 计算 n-gram 前去掉的空白与标点
+PUNCT_RE = re.compile(r"[\s，。、；：！？“”‘’（）()【】\[\]《》<>,.;:!?\"'\-—–~～/\\|]+")
+
+
+def ngram_counts(text, n: int = 2) -> Counter:
+    """去空白与标点、转小写后的字符 n-gram 计数（文本不足 n 个字时整体作为一个词）"""
+    text = PUNCT_RE.sub("", str(text).lower())
+    if len(text) < n:
+        return Counter([text]) if text else Counter()
+    return Counter(text[i:i + n] for i in range(len(text) - n + 1))